@@ -0,0 +1,136 @@
+r"""Measures the bulk writer on SQLite.
+
+The database is filled with a cluster of other nodes first, so that what a
+write costs can't depend on the size of the cluster unnoticed.  This reports
+the SQL statements and wall time of the first write, of a write where
+nothing changed and of a write where one process was replaced.
+
+Run with `python benchmarks/bench_monitor_writer.py`
+"""
+
+import sys
+import time
+from os import path as osp
+
+import sqlalchemy as sa
+
+sys.path = [osp.dirname(osp.dirname(osp.abspath(__file__)))] + sys.path
+from gpu_use.db.schema import Base  # noqa: E402
+from gpu_use.monitor import monitor  # noqa: E402
+from gpu_use.monitor.bulk_writer import write_node_state_bulk  # noqa: E402
+from gpu_use.monitor.node_state import JobInfo, NodeState  # noqa: E402
+from gpu_use.monitor.proc_table import ProcInfo  # noqa: E402
+from gpu_use.monitor.slurm import JobMetadata  # noqa: E402
+
+NUM_NODES = 100
+NUM_GPUS = 8
+PROCS_PER_GPU = 4
+
+
+class _LabResolver:
+    def lab_name(self, user_name):
+        return "lab{}".format(int(user_name[len("user") :]) % 10)
+
+
+def make_state(node_idx):
+    hostname = "node{}".format(node_idx)
+    jid2job_info = {}
+    gpu2pid_info = {}
+    gpu2job_info = {}
+    pid2user_info = {}
+    pid2job_id = {}
+    for gpu_id in range(NUM_GPUS):
+        jid = node_idx * NUM_GPUS + gpu_id
+        user_name = "user{}".format(jid % 200)
+        jid2job_info[jid] = JobInfo(
+            jid=jid,
+            user_name=user_name,
+            metadata=JobMetadata(
+                jid=jid,
+                account=_LabResolver().lab_name(user_name),
+                partition="short",
+                cpus=6,
+            ),
+        )
+        gpu2job_info[gpu_id] = jid2job_info[jid]
+
+        gpu2pid_info[gpu_id] = []
+        for i in range(PROCS_PER_GPU):
+            pid = 1000 + gpu_id * PROCS_PER_GPU + i
+            gpu2pid_info[gpu_id].append(pid)
+            pid2user_info[pid] = ProcInfo(pid, 1, "python train.py", 0, user_name)
+            pid2job_id[pid] = jid
+
+    return NodeState(
+        hostname=hostname,
+        load="1.00 / 1.00 / 1.00",
+        gpu2pid_info=gpu2pid_info,
+        pid2user_info=pid2user_info,
+        pid2job_id=pid2job_id,
+        jid2job_info=jid2job_info,
+        gpu2job_info=gpu2job_info,
+        all_pids=set(pid2user_info.keys()),
+        user2lab={
+            job_info.user_name: _LabResolver().lab_name(job_info.user_name)
+            for job_info in jid2job_info.values()
+        },
+    )
+
+
+def make_session():
+    engine = sa.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sa.orm.sessionmaker(bind=engine)()
+    for node_idx in range(1, NUM_NODES):
+        write_node_state_bulk(session, make_state(node_idx))
+
+    return session
+
+
+def run_cycle(session, write_fn, state):
+    statements = []
+
+    def _count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    sa.event.listen(engine, "before_cursor_execute", _count)
+    start_time = time.perf_counter()
+    write_fn(session, state)
+    secs = time.perf_counter() - start_time
+    sa.event.remove(engine, "before_cursor_execute", _count)
+
+    return len(statements), secs
+
+
+def main():
+    monitor.logger.disabled = True
+
+    changed = make_state(0)
+    replaced_pid = changed.gpu2pid_info[0].pop()
+    changed.all_pids.remove(replaced_pid)
+    changed.gpu2pid_info[0].append(replaced_pid + 10000)
+    changed.pid2user_info[replaced_pid + 10000] = changed.pid2user_info[replaced_pid]
+    changed.pid2job_id[replaced_pid + 10000] = changed.pid2job_id[replaced_pid]
+    changed.all_pids.add(replaced_pid + 10000)
+
+    cycles = [
+        ("first", make_state(0)),
+        ("unchanged", make_state(0)),
+        ("1 proc", changed),
+    ]
+
+    print("{:>6} {:>10} {:>12} {:>10}".format("writer", "cycle", "statements", "ms"))
+    for name, write_fn in (("bulk", write_node_state_bulk),):
+        session = make_session()
+        for cycle_name, state in cycles:
+            num_statements, secs = run_cycle(session, write_fn, state)
+            print(
+                "{:>6} {:>10} {:>12} {:>10.2f}".format(
+                    name, cycle_name, num_statements, secs * 1e3
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+r"""Compares the ways of reading nvidia-smi output on captured 4, 8 and 16 GPU
+dumps: the old full `etree.fromstring` parse of `-q -x`, the streaming
+`iterparse` fallback, and the `--query-*` CSV mode.
+
+Run with `python benchmarks/bench_nvidia_smi_parse.py`
+"""
+
+import sys
+import timeit
+import tracemalloc
+from os import path as osp
+from xml.etree import ElementTree as etree
+
+sys.path = [osp.dirname(osp.dirname(osp.abspath(__file__)))] + sys.path
+from gpu_use.monitor.gpu_collector import (  # noqa: E402
+    GPUInfo,
+    GPUProcessInfo,
+    _parse_memory,
+    parse_nvidia_smi_csv,
+    parse_nvidia_smi_xml,
+)
+
+FIXTURES_DIR = osp.join(
+    osp.dirname(osp.dirname(osp.abspath(__file__))), "tests", "fixtures", "nvidia-smi"
+)
+
+
+def parse_full_xml(smi_out):
+    gpus = []
+    gpu_xml = etree.fromstring(smi_out)
+    for gpu in gpu_xml.findall("gpu"):
+        procs = [
+            GPUProcessInfo(
+                pid=int(p.find("pid").text),
+                used_memory=_parse_memory(p.find("used_memory").text),
+            )
+            for p in gpu.find("processes").findall("process_info")
+        ]
+        gpus.append(GPUInfo(int(gpu.find("minor_number").text), procs))
+
+    return gpus
+
+
+def _read(fname, mode="rt"):
+    with open(osp.join(FIXTURES_DIR, fname), mode) as f:
+        return f.read()
+
+
+def _measure(fn, number):
+    secs = min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return secs, peak
+
+
+def main():
+    print(
+        "{:>5} {:>10} {:>12} {:>12} {:>14}".format(
+            "GPUs", "method", "input (KiB)", "parse (ms)", "peak mem (KiB)"
+        )
+    )
+    for num_gpus in (4, 8, 16):
+        smi_xml = _read("{}gpu.xml".format(num_gpus), "rb")
+        gpu_csv = _read("{}gpu.gpus.csv".format(num_gpus))
+        apps_csv = _read("{}gpu.apps.csv".format(num_gpus))
+
+        methods = [
+            ("full-xml", len(smi_xml), lambda: parse_full_xml(smi_xml)),
+            ("iterparse", len(smi_xml), lambda: parse_nvidia_smi_xml(smi_xml)),
+            (
+                "csv",
+                len(gpu_csv) + len(apps_csv),
+                lambda: parse_nvidia_smi_csv(gpu_csv, apps_csv),
+            ),
+        ]
+
+        expected = parse_full_xml(smi_xml)
+        for name, input_size, fn in methods:
+            assert fn() == expected, name
+
+            secs, peak = _measure(fn, number=20)
+            print(
+                "{:>5} {:>10} {:>12.1f} {:>12.3f} {:>14.1f}".format(
+                    num_gpus, name, input_size / 1024, secs * 1e3, peak / 1024
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
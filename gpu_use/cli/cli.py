@@ -1,25 +1,72 @@
+import importlib
+
 import click
 import click_default_group
 
 from gpu_use import __version__
-from gpu_use.cli.lab_command import gpu_use_lab_command
-from gpu_use.cli.view_command import gpu_use_view_command
+
+
+class LazyDefaultGroup(click_default_group.DefaultGroup):
+    r"""Only imports a subcommand, and with it SQLAlchemy and the schema,
+    when that subcommand is run, so that e.g. `gpu-use version` starts fast.
+    """
+
+    lazy_commands = {
+        "view": "gpu_use.cli.view_command:gpu_use_view_command",
+        "lab": "gpu_use.cli.lab_command:gpu_use_lab_command",
+        "health": "gpu_use.cli.health_command:gpu_use_health_command",
+        "db": "gpu_use.cli.db_command:gpu_use_db_command",
+    }
+
+    def _load(self, cmd_name):
+        if cmd_name in self.commands or cmd_name not in self.lazy_commands:
+            return
+
+        module_name, attr_name = self.lazy_commands[cmd_name].split(":")
+        self.add_command(
+            getattr(importlib.import_module(module_name), attr_name), cmd_name
+        )
+
+    def list_commands(self, ctx):
+        return sorted(set(self.commands.keys()) | set(self.lazy_commands.keys()))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_commands:
+            self._load(cmd_name)
+        elif cmd_name not in self.commands:
+            # Anything else goes to the default command
+            self._load(self.default_cmd_name)
+
+        return super().get_command(ctx, cmd_name)
 
 
 @click.group(
-    cls=click_default_group.DefaultGroup,
+    cls=LazyDefaultGroup,
     default="view",
     default_if_no_args=True,
     name="gpu-use",
 )
-def gpu_use_cli():
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="Report time spent connecting to and querying the database",
+)
+@click.pass_context
+def gpu_use_cli(ctx, profile):
     r"""Display real-time information about usage on skynet on skynet
 
 To see the help string for a given command, use `gpu-use <command> --help`
 
 Executes the `view` command by default
 """
-    pass
+    if profile:
+        from gpu_use.cli.profiling import QueryProfiler
+        from gpu_use.db.engine import get_engine
+
+        profiler = QueryProfiler(get_engine())
+        profiler.start()
+        ctx.call_on_close(profiler.report)
 
 
 @click.command()
@@ -29,8 +76,6 @@ def version():
 
 
 gpu_use_cli.add_command(version)
-gpu_use_cli.add_command(gpu_use_view_command)
-gpu_use_cli.add_command(gpu_use_lab_command)
 
 
 if __name__ == "__main__":
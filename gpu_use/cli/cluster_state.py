@@ -0,0 +1,760 @@
+import datetime
+import json
+from typing import Dict, List, Optional, Set, Tuple
+
+import attr
+import sqlalchemy as sa
+
+from gpu_use.cli.utils import MAX_LAG_TIME, is_out_of_date, supports_unicode
+from gpu_use.db import gpu_status
+from gpu_use.db.schema import (
+    GPU,
+    GPUProcess,
+    GPUStatus,
+    Lab,
+    Node,
+    SLURMJob,
+    User,
+    user_node_association_table,
+)
+
+
+@attr.s(auto_attribs=True)
+class GPUParseResult:
+    reserved: bool = False
+    in_use: bool = False
+    valid_use: bool = False
+    idle: bool = False
+    error: bool = False
+    err_msg: str = ""
+    # One of the classes in gpu_use.db.gpu_status
+    error_class: str = gpu_status.NO_ERROR
+    res_char: str = "\u25a1" if supports_unicode() else "-"
+    use_char: str = "\u25a1" if supports_unicode() else "-"
+    res_record: str = "-"
+    color: str = "bright_white"
+
+
+@attr.s(auto_attribs=True)
+class ProcessParseResult:
+    color: Optional[str] = None
+    error: bool = False
+    err_msg: str = ""
+    error_class: str = gpu_status.NO_ERROR
+
+
+# Records are compared by identity, comparing their fields would walk the
+# whole graph
+@attr.s(auto_attribs=True, slots=True, eq=False)
+class JobRecord:
+    job_id: int
+    node_name: Optional[str]
+    lab_name: Optional[str]
+    user_name: Optional[str]
+    cpus: int
+    is_debug_job: bool
+    is_overcap_job: bool
+
+
+@attr.s(auto_attribs=True, slots=True, eq=False)
+class ProcessRecord:
+    id: int
+    gpu_id: int
+    node_name: str
+    slurm_job_id: Optional[int]
+    user_name: Optional[str]
+    command: str
+    slurm_job: Optional[JobRecord] = None
+    status: Optional[ProcessParseResult] = None
+
+
+@attr.s(auto_attribs=True, slots=True, eq=False)
+class GPURecord:
+    id: int
+    node_name: str
+    slurm_job_id: Optional[int]
+    lab_name: Optional[str]
+    user_name: Optional[str]
+    update_time: datetime.datetime
+    slurm_job: Optional[JobRecord] = None
+    processes: List[ProcessRecord] = attr.Factory(list)
+    # The user of the GPU and the users of its processes
+    user_names: Set[Optional[str]] = attr.Factory(set)
+    status: Optional[GPUParseResult] = None
+    stale: bool = False
+
+
+@attr.s(auto_attribs=True, slots=True, eq=False)
+class NodeRecord:
+    name: str
+    load: str
+    update_time: datetime.datetime
+    gpus: List[GPURecord] = attr.Factory(list)
+    slurm_jobs: List[JobRecord] = attr.Factory(list)
+    user_names: Set[str] = attr.Factory(set)
+    stale: bool = False
+
+
+@attr.s(auto_attribs=True)
+class Usage:
+    gpus: int = 0
+    cpus: int = 0
+    invalid_gpus: int = 0
+    idle_gpus: int = 0
+    # GPUs reserved by a job, regardless of whether they are up to date
+    job_gpus: int = 0
+
+
+_ERROR_MESSAGES = {
+    gpu_status.INVALID_USE: "",
+    gpu_status.IDLE: "[Idle reservation]",
+    gpu_status.IDLE_DEBUG: "[Idle reservation - DEBUG]",
+    gpu_status.NO_RESERVATION: "[Use without reservation]",
+}
+
+
+def _job_id(job: Optional[JobRecord]) -> Optional[int]:
+    return job.job_id if job is not None else None
+
+
+def is_valid_use(gpu: GPURecord) -> bool:
+    return gpu_status.is_valid_use(
+        _job_id(gpu.slurm_job),
+        gpu.slurm_job.user_name if gpu.slurm_job is not None else None,
+        [(_job_id(proc.slurm_job), proc.user_name) for proc in gpu.processes],
+    )
+
+
+def gpu_result(
+    job: Optional[JobRecord], in_use: bool, valid_use: bool, error: str
+) -> GPUParseResult:
+    r"""How a GPU is shown, error is one of the classes in gpu_use.db.gpu_status"""
+    res = GPUParseResult()
+    res.error_class = error
+    res.valid_use = valid_use
+    res.reserved = job is not None
+    res.in_use = in_use
+
+    if res.reserved:
+        res.res_char = "\u25a0" if supports_unicode() else "#"
+        res.res_record = "{} ({})".format(job.user_name, job.job_id)
+
+    if res.in_use:
+        res.use_char = "\u25a0" if supports_unicode() else "#"
+
+    if error != gpu_status.NO_ERROR:
+        res.color = "magenta" if error == gpu_status.IDLE_DEBUG else "red"
+        res.err_msg = _ERROR_MESSAGES[error]
+        res.error = True
+        res.idle = error == gpu_status.IDLE
+
+    return res
+
+
+def parse_gpu(gpu: GPURecord) -> GPUParseResult:
+    reserved = gpu.slurm_job is not None
+    in_use = len(gpu.processes) > 0
+    valid_use = is_valid_use(gpu)
+    return gpu_result(
+        gpu.slurm_job,
+        in_use,
+        valid_use,
+        gpu_status.gpu_error(
+            reserved, in_use, valid_use, reserved and gpu.slurm_job.is_debug_job
+        ),
+    )
+
+
+def process_result(error: str, job_id: Optional[int]) -> ProcessParseResult:
+    res = ProcessParseResult()
+    res.error_class = error
+
+    if error == gpu_status.WRONG_JOB:
+        res.color = "red"
+        res.err_msg = "[Wrong Job (" + str(job_id) + ")]"
+        res.error = True
+
+    if error == gpu_status.NO_JOB:
+        res.color = "red"
+        res.err_msg = "[No Job]"
+        res.error = True
+
+    return res
+
+
+def parse_process(gpu: GPURecord, proc: ProcessRecord) -> ProcessParseResult:
+    return process_result(
+        gpu_status.process_error(_job_id(proc.slurm_job), _job_id(gpu.slurm_job)),
+        proc.slurm_job_id,
+    )
+
+
+def is_user_on_gpu(gpu: GPURecord, user_names: Optional[Set[str]]) -> bool:
+    return user_names is None or not gpu.user_names.isdisjoint(user_names)
+
+
+class ClusterState:
+    r"""Everything the CLI shows, read in one pass over the tables.
+
+    The status of every GPU and process is worked out once when loading and
+    the records are indexed by node, user and lab, so views only have to
+    format what is already there.
+
+    A state read from gpu_status (see load_gpu_status) comes with the status
+    the monitor worked out, but only knows the jobs GPUs are reserved by, and
+    the jobs don't know their CPUs.
+    """
+
+    def __init__(
+        self,
+        nodes: List[NodeRecord],
+        jobs: List[JobRecord],
+        gpus: List[GPURecord],
+        processes: List[ProcessRecord],
+        user2lab: Dict[str, Optional[str]],
+        lab_names: List[str],
+        marker: Tuple = None,
+        from_gpu_status: bool = False,
+        with_users: bool = True,
+    ):
+        # Changes whenever a node is written, see refresh
+        self.marker = marker
+        self.from_gpu_status = from_gpu_status
+        self.with_users = with_users
+        self._build(nodes, jobs, gpus, processes, user2lab, lab_names)
+
+    def _build(self, nodes, jobs, gpus, processes, user2lab, lab_names):
+        self.lab_names = sorted(lab_names)
+        self.user2lab = user2lab
+        self.nodes = sorted(nodes, key=lambda node: node.name)
+        self.name2node = {node.name: node for node in self.nodes}
+        self.jobs = {job.job_id: job for job in jobs}
+        self.processes = sorted(processes, key=lambda proc: proc.id)
+
+        for node in self.nodes:
+            node.gpus = []
+            node.slurm_jobs = []
+
+        self.users_by_lab: Dict[str, List[str]] = {name: [] for name in lab_names}
+        for user_name in sorted(user2lab.keys()):
+            lab_name = user2lab[user_name]
+            if lab_name is not None:
+                self.users_by_lab.setdefault(lab_name, []).append(user_name)
+
+        self.jobs_by_user: Dict[str, List[JobRecord]] = {}
+        self.jobs_by_lab: Dict[str, List[JobRecord]] = {}
+        for job in self.jobs.values():
+            self._index(self.jobs_by_user, job.user_name, job)
+            self._index(self.jobs_by_lab, job.lab_name, job)
+            node = self.name2node.get(job.node_name)
+            if node is not None:
+                node.slurm_jobs.append(job)
+
+        gpu2processes: Dict[Tuple[str, int], List[ProcessRecord]] = {}
+        for proc in self.processes:
+            if not self.from_gpu_status:
+                proc.slurm_job = self.jobs.get(proc.slurm_job_id)
+            gpu2processes.setdefault((proc.node_name, proc.gpu_id), []).append(proc)
+
+        self.gpus_by_user: Dict[str, List[GPURecord]] = {}
+        self.gpus_by_lab: Dict[str, List[GPURecord]] = {}
+        self.gpus = sorted(gpus, key=lambda gpu: (gpu.node_name, gpu.id))
+        for gpu in self.gpus:
+            gpu.processes = gpu2processes.get((gpu.node_name, gpu.id), [])
+            gpu.user_names = {gpu.user_name} | {
+                proc.user_name for proc in gpu.processes
+            }
+            if not self.from_gpu_status:
+                gpu.slurm_job = self.jobs.get(gpu.slurm_job_id)
+                gpu.status = parse_gpu(gpu)
+                for proc in gpu.processes:
+                    proc.status = parse_process(gpu, proc)
+
+            self._index(self.gpus_by_user, gpu.user_name, gpu)
+            self._index(self.gpus_by_lab, gpu.lab_name, gpu)
+            node = self.name2node.get(gpu.node_name)
+            if node is not None:
+                node.gpus.append(gpu)
+
+        self.mark_stale()
+
+    def mark_stale(self):
+        r"""Records go stale with time alone, without anything being written"""
+        for node in self.nodes:
+            node.stale = is_out_of_date(node.update_time)
+        for gpu in self.gpus:
+            gpu.stale = is_out_of_date(gpu.update_time)
+
+    @staticmethod
+    def _index(index, key, record):
+        if key is not None:
+            index.setdefault(key, []).append(record)
+
+    @staticmethod
+    def _read_marker(session, from_gpu_status: bool) -> Tuple:
+        if from_gpu_status:
+            columns = [
+                sa.func.count(GPUStatus.gpu_id),
+                sa.func.max(GPUStatus.node_update_time),
+            ]
+        else:
+            columns = [sa.func.count(Node.name), sa.func.max(Node.update_time)]
+
+        return tuple(session.execute(sa.select(columns)).first())
+
+    @staticmethod
+    def _read_users(session) -> Dict:
+        # Users and labs are small and shared by all nodes
+        return dict(
+            user2lab=dict(
+                session.execute(sa.select([User.name, User.lab_name])).fetchall()
+            ),
+            lab_names=[row[0] for row in session.execute(sa.select([Lab.name]))],
+        )
+
+    @staticmethod
+    def _fetch(session, node_names: Optional[List[str]] = None) -> Dict:
+        r"""Reads the records of all nodes, or only of node_names"""
+
+        def _select(node_name_column, *columns):
+            query = sa.select(columns)
+            if node_names is not None:
+                query = query.where(node_name_column.in_(node_names))
+
+            return session.execute(query).fetchall()
+
+        nodes = [
+            NodeRecord(*row)
+            for row in _select(Node.name, Node.name, Node.load, Node.update_time)
+        ]
+        name2node = {node.name: node for node in nodes}
+        for user_name, node_name in _select(
+            user_node_association_table.c.node_name,
+            user_node_association_table.c.user_name,
+            user_node_association_table.c.node_name,
+        ):
+            if node_name in name2node:
+                name2node[node_name].user_names.add(user_name)
+
+        return dict(
+            nodes=nodes,
+            jobs=[
+                JobRecord(*row)
+                for row in _select(
+                    SLURMJob.node_name,
+                    SLURMJob.job_id,
+                    SLURMJob.node_name,
+                    SLURMJob.lab_name,
+                    SLURMJob.user_name,
+                    SLURMJob.cpus,
+                    SLURMJob.is_debug_job,
+                    SLURMJob.is_overcap_job,
+                )
+            ],
+            gpus=[
+                GPURecord(*row)
+                for row in _select(
+                    GPU.node_name,
+                    GPU.id,
+                    GPU.node_name,
+                    GPU.slurm_job_id,
+                    GPU.lab_name,
+                    GPU.user_name,
+                    GPU.update_time,
+                )
+            ],
+            processes=[
+                ProcessRecord(*row)
+                for row in _select(
+                    GPUProcess.node_name,
+                    GPUProcess.id,
+                    GPUProcess.gpu_id,
+                    GPUProcess.node_name,
+                    GPUProcess.slurm_job_id,
+                    GPUProcess.user_name,
+                    GPUProcess.command,
+                )
+            ],
+            **ClusterState._read_users(session)
+        )
+
+    @staticmethod
+    def _fetch_gpu_status(
+        session, node_names: Optional[List[str]] = None, with_users: bool = True
+    ) -> Dict:
+        r"""Like _fetch, but with one query on gpu_status"""
+        status_table = GPUStatus.__table__
+        query = sa.select([status_table]).order_by(
+            status_table.c.node_name, status_table.c.gpu_id
+        )
+        if node_names is not None:
+            query = query.where(status_table.c.node_name.in_(node_names))
+
+        nodes = {}
+        jobs = {}
+        gpus = []
+        processes = []
+        for row in session.execute(query):
+            if row.node_name not in nodes:
+                nodes[row.node_name] = NodeRecord(
+                    row.node_name,
+                    row.node_load,
+                    row.node_update_time,
+                    user_names=set(json.loads(row.node_user_names)),
+                )
+
+            job = None
+            if row.slurm_job_id is not None:
+                job = jobs.setdefault(
+                    row.slurm_job_id,
+                    JobRecord(
+                        row.slurm_job_id,
+                        row.node_name,
+                        row.lab_name,
+                        row.user_name,
+                        None,
+                        row.is_debug_job,
+                        None,
+                    ),
+                )
+
+            gpus.append(
+                GPURecord(
+                    row.gpu_id,
+                    row.node_name,
+                    row.slurm_job_id,
+                    row.lab_name,
+                    row.user_name,
+                    row.update_time,
+                    slurm_job=job,
+                    status=gpu_result(job, row.in_use, row.valid_use, row.error),
+                )
+            )
+            for pid, command, user_name, slurm_job_id, error in json.loads(
+                row.processes
+            ):
+                processes.append(
+                    ProcessRecord(
+                        pid,
+                        row.gpu_id,
+                        row.node_name,
+                        slurm_job_id,
+                        user_name,
+                        command,
+                        status=process_result(error, slurm_job_id),
+                    )
+                )
+
+        records = dict(
+            nodes=list(nodes.values()),
+            jobs=list(jobs.values()),
+            gpus=gpus,
+            processes=processes,
+            user2lab={},
+            lab_names=[],
+        )
+        if with_users:
+            records.update(ClusterState._read_users(session))
+
+        return records
+
+    @classmethod
+    def load(cls, session) -> "ClusterState":
+        r"""Reads the whole cluster, session can also be a connection"""
+        marker = cls._read_marker(session, from_gpu_status=False)
+        return cls(marker=marker, **cls._fetch(session))
+
+    @classmethod
+    def load_gpu_status(cls, session, with_users: bool = True) -> "ClusterState":
+        r"""Reads the cluster from gpu_status with one query, plus users and
+        labs if with_users.  Falls back to load while the monitor doesn't
+        write gpu_status yet.
+        """
+        marker = cls._read_marker(session, from_gpu_status=True)
+        if marker[0] == 0:
+            return cls.load(session)
+
+        return cls(
+            marker=marker,
+            from_gpu_status=True,
+            with_users=with_users,
+            **cls._fetch_gpu_status(session, with_users=with_users)
+        )
+
+    def refresh(self, session) -> bool:
+        r"""Re-reads only the nodes written since the state was read.  Checking
+        for changes is a single one row query.  Returns whether anything was
+        re-read.
+        """
+        marker = self._read_marker(session, self.from_gpu_status)
+        if marker == self.marker:
+            self.mark_stale()
+            return False
+
+        if self.from_gpu_status:
+            query = sa.select(
+                [GPUStatus.node_name, sa.func.max(GPUStatus.node_update_time)]
+            ).group_by(GPUStatus.node_name)
+        else:
+            query = sa.select([Node.name, Node.update_time])
+        name2update_time = dict(session.execute(query).fetchall())
+        changed = [
+            name
+            for name, update_time in name2update_time.items()
+            if name not in self.name2node
+            or self.name2node[name].update_time != update_time
+        ]
+        dropped = set(changed) | (set(self.name2node.keys()) - set(name2update_time))
+        if self.from_gpu_status:
+            fetched = self._fetch_gpu_status(session, changed, self.with_users)
+        else:
+            fetched = self._fetch(session, changed)
+
+        def _kept(records):
+            return [record for record in records if record.node_name not in dropped]
+
+        self._build(
+            nodes=[node for node in self.nodes if node.name not in dropped]
+            + fetched["nodes"],
+            jobs=_kept(self.jobs.values()) + fetched["jobs"],
+            gpus=_kept(self.gpus) + fetched["gpus"],
+            processes=_kept(self.processes) + fetched["processes"],
+            user2lab=fetched["user2lab"],
+            lab_names=fetched["lab_names"],
+        )
+        self.marker = marker
+        return True
+
+
+def _is_true(column):
+    r"""NULL counts as false, like it does in Python"""
+    return sa.func.coalesce(column, sa.false()) == sa.true()
+
+
+def _count(condition):
+    return sa.func.sum(sa.case([(condition, 1)], else_=0))
+
+
+def _gpu_usage_query(cutoff: datetime.datetime):
+    r"""GPU usage grouped by the lab and user each GPU is attributed to, with
+    and without GPUs of overcap jobs
+    """
+    gpus = GPU.__table__
+    procs = GPUProcess.__table__
+    jobs = SLURMJob.__table__
+    gpu_jobs = jobs.alias("gpu_jobs")
+
+    # gpu_status.is_valid_use: either every process is in the GPU's job, or
+    # every process belongs to the user of the GPU's job
+    wrong_job = sa.or_(
+        procs.c.slurm_job_id.is_(None),
+        gpu_jobs.c.job_id.is_(None),
+        procs.c.slurm_job_id != gpu_jobs.c.job_id,
+    )
+    wrong_user = sa.or_(
+        gpu_jobs.c.job_id.is_(None),
+        sa.not_(
+            sa.or_(
+                procs.c.user_name == gpu_jobs.c.user_name,
+                sa.and_(procs.c.user_name.is_(None), gpu_jobs.c.user_name.is_(None)),
+            )
+        ),
+    )
+    gpu_procs = (
+        sa.select(
+            [
+                procs.c.node_name,
+                procs.c.gpu_id,
+                sa.func.count().label("num_processes"),
+                _count(wrong_job).label("num_wrong_job"),
+                _count(wrong_user).label("num_wrong_user"),
+            ]
+        )
+        .select_from(
+            procs.join(
+                gpus,
+                (procs.c.node_name == gpus.c.node_name) & (procs.c.gpu_id == gpus.c.id),
+            ).outerjoin(gpu_jobs, gpus.c.slurm_job_id == gpu_jobs.c.job_id)
+        )
+        .group_by(procs.c.node_name, procs.c.gpu_id)
+        .alias("gpu_procs")
+    )
+
+    fresh = gpus.c.update_time > cutoff
+    reserved = jobs.c.job_id.isnot(None)
+    not_overcap = sa.not_(sa.and_(reserved, _is_true(jobs.c.is_overcap_job)))
+    # gpu_status.gpu_error
+    invalid = sa.and_(gpu_procs.c.num_wrong_job > 0, gpu_procs.c.num_wrong_user > 0)
+    idle = sa.and_(
+        reserved,
+        sa.func.coalesce(gpu_procs.c.num_processes, 0) == 0,
+        sa.not_(_is_true(jobs.c.is_debug_job)),
+    )
+
+    return (
+        sa.select(
+            [
+                gpus.c.lab_name,
+                gpus.c.user_name,
+                _count(fresh).label("gpus"),
+                _count(sa.and_(fresh, invalid)).label("invalid_gpus"),
+                _count(sa.and_(fresh, idle)).label("idle_gpus"),
+                _count(reserved).label("job_gpus"),
+                _count(sa.and_(fresh, not_overcap)).label("gpus_without_overcap"),
+                _count(sa.and_(fresh, not_overcap, idle)).label(
+                    "idle_gpus_without_overcap"
+                ),
+                _count(sa.and_(reserved, not_overcap)).label(
+                    "job_gpus_without_overcap"
+                ),
+                sa.func.min(sa.case([(fresh, gpus.c.update_time)])).label("oldest"),
+            ]
+        )
+        .select_from(
+            gpus.outerjoin(
+                gpu_procs,
+                (gpus.c.node_name == gpu_procs.c.node_name)
+                & (gpus.c.id == gpu_procs.c.gpu_id),
+            ).outerjoin(jobs, gpus.c.slurm_job_id == jobs.c.job_id)
+        )
+        .group_by(gpus.c.lab_name, gpus.c.user_name)
+    )
+
+
+def _cpu_usage_query(cutoff: datetime.datetime):
+    r"""CPUs of jobs on up to date nodes grouped by lab and user, with and
+    without overcap jobs
+    """
+    jobs = SLURMJob.__table__
+    nodes = Node.__table__
+
+    fresh = nodes.c.update_time > cutoff
+    not_overcap = sa.not_(_is_true(jobs.c.is_overcap_job))
+
+    def _cpus(condition):
+        return sa.func.sum(sa.case([(condition, jobs.c.cpus)], else_=0))
+
+    return (
+        sa.select(
+            [
+                jobs.c.lab_name,
+                jobs.c.user_name,
+                _cpus(fresh).label("cpus"),
+                _cpus(sa.and_(fresh, not_overcap)).label("cpus_without_overcap"),
+                sa.func.min(sa.case([(fresh, nodes.c.update_time)])).label("oldest"),
+            ]
+        )
+        .select_from(jobs.join(nodes, jobs.c.node_name == nodes.c.name))
+        .group_by(jobs.c.lab_name, jobs.c.user_name)
+    )
+
+
+@attr.s(auto_attribs=True)
+class LabUsage:
+    r"""What `gpu-use lab` shows.  The usage of every lab and user is summed
+    up by the database in two aggregate queries, so reading it doesn't depend
+    on how many GPUs, processes and jobs there are.
+
+    Like ClusterState, it can be refreshed, which sums everything up again
+    once a node was written or something it counted got out of date.
+    """
+
+    lab_names: List[str]
+    user2lab: Dict[str, Optional[str]]
+    # Usage by lab and by user, by whether overcap jobs count
+    usage: Dict[bool, Tuple[Dict[str, Usage], Dict[str, Usage]]]
+    marker: Tuple = None
+    # When the first GPU or node counted as up to date stops being so
+    expires_at: Optional[datetime.datetime] = None
+
+    @property
+    def users_by_lab(self) -> Dict[str, List[str]]:
+        users_by_lab: Dict[str, List[str]] = {name: [] for name in self.lab_names}
+        for user_name in sorted(self.user2lab.keys()):
+            lab_name = self.user2lab[user_name]
+            if lab_name is not None:
+                users_by_lab.setdefault(lab_name, []).append(user_name)
+
+        return users_by_lab
+
+    def usage_by_lab_and_user(
+        self, overcap: bool
+    ) -> Tuple[Dict[str, Usage], Dict[str, Usage]]:
+        r"""Usage of every lab and every user.  Anything not up to date counts
+        as unused.
+        """
+        return self.usage[overcap]
+
+    @classmethod
+    def load(cls, session) -> "LabUsage":
+        marker = ClusterState._read_marker(session, from_gpu_status=False)
+        users = ClusterState._read_users(session)
+        now = datetime.datetime.now()
+        usage = {
+            overcap: (
+                {name: Usage() for name in users["lab_names"]},
+                {name: Usage() for name in users["user2lab"].keys()},
+            )
+            for overcap in (True, False)
+        }
+        oldest = []
+
+        def _usages(row, overcap):
+            lab_usage, user_usage = usage[overcap]
+            return [
+                by_name.setdefault(name, Usage())
+                for by_name, name in (
+                    (lab_usage, row.lab_name),
+                    (user_usage, row.user_name),
+                )
+                if name is not None
+            ]
+
+        # Sums come back as decimals from MySQL
+        for row in session.execute(_gpu_usage_query(now - MAX_LAG_TIME)):
+            for totals in _usages(row, overcap=True):
+                totals.gpus += int(row.gpus)
+                totals.invalid_gpus += int(row.invalid_gpus)
+                totals.idle_gpus += int(row.idle_gpus)
+                totals.job_gpus += int(row.job_gpus)
+            for totals in _usages(row, overcap=False):
+                totals.gpus += int(row.gpus_without_overcap)
+                totals.invalid_gpus += int(row.invalid_gpus)
+                totals.idle_gpus += int(row.idle_gpus_without_overcap)
+                totals.job_gpus += int(row.job_gpus_without_overcap)
+            oldest.append(row.oldest)
+
+        for row in session.execute(_cpu_usage_query(now - MAX_LAG_TIME)):
+            for totals in _usages(row, overcap=True):
+                totals.cpus += int(row.cpus or 0)
+            for totals in _usages(row, overcap=False):
+                totals.cpus += int(row.cpus_without_overcap or 0)
+            oldest.append(row.oldest)
+
+        oldest = [update_time for update_time in oldest if update_time is not None]
+        return cls(
+            usage=usage,
+            marker=marker,
+            expires_at=min(oldest) + MAX_LAG_TIME if oldest else None,
+            **users
+        )
+
+    def refresh(self, session) -> bool:
+        r"""Sums everything up again if a node was written or something got
+        out of date since.  Checking for writes is a single one row query.
+        Returns whether anything was read again.
+        """
+        if ClusterState._read_marker(
+            session, from_gpu_status=False
+        ) == self.marker and (
+            self.expires_at is None or datetime.datetime.now() < self.expires_at
+        ):
+            return False
+
+        loaded = self.load(session)
+        self.lab_names = loaded.lab_names
+        self.user2lab = loaded.user2lab
+        self.usage = loaded.usage
+        self.marker = loaded.marker
+        self.expires_at = loaded.expires_at
+        return True
@@ -0,0 +1 @@
+from gpu_use.cli.db_command.db_command import gpu_use_db_command
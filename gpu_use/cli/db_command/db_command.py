@@ -0,0 +1,32 @@
+import click
+import sqlalchemy as sa
+
+from gpu_use.db.engine import get_engine
+from gpu_use.db.schema import Base, create_schema
+
+
+@click.group(name="db")
+def gpu_use_db_command():
+    r"""Manage the gpu-use database"""
+    pass
+
+
+@gpu_use_db_command.command(name="init")
+def init():
+    r"""Create the tables that don't exist yet
+
+    Safe to run on an existing database, run it after every upgrade.
+    """
+    engine = get_engine()
+    existing_tables = set(sa.inspect(engine).get_table_names())
+    create_schema(engine)
+
+    new_tables = [
+        table.name
+        for table in Base.metadata.sorted_tables
+        if table.name not in existing_tables
+    ]
+    if len(new_tables) == 0:
+        click.echo("Schema is up to date")
+    else:
+        click.echo("Created {}".format(", ".join(new_tables)))
@@ -0,0 +1 @@
+from gpu_use.cli.health_command.health_command import gpu_use_health_command
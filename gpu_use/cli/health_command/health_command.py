@@ -0,0 +1,161 @@
+import collections
+import json
+from typing import Dict, List, Sequence
+
+import attr
+import click
+
+from gpu_use.db.schema import MonitorCycle
+from gpu_use.db.session import SessionMaker
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    r"""Nearest-rank percentile, q is in [0, 100]"""
+    if len(values) == 0:
+        return 0.0
+
+    values = sorted(values)
+    rank = max(int(-(-q * len(values) // 100)), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+@attr.s(auto_attribs=True)
+class NodeHealth:
+    node_name: str
+    num_cycles: int
+    p50: float
+    p90: float
+    # The phase with the largest median time and that median
+    slowest_phase: str
+    slowest_phase_time: float
+    failed_phases: Dict[str, int]
+
+
+def summarize_nodes(cycles: List[MonitorCycle]) -> List[NodeHealth]:
+    node2cycles = collections.defaultdict(list)
+    for cycle in cycles:
+        node2cycles[cycle.node_name].append(cycle)
+
+    summaries = []
+    for node_name, node_cycles in node2cycles.items():
+        phase2times = collections.defaultdict(list)
+        for cycle in node_cycles:
+            for phase, t in json.loads(cycle.phase_times or "{}").items():
+                phase2times[phase].append(t)
+
+        phase_medians = {
+            phase: percentile(times, 50) for phase, times in phase2times.items()
+        }
+        slowest_phase = max(
+            phase_medians, key=lambda phase: phase_medians[phase], default="-"
+        )
+
+        durations = [
+            cycle.duration for cycle in node_cycles if cycle.failed_phase is None
+        ]
+        summaries.append(
+            NodeHealth(
+                node_name=node_name,
+                num_cycles=len(node_cycles),
+                p50=percentile(durations, 50),
+                p90=percentile(durations, 90),
+                slowest_phase=slowest_phase,
+                slowest_phase_time=phase_medians.get(slowest_phase, 0.0),
+                failed_phases=dict(
+                    collections.Counter(
+                        cycle.failed_phase
+                        for cycle in node_cycles
+                        if cycle.failed_phase is not None
+                    )
+                ),
+            )
+        )
+
+    return sorted(summaries, key=lambda s: s.p90, reverse=True)
+
+
+@click.command(name="health")
+@click.option(
+    "-n",
+    "--top",
+    type=int,
+    default=10,
+    show_default=True,
+    help="How many of the slowest nodes to show",
+)
+@click.option(
+    "-s",
+    "--slow",
+    type=float,
+    default=30.0,
+    show_default=True,
+    help="Nodes whose p90 cycle takes longer than this many seconds are highlighted",
+)
+def gpu_use_health_command(top, slow):
+    r"""Display how long monitor cycles take and which phases fail"""
+    session = SessionMaker()
+    cycles = session.query(MonitorCycle).all()
+    if len(cycles) == 0:
+        raise click.ClickException("No monitor cycles have been recorded yet")
+
+    durations = [cycle.duration for cycle in cycles if cycle.failed_phase is None]
+    summaries = summarize_nodes(cycles)
+
+    click.echo()
+    click.secho(
+        "Cycle duration over {} cycles on {} nodes".format(len(cycles), len(summaries)),
+        bold=True,
+    )
+    click.echo(
+        "  p50 {:.2f}s   p90 {:.2f}s   p99 {:.2f}s   max {:.2f}s".format(
+            percentile(durations, 50),
+            percentile(durations, 90),
+            percentile(durations, 99),
+            max(durations, default=0.0),
+        )
+    )
+
+    name_width = max(len(s.node_name) for s in summaries) + 2
+    click.echo()
+    click.secho("Slowest nodes", bold=True)
+    click.echo(
+        "{:>{width}}  {:>6}  {:>8}  {:>8}  {}".format(
+            "Node", "Cycles", "p50", "p90", "Slowest phase", width=name_width
+        )
+    )
+    for summary in summaries[:top]:
+        click.secho(
+            "{:>{width}}  {:6d}  {:7.2f}s  {:7.2f}s  {} ({:.2f}s)".format(
+                summary.node_name,
+                summary.num_cycles,
+                summary.p50,
+                summary.p90,
+                summary.slowest_phase,
+                summary.slowest_phase_time,
+                width=name_width,
+            ),
+            fg="red" if summary.p90 > slow else None,
+        )
+
+    failing = [s for s in summaries if len(s.failed_phases) > 0]
+    click.echo()
+    click.secho("Failing phases", bold=True)
+    if len(failing) == 0:
+        click.secho("  None", fg="green")
+
+    for summary in sorted(
+        failing, key=lambda s: sum(s.failed_phases.values()), reverse=True
+    ):
+        click.secho(
+            "{:>{width}}  {}".format(
+                summary.node_name,
+                ", ".join(
+                    "{} x{}".format(phase, count)
+                    for phase, count in sorted(
+                        summary.failed_phases.items(), key=lambda kv: -kv[1]
+                    )
+                ),
+                width=name_width,
+            ),
+            fg="red",
+        )
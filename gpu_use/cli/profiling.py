@@ -0,0 +1,53 @@
+import time
+
+import click
+import sqlalchemy as sa
+
+
+class QueryProfiler:
+    r"""Times connecting to the database and the queries a command runs"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.start_time = time.time()
+        self.num_connects = 0
+        self.connect_time = 0.0
+        self.num_queries = 0
+        self.query_time = 0.0
+        self._connect_start = None
+        self._query_start = None
+
+    def _before_connect(self, *args):
+        self._connect_start = time.time()
+
+    def _after_connect(self, *args):
+        if self._connect_start is not None:
+            self.num_connects += 1
+            self.connect_time += time.time() - self._connect_start
+            self._connect_start = None
+
+    def _before_query(self, *args):
+        self._query_start = time.time()
+
+    def _after_query(self, *args):
+        self.num_queries += 1
+        self.query_time += time.time() - self._query_start
+
+    def start(self):
+        sa.event.listen(self.engine, "do_connect", self._before_connect)
+        sa.event.listen(self.engine, "connect", self._after_connect)
+        sa.event.listen(self.engine, "before_cursor_execute", self._before_query)
+        sa.event.listen(self.engine, "after_cursor_execute", self._after_query)
+
+    def report(self):
+        click.echo(
+            "Connecting: {:.3f}s over {} connection(s), querying: {:.3f}s over"
+            " {} queries, total: {:.3f}s".format(
+                self.connect_time,
+                self.num_connects,
+                self.query_time,
+                self.num_queries,
+                time.time() - self.start_time,
+            ),
+            err=True,
+        )
@@ -0,0 +1,460 @@
+import datetime
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import os.path as osp
+import socket
+import stat
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import attr
+
+from gpu_use.cli.cluster_state import (
+    ClusterState,
+    GPURecord,
+    JobRecord,
+    LabUsage,
+    NodeRecord,
+    ProcessRecord,
+    Usage,
+    gpu_result,
+    process_result,
+)
+from gpu_use.db import gpu_status
+from gpu_use.db.engine import get_engine
+from gpu_use.db.session import SessionMaker
+
+# Set to a directory to share one cache between all users of a login node.
+# Only whoever may write the directory may write the cache, so it must not be
+# writable by others, e.g. install -d -m 3770 -g gpu-use /dev/shm/gpu-use
+CACHE_DIR_ENV_VAR = "GPU_USE_CACHE_DIR"
+CACHE_TTL_ENV_VAR = "GPU_USE_CACHE_TTL"
+DEFAULT_CACHE_TTL = 5.0
+
+# What an entry holds, see StateCache
+TABLES = "tables"
+GPU_STATUS = "gpu_status"
+LAB_USAGE = "lab_usage"
+SOURCES = (TABLES, GPU_STATUS, LAB_USAGE)
+
+_MAGIC = b"gpu-use-cache 3\n"
+_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def _encode_time(value: Optional[datetime.datetime]) -> Optional[str]:
+    # Exact, the marker and the update times are compared with the database's
+    return value.strftime(_TIME_FORMAT) if value is not None else None
+
+
+def _decode_time(value: Optional[str]) -> Optional[datetime.datetime]:
+    return (
+        datetime.datetime.strptime(value, _TIME_FORMAT) if value is not None else None
+    )
+
+
+def _row_fields(cls) -> List[attr.Attribute]:
+    # What ClusterState._fetch reads, everything else is derived
+    return [field for field in attr.fields(cls) if field.default is attr.NOTHING]
+
+
+def _check(value: Any, expected: type) -> None:
+    r"""Raises ValueError unless value is None or exactly of type expected.
+    Any column the records are read from may be NULL.
+    """
+    if value is not None and type(value) is not expected:
+        raise ValueError("{!r} isn't a {}".format(value, expected.__name__))
+
+
+def _check_all(values: Any, expected: type) -> None:
+    _check(values, list)
+    for value in values:
+        _check(value, expected)
+
+
+def _encoded_type(field: attr.Attribute) -> type:
+    # Optional[X] is Union[X, None]
+    annotation = next(
+        (arg for arg in getattr(field.type, "__args__", ()) if arg is not type(None)),
+        field.type,
+    )
+    return str if annotation is datetime.datetime else annotation
+
+
+def _to_row(record) -> List[Any]:
+    return [
+        (
+            _encode_time(getattr(record, field.name))
+            if field.type is datetime.datetime
+            else getattr(record, field.name)
+        )
+        for field in _row_fields(type(record))
+    ]
+
+
+def _from_row(cls, row: List[Any], **kwargs):
+    fields = _row_fields(cls)
+    _check(row, list)
+    if len(row) != len(fields):
+        raise ValueError("Expected {} values, got {}".format(len(fields), len(row)))
+    for field, value in zip(fields, row):
+        _check(value, _encoded_type(field))
+
+    return cls(
+        *[
+            _decode_time(value) if field.type is datetime.datetime else value
+            for field, value in zip(_row_fields(cls), row)
+        ],
+        **kwargs
+    )
+
+
+def _source_of(state: Union[ClusterState, LabUsage]) -> str:
+    if isinstance(state, LabUsage):
+        return LAB_USAGE
+
+    return GPU_STATUS if state.from_gpu_status else TABLES
+
+
+def _encode_usage(usage: Dict[str, Usage]) -> Dict[str, List[int]]:
+    return {name: list(attr.astuple(totals)) for name, totals in usage.items()}
+
+
+def _decode_usage(usage: Dict[str, List[int]]) -> Dict[str, Usage]:
+    _check(usage, dict)
+    num_fields = len(attr.fields(Usage))
+    for values in usage.values():
+        _check_all(values, int)
+        if len(values) != num_fields:
+            raise ValueError("Expected {} values".format(num_fields))
+
+    return {name: Usage(*values) for name, values in usage.items()}
+
+
+def encode_state(state: Union[ClusterState, LabUsage], fetched_at: float) -> bytes:
+    r"""The records of a state, or the sums of a LabUsage, as zlib compressed
+    JSON.  Nothing in it is ever executed, and decode_state checks the type
+    of every value.
+
+    A state read from gpu_status keeps the status the monitor worked out, as
+    it can't be worked out again from its records.
+    """
+    entry = dict(
+        fetched_at=fetched_at,
+        source=_source_of(state),
+        marker=[state.marker[0], _encode_time(state.marker[1])],
+        user2lab=state.user2lab,
+        lab_names=state.lab_names,
+    )
+    if isinstance(state, LabUsage):
+        entry.update(
+            usage=[
+                [_encode_usage(usage) for usage in state.usage[overcap]]
+                for overcap in (False, True)
+            ],
+            expires_at=_encode_time(state.expires_at),
+        )
+        return _MAGIC + zlib.compress(json.dumps(entry, separators=(",", ":")).encode())
+
+    if state.from_gpu_status:
+        gpus = [
+            _to_row(gpu)
+            + [gpu.status.in_use, gpu.status.valid_use, gpu.status.error_class]
+            for gpu in state.gpus
+        ]
+        processes = [
+            _to_row(proc) + [proc.status.error_class] for proc in state.processes
+        ]
+    else:
+        gpus = [_to_row(gpu) for gpu in state.gpus]
+        processes = [_to_row(proc) for proc in state.processes]
+
+    entry.update(
+        nodes=[_to_row(node) + [sorted(node.user_names)] for node in state.nodes],
+        jobs=[_to_row(job) for job in state.jobs.values()],
+        gpus=gpus,
+        processes=processes,
+    )
+    return _MAGIC + zlib.compress(json.dumps(entry, separators=(",", ":")).encode())
+
+
+def _decode_lab_usage(entry: Dict[str, Any], **kwargs) -> LabUsage:
+    _check(entry["expires_at"], str)
+    _check(entry["usage"], list)
+    without_overcap, with_overcap = entry["usage"]
+    return LabUsage(
+        usage={
+            overcap: tuple(_decode_usage(usage) for usage in usages)
+            for overcap, usages in ((False, without_overcap), (True, with_overcap))
+        },
+        expires_at=_decode_time(entry["expires_at"]),
+        **kwargs
+    )
+
+
+def _decode_cluster_state(entry: Dict[str, Any], **kwargs) -> ClusterState:
+    from_gpu_status = entry["source"] == GPU_STATUS
+    for row in entry["nodes"]:
+        _check_all(row[-1], str)
+
+    jobs = [_from_row(JobRecord, row) for row in entry["jobs"]]
+    if from_gpu_status:
+        # As in ClusterState._fetch_gpu_status
+        id2job = {job.job_id: job for job in jobs}
+        gpus = []
+        for row in entry["gpus"]:
+            gpu = _from_row(GPURecord, row[:-3])
+            in_use, valid_use, error = row[-3:]
+            _check(in_use, bool)
+            _check(valid_use, bool)
+            if error not in gpu_status.GPU_ERRORS:
+                raise ValueError("Unknown GPU error {!r}".format(error))
+            gpu.slurm_job = id2job.get(gpu.slurm_job_id)
+            gpu.status = gpu_result(gpu.slurm_job, in_use, valid_use, error)
+            gpus.append(gpu)
+
+        processes = []
+        for row in entry["processes"]:
+            proc = _from_row(ProcessRecord, row[:-1])
+            if row[-1] not in gpu_status.PROCESS_ERRORS:
+                raise ValueError("Unknown process error {!r}".format(row[-1]))
+            proc.status = process_result(row[-1], proc.slurm_job_id)
+            processes.append(proc)
+    else:
+        gpus = [_from_row(GPURecord, row) for row in entry["gpus"]]
+        processes = [_from_row(ProcessRecord, row) for row in entry["processes"]]
+
+    return ClusterState(
+        nodes=[
+            _from_row(NodeRecord, row[:-1], user_names=set(row[-1]))
+            for row in entry["nodes"]
+        ],
+        jobs=jobs,
+        gpus=gpus,
+        processes=processes,
+        from_gpu_status=from_gpu_status,
+        **kwargs
+    )
+
+
+def decode_state(data: bytes) -> Optional[Dict[str, Any]]:
+    r"""The state and when it was fetched, None if data isn't a well formed
+    cache entry.
+    """
+    if not data.startswith(_MAGIC):
+        return None
+
+    try:
+        entry = json.loads(zlib.decompress(data[len(_MAGIC) :]).decode())
+        _check(entry, dict)
+        if type(entry["fetched_at"]) not in (int, float):
+            raise ValueError("fetched_at isn't a time")
+        if entry["source"] not in SOURCES:
+            raise ValueError("Unknown source {!r}".format(entry["source"]))
+        _check(entry["user2lab"], dict)
+        for lab_name in entry["user2lab"].values():
+            _check(lab_name, str)
+        _check_all(entry["lab_names"], str)
+        _check(entry["marker"][0], int)
+        _check(entry["marker"][1], str)
+
+        decode = (
+            _decode_lab_usage if entry["source"] == LAB_USAGE else _decode_cluster_state
+        )
+        state = decode(
+            entry,
+            user2lab=entry["user2lab"],
+            lab_names=entry["lab_names"],
+            marker=(entry["marker"][0], _decode_time(entry["marker"][1])),
+        )
+    except (zlib.error, ValueError, KeyError, TypeError, IndexError):
+        return None
+
+    return dict(state=state, fetched_at=entry["fetched_at"])
+
+
+def cache_path(directory: str, source: str = TABLES) -> str:
+    r"""One file per host, database and what the state is read from"""
+    database = hashlib.sha1(str(get_engine().url).encode()).hexdigest()[:12]
+    return osp.join(
+        directory,
+        "{}-{}-{}.cache".format(
+            socket.gethostname(),
+            database,
+            source,
+        ),
+    )
+
+
+def _loader(source: str, with_users: bool = True) -> Callable:
+    if source == LAB_USAGE:
+        return LabUsage.load
+
+    if source == GPU_STATUS:
+        return functools.partial(ClusterState.load_gpu_status, with_users=with_users)
+
+    return ClusterState.load
+
+
+def _open_fd(path: str) -> Tuple[int, bool]:
+    # Never through a symlink someone planted, truncate would follow it
+    try:
+        # Without O_CREAT, which protected_regular forbids on files of other
+        # users in sticky directories
+        return os.open(path, os.O_RDWR | os.O_NOFOLLOW), True
+    except FileNotFoundError:
+        pass
+    except PermissionError:
+        return os.open(path, os.O_RDONLY | os.O_NOFOLLOW), False
+
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o660)
+        # Past the umask, so that the group of the directory shares it
+        os.fchmod(fd, 0o660)
+    except FileExistsError:
+        fd = os.open(path, os.O_RDWR | os.O_NOFOLLOW)
+
+    return fd, True
+
+
+def _open(path: str):
+    r"""Opens, or creates, the cache for reading and writing if we may, and
+    only for reading otherwise.  Returns the file and whether it is writable.
+
+    Raises OSError unless the cache is a regular file that only those who
+    may write its directory may write, and the directory isn't writable by
+    others.  Everyone sharing it is trusted to write it, and decode_state
+    still checks whatever they wrote.
+    """
+    if os.stat(osp.dirname(path) or ".").st_mode & stat.S_IWOTH:
+        raise PermissionError("Not using {}, anyone may write there".format(path))
+
+    fd, writable = _open_fd(path)
+    try:
+        info = os.fstat(fd)
+        if not stat.S_ISREG(info.st_mode) or info.st_mode & stat.S_IWOTH:
+            raise PermissionError("Not using {}, anyone may write it".format(path))
+    except OSError:
+        os.close(fd)
+        raise
+
+    return open(fd, "r+b" if writable else "rb"), writable
+
+
+@attr.s(auto_attribs=True)
+class StateCache:
+    r"""The state of the cluster shared through a file by all invocations on
+    a host, of any user.
+
+    An entry is used as is for ttl seconds.  After that, the first invocation
+    to take the lock asks the database whether any node was written since
+    (see ClusterState.refresh), reads only the nodes that were and writes the
+    entry back, while the others wait for it on the lock and then use its
+    entry.
+
+    Holds what ClusterState.load reads if source is TABLES, what
+    ClusterState.load_gpu_status reads, with users, if it is GPU_STATUS and
+    what LabUsage.load reads if it is LAB_USAGE.
+    """
+
+    path: str
+    ttl: float = DEFAULT_CACHE_TTL
+    source: str = TABLES
+
+    @classmethod
+    def from_environ(cls, source: str = TABLES) -> Optional["StateCache"]:
+        directory = os.environ.get(CACHE_DIR_ENV_VAR)
+        if not directory:
+            return None
+
+        return cls(
+            path=cache_path(directory, source),
+            ttl=float(os.environ.get(CACHE_TTL_ENV_VAR, DEFAULT_CACHE_TTL)),
+            source=source,
+        )
+
+    def _is_fresh(self, entry: Optional[Dict[str, Any]]) -> bool:
+        return entry is not None and 0 <= time.time() - entry["fetched_at"] < self.ttl
+
+    def load(self) -> Union[ClusterState, LabUsage]:
+        r"""The cached state, refreshed first if it expired"""
+        load = _loader(self.source)
+        try:
+            f, writable = _open(self.path)
+        except OSError:
+            return _load_from_db(load)
+
+        with f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            entry = decode_state(f.read())
+            if self._is_fresh(entry):
+                return entry["state"]
+
+            if not writable:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                return _load_from_db(load)
+
+            # Not atomic, whoever gets the lock first refreshes the entry
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            entry = decode_state(f.read())
+            if self._is_fresh(entry):
+                return entry["state"]
+
+            fetched_at = time.time()
+            # load_gpu_status reads the tables while gpu_status is empty, such
+            # a state is read again until it isn't
+            if entry is not None and _source_of(entry["state"]) == self.source:
+                state = entry["state"]
+                _load_from_db(state.refresh)
+            else:
+                state = _load_from_db(load)
+
+            try:
+                f.seek(0)
+                f.truncate()
+                f.write(encode_state(state, fetched_at))
+                f.flush()
+            except OSError:
+                # e.g. /dev/shm is full, the next invocation reads it again
+                pass
+
+        return state
+
+
+def _load_from_db(load: Callable):
+    session = SessionMaker()
+    try:
+        return load(session)
+    finally:
+        session.close()
+
+
+def load_cluster_state(
+    from_gpu_status: bool = False, with_users: bool = True
+) -> ClusterState:
+    r"""The state for a single run of a command, read with
+    ClusterState.load_gpu_status if from_gpu_status and ClusterState.load
+    otherwise.  Read through the shared cache if GPU_USE_CACHE_DIR is set,
+    which always has the users.
+    """
+    source = GPU_STATUS if from_gpu_status else TABLES
+    cache = StateCache.from_environ(source)
+    if cache is not None:
+        return cache.load()
+
+    return _load_from_db(_loader(source, with_users))
+
+
+def load_lab_usage() -> LabUsage:
+    r"""What `gpu-use lab` shows for a single run, read through the shared
+    cache if GPU_USE_CACHE_DIR is set.
+    """
+    cache = StateCache.from_environ(LAB_USAGE)
+    if cache is not None:
+        return cache.load()
+
+    return _load_from_db(LabUsage.load)
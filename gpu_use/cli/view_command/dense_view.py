@@ -1,22 +1,24 @@
-from typing import List, Set
+from typing import List, Optional, Set
 
 import click
 
-from gpu_use.cli.utils import (
-    gray_if_out_of_date,
-    is_user_on_gpu,
-    parse_gpu,
-    parse_process,
-)
+from gpu_use.cli.cluster_state import NodeRecord, is_user_on_gpu
+from gpu_use.cli.utils import gray_if_stale
 from gpu_use.cli.view_command.regular_view import NODE_NAME_WITH_TIME
-from gpu_use.db.schema import Node, User
 
 
-def show_dense(nodes: List[Node], users: List[User], display_time, display_load):
+def show_dense(
+    nodes: List[NodeRecord],
+    user_names: Optional[Set[str]],
+    display_time,
+    display_load,
+):
     longest_name_length = max(len(node.name) for node in nodes)
-    max_gpus = max(
-        len([gpu for gpu in node.gpus if is_user_on_gpu(gpu, users)]) for node in nodes
-    )
+    node2gpus = {
+        node.name: [gpu for gpu in node.gpus if is_user_on_gpu(gpu, user_names)]
+        for node in nodes
+    }
+    max_gpus = max(len(gpus) for gpus in node2gpus.values())
 
     for node in nodes:
         gpu_tot = 0
@@ -33,13 +35,10 @@ def show_dense(nodes: List[Node], users: List[User], display_time, display_load)
         name_str = click.style(name_str, fg="bright_white")
 
         gpus_str = ""
-        for gpu in node.gpus:
-            if not is_user_on_gpu(gpu, users):
-                continue
-
+        for gpu in node2gpus[node.name]:
             gpu_tot = gpu_tot + 1
 
-            res = parse_gpu(gpu)
+            res = gpu.status
 
             if res.reserved:
                 gpu_res += 1
@@ -47,12 +46,12 @@ def show_dense(nodes: List[Node], users: List[User], display_time, display_load)
             if res.in_use:
                 gpu_used += 1
 
-            gpus_str += gray_if_out_of_date(
+            gpus_str += gray_if_stale(
                 click.style(
                     "\t{}{}[{}]".format(res.res_char, res.use_char, gpu.id),
                     fg=res.color,
                 ),
-                gpu.update_time,
+                gpu.stale,
             )
 
         for _ in range(max_gpus - gpu_tot):
@@ -65,5 +64,5 @@ def show_dense(nodes: List[Node], users: List[User], display_time, display_load)
                 name_str, node.update_time.strftime("%Y-%m-%d %H:%M:%S")
             )
 
-        name_str = gray_if_out_of_date(name_str, node.update_time)
+        name_str = gray_if_stale(name_str, node.stale)
         click.echo(name_str, color=True)
@@ -1,21 +1,22 @@
-from typing import List, Set
+from typing import List, Optional, Set
 
 import click
 
-from gpu_use.cli.utils import (
-    gray_if_out_of_date,
-    is_user_on_gpu,
-    parse_gpu,
-    parse_process,
-)
-from gpu_use.db.schema import Node, User
+from gpu_use.cli.cluster_state import NodeRecord, is_user_on_gpu
+from gpu_use.cli.utils import gray_if_stale
 
 
-def show_errors(nodes: List[Node], users: List[User]):
-    valid_nodes_name_lengths = [
-        len(node.name)
+def show_errors(nodes: List[NodeRecord], user_names: Optional[Set[str]]):
+    node2errors = {
+        node.name: [
+            gpu
+            for gpu in node.gpus
+            if gpu.status.error and is_user_on_gpu(gpu, user_names)
+        ]
         for node in nodes
-        if any(is_user_on_gpu(gpu, users) and parse_gpu(gpu).error for gpu in node.gpus)
+    }
+    valid_nodes_name_lengths = [
+        len(node.name) for node in nodes if len(node2errors[node.name]) > 0
     ]
 
     if len(valid_nodes_name_lengths) == 0:
@@ -25,51 +26,43 @@ def show_errors(nodes: List[Node], users: List[User]):
     longest_name_length = max(valid_nodes_name_lengths)
 
     for node in nodes:
-        for gpu in node.gpus:
-            if not is_user_on_gpu(gpu, users):
-                continue
+        for gpu in node2errors[node.name]:
+            res = gpu.status
 
-            res = parse_gpu(gpu)
+            gpu_record = gray_if_stale(
+                "{}{}[{}]".format(res.res_char, res.use_char, gpu.id), gpu.stale
+            )
+            click.echo(
+                gray_if_stale(
+                    click.style(
+                        "{:{width}} {} {} {}".format(
+                            node.name,
+                            gpu_record,
+                            res.res_record,
+                            res.err_msg,
+                            width=longest_name_length,
+                        ),
+                        fg=res.color,
+                    ),
+                    node.stale,
+                ),
+                color=True,
+            )
+
+            for proc in gpu.processes:
+                proc_res = proc.status
 
-            if res.error:
-                gpu_record = gray_if_out_of_date(
-                    "{}{}[{}]".format(res.res_char, res.use_char, gpu.id),
-                    gpu.update_time,
-                )
                 click.echo(
-                    gray_if_out_of_date(
+                    gray_if_stale(
                         click.style(
-                            "{:{width}} {} {} {}".format(
-                                node.name,
-                                gpu_record,
-                                res.res_record,
-                                res.err_msg,
-                                width=longest_name_length,
+                            (" " * longest_name_length)
+                            + "       "
+                            + "{} {} {} {}".format(
+                                proc.id, proc.command, proc.user_name, proc_res.err_msg
                             ),
-                            fg=res.color,
+                            fg=proc_res.color,
                         ),
-                        node.update_time,
+                        node.stale,
                     ),
                     color=True,
                 )
-
-                for proc in gpu.processes:
-                    proc_res = parse_process(gpu, proc)
-
-                    click.echo(
-                        gray_if_out_of_date(
-                            click.style(
-                                (" " * longest_name_length)
-                                + "       "
-                                + "{} {} {} {}".format(
-                                    proc.id,
-                                    proc.command,
-                                    proc.user_name,
-                                    proc_res.err_msg,
-                                ),
-                                fg=proc_res.color,
-                            ),
-                            node.update_time,
-                        ),
-                        color=True,
-                    )
@@ -1,20 +1,19 @@
-from typing import List, Set
+from typing import List, Optional, Set
 
 import click
 
-from gpu_use.cli.utils import (
-    gray_if_out_of_date,
-    is_user_on_gpu,
-    parse_gpu,
-    parse_process,
-)
-from gpu_use.db.schema import Node, User
+from gpu_use.cli.cluster_state import NodeRecord, is_user_on_gpu
+from gpu_use.cli.utils import gray_if_stale
 
 NODE_NAME_WITH_TIME = "{}\t\tUpdated: {}"
 
 
-def show_regular(nodes: List[Node], users: List[User], display_time, display_load):
-    longest_name_length = max(len(node.name) for node in nodes)
+def show_regular(
+    nodes: List[NodeRecord],
+    user_names: Optional[Set[str]],
+    display_time,
+    display_load,
+):
     for node in nodes:
         name_str = click.style(node.name, bold=True)
         if display_load:
@@ -25,34 +24,34 @@ def show_regular(nodes: List[Node], users: List[User], display_time, display_loa
             )
 
         click.echo(
-            gray_if_out_of_date(
+            gray_if_stale(
                 click.style(
                     "-------------------------------------------------------------------\n"
                     + name_str
                     + "\n-------------------------------------------------------------------",
                     fg="bright_white",
                 ),
-                node.update_time,
+                node.stale,
             ),
             color=True,
         )
 
         for gpu in node.gpus:
-            if not is_user_on_gpu(gpu, users):
+            if not is_user_on_gpu(gpu, user_names):
                 continue
 
-            res = parse_gpu(gpu)
+            res = gpu.status
 
-            gpu_record = gray_if_out_of_date(
-                "{}{}[{}]".format(res.res_char, res.use_char, gpu.id), gpu.update_time
+            gpu_record = gray_if_stale(
+                "{}{}[{}]".format(res.res_char, res.use_char, gpu.id), gpu.stale
             )
             click.echo(
-                gray_if_out_of_date(
+                gray_if_stale(
                     click.style(
                         "{} {} {}".format(gpu_record, res.res_record, res.err_msg),
                         fg=res.color,
                     ),
-                    node.update_time,
+                    node.stale,
                 ),
                 nl=False,
                 color=True,
@@ -60,10 +59,10 @@ def show_regular(nodes: List[Node], users: List[User], display_time, display_loa
 
             if res.error:
                 for proc in gpu.processes:
-                    proc_res = parse_process(gpu, proc)
+                    proc_res = proc.status
                     if proc_res.error:
                         click.echo(
-                            gray_if_out_of_date(
+                            gray_if_stale(
                                 click.style(
                                     "       "
                                     + "{} {} {} {}".format(
@@ -74,7 +73,7 @@ def show_regular(nodes: List[Node], users: List[User], display_time, display_loa
                                     ),
                                     fg=proc_res.color,
                                 ),
-                                node.update_time,
+                                node.stale,
                             ),
                             nl=False,
                             color=True,
@@ -1,17 +1,15 @@
-import datetime
-import os
+import functools
 import re
-from typing import List, Set
 
 import click
-import sqlalchemy as sa
 
+from gpu_use.cli.cluster_state import ClusterState
+from gpu_use.cli.state_cache import load_cluster_state
 from gpu_use.cli.utils import filter_labs, supports_unicode
 from gpu_use.cli.view_command.dense_view import show_dense
 from gpu_use.cli.view_command.errors_view import show_errors
 from gpu_use.cli.view_command.regular_view import show_regular
-from gpu_use.db.schema import GPU, GPUProcess, Lab, Node, SLURMJob, User
-from gpu_use.db.session import SessionMaker
+from gpu_use.cli.watch import watch_cluster, watch_options
 
 
 @click.command(name="view")
@@ -72,8 +70,9 @@ from gpu_use.db.session import SessionMaker
     default=False,
     is_flag=True,
 )
+@watch_options
 def gpu_use_view_command(
-    node, user, lab, dense, only_errors, display_time, display_load
+    node, user, lab, dense, only_errors, display_time, display_load, watch, interval
 ):
     r"""Display real-time information about the GPUs on skynet
 
@@ -85,8 +84,8 @@ and pink/magenta means idle reservation but in the debug partition.
 
 Notes:
 
-    - When using gpu-use with `watch`, add `--color` for the output to be displayed
-correctly, i.e. use `watch --color gpu-use -d`.
+    - To keep the output up to date, use `gpu-use -d --watch` rather than
+`watch gpu-use -d`, it is much lighter on the database.
     """
     if dense and only_errors:
         dense = False
@@ -94,72 +93,73 @@ correctly, i.e. use `watch --color gpu-use -d`.
     node_re = re.compile(node) if node is not None else None
     user_re = re.compile(user) if user is not None else None
 
-    session = SessionMaker()
-
-    nodes = session.query(Node)
-    users = None
-    if node_re is not None:
-        node_names = [
-            name[0]
-            for name in session.query(Node.name).all()
-            if node_re.match(name[0]) is not None
-        ]
-        if len(node_names) == 0:
-            raise click.BadArgumentUsage("No nodes matched {}".format(node))
-
-        node_filter = Node.name.in_(node_names)
-        nodes = nodes.filter(Node.name.in_(node_names))
-
-    if lab is not None:
-        labs = filter_labs(session, lab)
-
-        user_names = list(set(user.name for lab in labs for user in lab.users))
-        users = session.query(User).filter(User.name.in_(user_names))
-        nodes = nodes.filter(Node.users.any(User.name.in_(user_names)))
-
-    if user_re is not None:
-        user_names = [
-            name[0]
-            for name in session.query(User.name).all()
-            if user_re.match(name[0]) is not None
-        ]
-
-        if len(user_names) == 0:
-            raise click.BadArgumentUsage("No users matched {}".format(user))
-
-        users = (session.query(User) if users is None else users).filter(
-            User.name.in_(user_names)
+    def _render(state: ClusterState):
+        nodes = state.nodes
+        user_names = None
+        if node_re is not None:
+            nodes = [node for node in nodes if node_re.match(node.name) is not None]
+            if len(nodes) == 0:
+                raise click.BadArgumentUsage("No nodes matched {}".format(node))
+
+        if lab is not None:
+            labs = filter_labs(state.lab_names, lab)
+
+            user_names = set(
+                user_name
+                for lab_name in labs
+                for user_name in state.users_by_lab[lab_name]
+            )
+            nodes = [
+                node for node in nodes if not node.user_names.isdisjoint(user_names)
+            ]
+
+        if user_re is not None:
+            matched_user_names = set(
+                user_name
+                for user_name in state.user2lab.keys()
+                if user_re.match(user_name) is not None
+            )
+
+            if len(matched_user_names) == 0:
+                raise click.BadArgumentUsage("No users matched {}".format(user))
+
+            user_names = (
+                matched_user_names
+                if user_names is None
+                else user_names & matched_user_names
+            )
+            nodes = [
+                node
+                for node in nodes
+                if not node.user_names.isdisjoint(matched_user_names)
+            ]
+
+        if not supports_unicode():
+            click.echo(
+                "Terminal does not support unicode, do `export LANG=en_US.UTF-8` for a better experience (may also need to start tmux with `-u`)"
+            )
+
+        nodes = sorted(nodes, key=lambda n: len(n.gpus))
+
+        use_dense = dense
+        if not only_errors and use_dense is None:
+            if len(nodes) > 4:
+                use_dense = True
+
+        if only_errors:
+            show_errors(nodes, user_names)
+        elif use_dense:
+            show_dense(nodes, user_names, display_time, display_load)
+        else:
+            show_regular(nodes, user_names, display_time, display_load)
+
+    # Users and labs are only needed to filter by them
+    with_users = lab is not None or user is not None
+    if watch:
+        watch_cluster(
+            _render,
+            interval,
+            functools.partial(ClusterState.load_gpu_status, with_users=with_users),
         )
-        nodes = nodes.filter(Node.users.any(User.name.in_(user_names)))
-
-    nodes = (
-        nodes.order_by(Node.name)
-        .options(
-            sa.orm.joinedload(Node.gpus),
-            sa.orm.joinedload(Node.slurm_jobs),
-            sa.orm.joinedload(Node.gpus).joinedload("processes"),
-            sa.orm.joinedload(Node.slurm_jobs).joinedload("processes"),
-        )
-        .all()
-    )
-
-    if users is not None:
-        users = users.all()
-
-    if not supports_unicode():
-        click.echo(
-            "Terminal does not support unicode, do `export LANG=en_US.UTF-8` for a better experience (may also need to start tmux with `-u`)"
-        )
-
-    nodes = sorted(nodes, key=lambda n: len(n.gpus))
-
-    if not only_errors and dense is None:
-        if len(nodes) > 4:
-            dense = True
-
-    if only_errors:
-        show_errors(nodes, users)
-    elif dense:
-        show_dense(nodes, users, display_time, display_load)
     else:
-        show_regular(nodes, users, display_time, display_load)
+        _render(load_cluster_state(from_gpu_status=True, with_users=with_users))
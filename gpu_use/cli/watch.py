@@ -0,0 +1,90 @@
+import contextlib
+import io
+import time
+from typing import Callable
+
+import click
+
+from gpu_use.cli.cluster_state import ClusterState
+from gpu_use.db.engine import get_engine
+
+DEFAULT_WATCH_INTERVAL = 2.0
+
+# Move the cursor to the top left and clear the screen
+_REDRAW = "\x1b[H\x1b[2J"
+
+
+def watch_options(f):
+    r"""Adds --watch and --interval to a command"""
+    f = click.option(
+        "-i",
+        "--interval",
+        type=float,
+        default=DEFAULT_WATCH_INTERVAL,
+        show_default=True,
+        help="Seconds between refreshes with --watch",
+    )(f)
+    f = click.option(
+        "-w",
+        "--watch",
+        "watch",
+        help="Keep refreshing the output until interrupted."
+        "  Only nodes that were updated are read again.",
+        default=False,
+        is_flag=True,
+    )(f)
+    return f
+
+
+def _render_frame(render: Callable[[ClusterState], None], state: ClusterState) -> str:
+    frame = io.StringIO()
+    ctx = click.get_current_context(silent=True)
+    color = ctx.color if ctx is not None else None
+    if ctx is not None and color is None:
+        # Whether to keep colors is decided when the frame is echoed
+        ctx.color = True
+
+    try:
+        with contextlib.redirect_stdout(frame):
+            render(state)
+    finally:
+        if ctx is not None:
+            ctx.color = color
+
+    return frame.getvalue()
+
+
+def watch_cluster(
+    render: Callable[[ClusterState], None],
+    interval: float,
+    load: Callable[..., ClusterState] = ClusterState.load,
+):
+    r"""Calls render with the state of the cluster, read by load, every
+    interval seconds and redraws the screen with what it prints.
+
+    Unlike `watch gpu-use`, this keeps one connection open, and asks the
+    database whether any node was written since the last refresh before
+    reading the nodes that were.  So an idle watcher costs one single row
+    query per refresh.
+    """
+    connection = get_engine().connect()
+    try:
+        # Every refresh is its own transaction, or it would keep seeing the
+        # snapshot of the first one
+        with connection.begin():
+            state = load(connection)
+
+        last_frame = None
+        while True:
+            frame = _render_frame(render, state)
+            if frame != last_frame:
+                click.echo(_REDRAW + frame, nl=False)
+                last_frame = frame
+
+            time.sleep(interval)
+            with connection.begin():
+                state.refresh(connection)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connection.close()
@@ -1,25 +1,150 @@
 import json
+import os
+from typing import Any, Dict, Optional
 
+import sqlalchemy as sa
 from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
 
+SECRETS_PATH = os.environ.get(
+    "GPU_USE_CONFIG", "/usr/local/gpu-use/gpu-use-engine-secrets.json"
+)
 
-def make_engine():
-    with open("/usr/local/gpu-use/gpu-use-engine-secrets.json", "rt") as f:
-        engine_secrets = json.load(f)
+# The daemon runs for weeks and opens a session about once a minute, so it
+# keeps a single connection around and checks it before use.  The CLI runs
+# one burst of queries and exits, so pooling would only cost a connection
+# that is never reused.  Options under "engine_profiles" in the secrets file
+# are merged over these, e.g. {"daemon": {"pool_recycle": 600}}.
+ENGINE_PROFILES = {
+    "daemon": dict(
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=30,
+        pool_pre_ping=True,
+        pool_recycle=60 * 60,
+        connect_timeout=10,
+    ),
+    "cli": dict(poolclass=NullPool, connect_timeout=10),
+}
+DEFAULT_PROFILE = "cli"
 
-    engine = create_engine(
-        "mysql://{}:{}@{}/gpu_use_db".format(
-            engine_secrets["user"],
-            engine_secrets["password"],
-            engine_secrets["hostname"],
-        ),
-        echo=False,
-        pool_size=15,
-        max_overflow=30,
+# SQLAlchemy picks the pool for SQLite itself, one that suits files or
+# in-memory databases
+_SQLITE_IGNORED_OPTIONS = ("poolclass", "pool_size", "max_overflow", "pool_timeout")
+
+
+def load_secrets() -> Dict[str, Any]:
+    r"""The config file, with the database URL overridden by GPU_USE_DB_URL.
+
+    The database is either given as "url", any SQLAlchemy URL, or by "user",
+    "password", "hostname" and optionally "database" of a MySQL server.
+    """
+    url = os.environ.get("GPU_USE_DB_URL")
+    try:
+        with open(SECRETS_PATH, "rt") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        if url is None:
+            raise
+        config = {}
+
+    if url is not None:
+        config["url"] = url
+
+    return config
+
+
+def database_url(config: Dict[str, Any]) -> str:
+    if "url" in config:
+        return config["url"]
+
+    return "mysql://{}:{}@{}/{}".format(
+        config["user"],
+        config["password"],
+        config["hostname"],
+        config.get("database", "gpu_use_db"),
     )
-    #  engine = create_engine("sqlite:///:memory:", echo=False)
+
+
+def _make_sqlite_begin(begin: str):
+    def _connect(dbapi_connection, connection_record):
+        # Let SQLAlchemy emit BEGIN instead of pysqlite, see _begin
+        dbapi_connection.isolation_level = None
+
+        cursor = dbapi_connection.cursor()
+        # Readers don't block the writer and the writer doesn't block readers
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # Like InnoDB
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    def _begin(conn):
+        conn.execute(begin)
+
+    return _connect, _begin
+
+
+def make_engine(
+    profile: str = DEFAULT_PROFILE, config: Optional[Dict[str, Any]] = None
+):
+    if config is None:
+        config = load_secrets()
+
+    url = sa.engine.url.make_url(database_url(config))
+
+    options = dict(ENGINE_PROFILES[profile])
+    options.update(config.get("engine_profiles", {}).get(profile, {}))
+    connect_timeout = options.pop("connect_timeout", None)
+
+    connect_args = {}
+    if url.get_backend_name() == "sqlite":
+        for name in _SQLITE_IGNORED_OPTIONS:
+            options.pop(name, None)
+        # How long to wait for the database to be unlocked
+        if connect_timeout is not None:
+            connect_args["timeout"] = connect_timeout
+        # Connections are handed between the collector and writer threads
+        connect_args["check_same_thread"] = False
+    elif connect_timeout is not None:
+        connect_args["connect_timeout"] = connect_timeout
+
+    engine = create_engine(url, echo=False, connect_args=connect_args, **options)
+
+    if url.get_backend_name() == "sqlite":
+        # The daemon reads and then writes in the same transaction.  Taking
+        # the write lock up front makes concurrent writers wait on each other
+        # instead of failing when upgrading a read lock.
+        connect, begin = _make_sqlite_begin(
+            "BEGIN IMMEDIATE" if profile == "daemon" else "BEGIN"
+        )
+        sa.event.listen(engine, "connect", connect)
+        sa.event.listen(engine, "begin", begin)
 
     return engine
 
 
-engine = make_engine()
+_engine = None
+_profile = os.environ.get("GPU_USE_ENGINE_PROFILE", DEFAULT_PROFILE)
+
+
+def set_profile(profile: str):
+    r"""Picks the engine profile, has to be called before get_engine"""
+    global _profile
+    if _engine is not None and profile != _profile:
+        raise RuntimeError(
+            "The engine was already created with the {} profile".format(_profile)
+        )
+
+    _profile = profile
+
+
+def get_engine():
+    r"""The engine of this process, created on first use so that importing
+    gpu_use doesn't read the secrets file or connect to anything.
+    """
+    global _engine
+    if _engine is None:
+        _engine = make_engine(_profile)
+
+    return _engine
@@ -0,0 +1,55 @@
+from typing import Iterable, Optional, Tuple
+
+# What is wrong with a GPU, as stored in gpu_status.error
+NO_ERROR = ""
+INVALID_USE = "invalid_use"
+IDLE = "idle"
+IDLE_DEBUG = "idle_debug"
+NO_RESERVATION = "no_reservation"
+GPU_ERRORS = (NO_ERROR, INVALID_USE, IDLE, IDLE_DEBUG, NO_RESERVATION)
+
+# What is wrong with a process on a GPU
+WRONG_JOB = "wrong_job"
+NO_JOB = "no_job"
+PROCESS_ERRORS = (NO_ERROR, WRONG_JOB, NO_JOB)
+
+
+def is_valid_use(
+    job_id: Optional[int],
+    job_user_name: Optional[str],
+    processes: Iterable[Tuple[Optional[int], Optional[str]]],
+) -> bool:
+    r"""Whether every process, given as (job id, user name), is in the GPU's
+    job, or every process belongs to the user of the GPU's job.
+    """
+    processes = list(processes)
+    return all(
+        (proc_job_id is not None and proc_job_id == job_id)
+        for proc_job_id, _ in processes
+    ) or all(
+        (job_id is not None and user_name == job_user_name)
+        for _, user_name in processes
+    )
+
+
+def gpu_error(reserved: bool, in_use: bool, valid_use: bool, is_debug_job) -> str:
+    if reserved and in_use and not valid_use:
+        return INVALID_USE
+
+    if reserved and not in_use:
+        return IDLE_DEBUG if is_debug_job else IDLE
+
+    if in_use and not reserved:
+        return NO_RESERVATION
+
+    return NO_ERROR
+
+
+def process_error(job_id: Optional[int], gpu_job_id: Optional[int]) -> str:
+    if job_id is None:
+        return NO_JOB
+
+    if job_id != gpu_job_id:
+        return WRONG_JOB
+
+    return NO_ERROR
@@ -1,7 +1,7 @@
 import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declarative_base
 
-from gpu_use.db.engine import engine
+from gpu_use.db.engine import get_engine
 
 Base = declarative_base()
 
@@ -134,6 +134,63 @@ class GPUProcess(Base):
         )
 
 
+class MonitorCycle(Base):
+    r"""Timing breakdown of one monitor cycle, the last few are kept per node"""
+
+    __tablename__ = "monitor_cycles"
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    node_name = sa.Column(sa.String(32), index=True)
+    start_time = sa.Column(sa.DateTime())
+    duration = sa.Column(sa.Float)
+    # JSON encoded {phase: seconds}
+    phase_times = sa.Column(sa.Text)
+    num_subprocesses = sa.Column(sa.Integer)
+    num_statements = sa.Column(sa.Integer)
+    failed_phase = sa.Column(sa.String(32))
+
+    def __repr__(self):
+        return "<MonitorCycle(node={}, start_time={}, duration={})>".format(
+            self.node_name, self.start_time, self.duration
+        )
+
+
+class GPUStatus(Base):
+    r"""Everything `gpu-use view` shows about a GPU, derived by the monitor
+    whenever it writes the node, so the CLI reads one table instead of
+    joining nodes, GPUs, jobs and processes.
+    """
+
+    __tablename__ = "gpu_status"
+
+    node_name = sa.Column(sa.String(32), primary_key=True)
+    gpu_id = sa.Column(sa.Integer, primary_key=True)
+    node_load = sa.Column(sa.String(64))
+    node_update_time = sa.Column(sa.DateTime(), index=True)
+    # JSON encoded list of the users linked to the node
+    node_user_names = sa.Column(sa.Text)
+
+    # The reservation, its owner and their lab
+    slurm_job_id = sa.Column(sa.Integer)
+    user_name = sa.Column(sa.String(32))
+    lab_name = sa.Column(sa.String(32))
+    is_debug_job = sa.Column(sa.Boolean)
+
+    in_use = sa.Column(sa.Boolean)
+    valid_use = sa.Column(sa.Boolean)
+    # See gpu_use.db.gpu_status
+    error = sa.Column(sa.String(32))
+    # JSON encoded list of [pid, command, user_name, slurm_job_id, error]
+    processes = sa.Column(sa.Text)
+
+    update_time = sa.Column(sa.DateTime())
+
+    def __repr__(self):
+        return "<GPUStatus(node={}, gpu_id={}, error={})>".format(
+            self.node_name, self.gpu_id, self.error
+        )
+
+
 Lab.users = sa.orm.relationship(
     "User", order_by=User.name, back_populates="lab", lazy="select"
 )
@@ -182,4 +239,8 @@ GPU.processes = sa.orm.relationship(
 )
 
 
-Base.metadata.create_all(engine)
+def create_schema(engine=None):
+    r"""Creates the tables that don't exist yet.  Existing tables are left
+    as they are, so this is safe to run on every upgrade.
+    """
+    Base.metadata.create_all(engine if engine is not None else get_engine())
@@ -1,5 +1,10 @@
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 
-from gpu_use.db.engine import engine
+from gpu_use.db.engine import get_engine
 
-SessionMaker = sessionmaker(bind=engine)
+_sessionmaker = sessionmaker()
+
+
+def SessionMaker(**kwargs) -> Session:
+    r"""Makes a session bound to the engine, which is created on first use"""
+    return _sessionmaker(bind=get_engine(), **kwargs)
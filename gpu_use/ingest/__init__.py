@@ -0,0 +1 @@
+from gpu_use.ingest.client import push_states
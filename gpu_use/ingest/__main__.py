@@ -0,0 +1,4 @@
+from gpu_use.ingest.server import main
+
+if __name__ == "__main__":
+    main()
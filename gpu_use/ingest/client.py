@@ -0,0 +1,95 @@
+import gzip
+import http.client
+import json
+import socket
+import urllib.parse
+from typing import List, Optional
+
+import attr
+
+from gpu_use.monitor.cycle_stats import CycleStats
+from gpu_use.monitor.node_state import NodeState
+
+SNAPSHOTS_PATH = "/snapshots"
+# The shared secret pushes over TCP are authenticated with, under this key in
+# the config file
+TOKEN_CONFIG_KEY = "ingest_token"
+
+
+def load_token() -> Optional[str]:
+    from gpu_use.db.engine import load_secrets
+
+    try:
+        return load_secrets().get(TOKEN_CONFIG_KEY)
+    except FileNotFoundError:
+        return None
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _connect(url: str, timeout: float) -> http.client.HTTPConnection:
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "unix":
+        return _UnixHTTPConnection(parsed.path, timeout)
+    elif parsed.scheme == "http":
+        return http.client.HTTPConnection(parsed.netloc, timeout=timeout)
+    else:
+        raise ValueError("Unsupported ingest url {}".format(url))
+
+
+def encode_snapshots(states: List[NodeState], cycles: List[CycleStats] = ()) -> bytes:
+    return gzip.compress(
+        json.dumps(
+            dict(
+                states=[state.to_dict() for state in states],
+                cycles=[attr.asdict(stats) for stats in cycles],
+            ),
+            separators=(",", ":"),
+        ).encode("utf-8")
+    )
+
+
+def push_states(
+    url: str,
+    states: List[NodeState],
+    cycles: List[CycleStats] = (),
+    timeout: float = 10.0,
+    token: Optional[str] = None,
+):
+    r"""Sends snapshots, and the stats of failed cycles, to an ingest server.
+
+    url is either http://host:port or unix:///path/to/socket.  Over TCP the
+    server only accepts them with its token.  Raises OSError if the server
+    couldn't be reached or didn't accept them.
+    """
+    headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+    if token is not None:
+        headers["Authorization"] = "Bearer {}".format(token)
+
+    conn = _connect(url, timeout)
+    try:
+        conn.request(
+            "POST",
+            SNAPSHOTS_PATH,
+            body=encode_snapshots(states, cycles),
+            headers=headers,
+        )
+        response = conn.getresponse()
+        response.read()
+        if response.status >= 300:
+            raise OSError(
+                "Ingest server replied {} {}".format(response.status, response.reason)
+            )
+    except http.client.HTTPException as e:
+        raise OSError(str(e))
+    finally:
+        conn.close()
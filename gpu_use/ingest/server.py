@@ -0,0 +1,404 @@
+import gzip
+import hmac
+import http.server
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import click
+import sqlalchemy as sa
+
+from gpu_use.db.engine import load_secrets, set_profile
+from gpu_use.db.schema import Node
+from gpu_use.ingest.client import SNAPSHOTS_PATH, TOKEN_CONFIG_KEY
+from gpu_use.monitor.bulk_writer import (
+    delete_orphans,
+    write_cycle_stats,
+    write_node_state_bulk,
+)
+from gpu_use.monitor.cycle_stats import CycleStats
+from gpu_use.monitor.monitor import ORPHAN_SWEEP_INTERVAL, write_heartbeat
+from gpu_use.monitor.node_state import NodeState
+
+DEFAULT_PORT = 9743
+# Only reachable from other nodes when asked for with --host
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_SOCKET_PATH = "/run/gpu-use/ingest.sock"
+# Nodes that may push before they are in the database, under this key in
+# the config file
+NODES_CONFIG_KEY = "ingest_nodes"
+# How often to look for new nodes in the database when an unknown one pushes
+KNOWN_NODES_REFRESH_INTERVAL = 60.0
+# Pushes that arrive within this many seconds are written in one transaction
+DEFAULT_BATCH_INTERVAL = 1.0
+
+logger = logging.getLogger("gpu-used")
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != SNAPSHOTS_PATH:
+            self.send_error(404)
+            return
+
+        # The Unix socket is protected by its permissions
+        if isinstance(self.server, _TCPServer):
+            authorization = self.headers.get("Authorization")
+            if authorization is None:
+                self.send_error(401, "Missing token")
+                return
+
+            if not self.server.ingest.is_authorized(authorization):
+                self.send_error(403, "Bad token")
+                return
+
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+
+            payload = json.loads(body.decode("utf-8"))
+            states = [NodeState.from_dict(state) for state in payload["states"]]
+            cycles = [CycleStats(**stats) for stats in payload.get("cycles", [])]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.send_error(400, "Bad snapshot: {}".format(e))
+            return
+
+        unknown_nodes = self.server.ingest.unknown_nodes(
+            [state.hostname for state in states] + [stats.node_name for stats in cycles]
+        )
+        if len(unknown_nodes) > 0:
+            self.send_error(403, "Unknown nodes: {}".format(", ".join(unknown_nodes)))
+            return
+
+        self.server.ingest.submit(states, cycles)
+        self.send_response(204)
+        self.end_headers()
+
+    def address_string(self):
+        # Unix sockets don't have a client address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class IngestServer:
+    r"""Accepts snapshots pushed by the daemons and writes them to the
+    database from a single thread.
+
+    Pushes are coalesced per node, only the newest snapshot of each node
+    that arrived in the last batch_interval is written, and every batch is
+    one transaction.  So the database sees one client instead of one per
+    node, and writes to the users and labs tables shared by all nodes never
+    contend with each other.
+
+    If a batch fails, its snapshots are retried one at a time so that one
+    bad snapshot doesn't hold back the rest.  Those that still fail are
+    kept for the next batch unless a newer one comes in.
+
+    Snapshots pushed over TCP are only accepted with token.  Snapshots are
+    only accepted from nodes that are in the database or in nodes, so that
+    nobody can make up the state of a node.
+    """
+
+    def __init__(
+        self,
+        port: Optional[int] = None,
+        host: str = DEFAULT_HOST,
+        socket_path: Optional[str] = None,
+        batch_interval: float = DEFAULT_BATCH_INTERVAL,
+        session_maker=None,
+        token: Optional[str] = None,
+        nodes: Iterable[str] = (),
+    ):
+        if session_maker is None:
+            from gpu_use.db.session import SessionMaker
+
+            session_maker = SessionMaker
+
+        if port is not None and not token:
+            raise ValueError("Accepting snapshots over TCP requires a token")
+
+        self.batch_interval = batch_interval
+        self.session_maker = session_maker
+        self.token = token
+        self.nodes = set(nodes)
+        self._known_nodes: Set[str] = set()
+        self._known_nodes_time = None
+
+        self._servers = []
+        if port is not None:
+            self._servers.append(_TCPServer((host, port), _Handler))
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self._servers.append(_UnixServer(socket_path, _Handler))
+        for server in self._servers:
+            server.ingest = self
+
+        self._lock = threading.Lock()
+        self._pending: Dict[str, NodeState] = {}
+        self._pending_cycles: List[CycleStats] = []
+        # Fingerprint of what is in the database for every node
+        self._fingerprints: Dict[str, str] = {}
+        self._stop = threading.Event()
+        self._threads = []
+        self._next_orphan_sweep = time.time() + ORPHAN_SWEEP_INTERVAL
+
+        self.num_received = 0
+        self.num_batches = 0
+
+    def is_authorized(self, authorization: str) -> bool:
+        return self.token is not None and hmac.compare_digest(
+            authorization.encode("utf-8"),
+            "Bearer {}".format(self.token).encode("utf-8"),
+        )
+
+    def unknown_nodes(self, node_names: List[str]) -> List[str]:
+        r"""The names that are neither in the database nor in nodes.  Reads
+        the nodes from the database at most every KNOWN_NODES_REFRESH_INTERVAL.
+        """
+        with self._lock:
+            unknown = sorted(set(node_names) - self.nodes - self._known_nodes)
+            if len(unknown) == 0 or (
+                self._known_nodes_time is not None
+                and time.time() - self._known_nodes_time < KNOWN_NODES_REFRESH_INTERVAL
+            ):
+                return unknown
+
+            self._known_nodes_time = time.time()
+
+        session = self.session_maker()
+        try:
+            known_nodes = {row.name for row in session.execute(sa.select([Node.name]))}
+        except sa.exc.SQLAlchemyError as e:
+            logger.error("Could not read the known nodes: {}".format(e))
+            return unknown
+        finally:
+            session.close()
+
+        with self._lock:
+            self._known_nodes = known_nodes
+
+        return [name for name in unknown if name not in known_nodes]
+
+    @property
+    def port(self) -> Optional[int]:
+        for server in self._servers:
+            if isinstance(server, _TCPServer):
+                return server.server_port
+
+        return None
+
+    def start(self):
+        for server in self._servers:
+            self._threads.append(
+                threading.Thread(target=server.serve_forever, daemon=True)
+            )
+        self._threads.append(
+            threading.Thread(target=self._run, name="gpu-use-ingest", daemon=True)
+        )
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        r"""Stops accepting snapshots and writes what is still pending"""
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, states: List[NodeState], cycles: List[CycleStats] = ()):
+        with self._lock:
+            for state in states:
+                self._pending[state.hostname] = state
+            self._pending_cycles.extend(cycles)
+            self.num_received += len(states)
+
+    def _run(self):
+        while not self._stop.wait(self.batch_interval):
+            self.flush()
+
+        self.flush()
+
+    def _write(
+        self, session, states: List[NodeState]
+    ) -> List[Tuple[NodeState, str, Dict[str, float], float]]:
+        r"""Writes states without committing, returns what to record once committed"""
+        writes = []
+        for state in states:
+            start_time = time.time()
+            phase_times = {}
+
+            fingerprint = state.fingerprint()
+            if self._fingerprints.get(state.hostname) == fingerprint:
+                write_heartbeat(session, state, commit=False)
+                phase_times["db_write"] = time.time() - start_time
+            else:
+                write_node_state_bulk(session, state, phase_times, commit=False)
+
+            writes.append((state, fingerprint, phase_times, time.time() - start_time))
+
+        return writes
+
+    def flush(self) -> int:
+        r"""Writes everything pending, returns how many snapshots were written"""
+        with self._lock:
+            states, self._pending = self._pending, {}
+            cycles, self._pending_cycles = self._pending_cycles, []
+
+        if len(states) == 0 and len(cycles) == 0:
+            return 0
+
+        try:
+            session = self.session_maker()
+        except sa.exc.OperationalError as e:
+            logger.error("Could not connect to the database: {}".format(e))
+            self._requeue(list(states.values()), cycles)
+            return 0
+
+        batches = [list(states.values())]
+        written = []
+        failed = []
+        try:
+            while len(batches) > 0:
+                batch = batches.pop()
+                try:
+                    writes = self._write(session, batch)
+                    session.commit()
+                except sa.exc.SQLAlchemyError as e:
+                    session.rollback()
+                    if len(batch) == 1:
+                        logger.error(
+                            "Could not write {}: {}".format(batch[0].hostname, e)
+                        )
+                        failed.append(batch[0])
+                    else:
+                        logger.error(
+                            "Batch of {} snapshots failed, retrying one at a"
+                            " time: {}".format(len(batch), e)
+                        )
+                        batches.extend([state] for state in batch)
+                    continue
+
+                # A batch that gets retried one at a time must not count twice
+                for state, fingerprint, phase_times, duration in writes:
+                    self._fingerprints[state.hostname] = fingerprint
+                    if state.stats is not None:
+                        state.stats.phase_times.update(phase_times)
+                        state.stats.duration += duration
+
+                written.extend(batch)
+                with self._lock:
+                    self._known_nodes.update(state.hostname for state in batch)
+
+            self.num_batches += 1
+            write_cycle_stats(
+                session,
+                cycles + [state.stats for state in written if state.stats is not None],
+            )
+
+            if time.time() >= self._next_orphan_sweep:
+                self._next_orphan_sweep = time.time() + ORPHAN_SWEEP_INTERVAL
+                delete_orphans(session)
+                session.commit()
+        except sa.exc.SQLAlchemyError as e:
+            logger.error(str(e))
+            session.rollback()
+        finally:
+            session.close()
+
+        for state in failed:
+            # The next write of this node has to be a full one
+            self._fingerprints.pop(state.hostname, None)
+        self._requeue(failed, [])
+
+        logger.info(
+            "Wrote {} of {} snapshots in one batch".format(len(written), len(states))
+        )
+        return len(written)
+
+    def _requeue(self, states: List[NodeState], cycles: List[CycleStats]):
+        with self._lock:
+            for state in states:
+                # Anything that came in meanwhile is newer
+                self._pending.setdefault(state.hostname, state)
+            self._pending_cycles = cycles + self._pending_cycles
+
+
+@click.command(name="gpu-use-ingest")
+@click.option(
+    "-s",
+    "--socket",
+    "socket_path",
+    type=str,
+    default=DEFAULT_SOCKET_PATH,
+    show_default=True,
+    help="Unix socket to accept snapshots on",
+)
+@click.option(
+    "-p",
+    "--port",
+    type=int,
+    default=None,
+    help="Also accept snapshots on this TCP port, e.g. {}.  Requires {} in"
+    " the config file".format(DEFAULT_PORT, TOKEN_CONFIG_KEY),
+)
+@click.option(
+    "--host",
+    type=str,
+    default=DEFAULT_HOST,
+    show_default=True,
+    help="Address to accept TCP snapshots on, 0.0.0.0 for every interface",
+)
+@click.option(
+    "-b",
+    "--batch-interval",
+    type=float,
+    default=DEFAULT_BATCH_INTERVAL,
+    show_default=True,
+    help="Seconds of pushes to coalesce into one transaction",
+)
+def main(socket_path, port, host, batch_interval):
+    r"""Write snapshots pushed by gpu-used daemons to the database"""
+    set_profile("daemon")
+
+    config = load_secrets()
+    if port is not None and not config.get(TOKEN_CONFIG_KEY):
+        raise click.UsageError(
+            "Set {} in the config file to accept snapshots over TCP".format(
+                TOKEN_CONFIG_KEY
+            )
+        )
+
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    server = IngestServer(
+        port=port,
+        host=host,
+        socket_path=socket_path,
+        batch_interval=batch_interval,
+        token=config.get(TOKEN_CONFIG_KEY),
+        nodes=config.get(NODES_CONFIG_KEY, ()),
+    )
+    server.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.stop()
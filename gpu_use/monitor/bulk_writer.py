@@ -0,0 +1,611 @@
+import datetime
+import json
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql
+
+from gpu_use.db.gpu_status import gpu_error, is_valid_use, process_error
+from gpu_use.db.schema import (
+    GPU,
+    GPUProcess,
+    GPUStatus,
+    Lab,
+    MonitorCycle,
+    Node,
+    SLURMJob,
+    User,
+    user_node_association_table,
+)
+from gpu_use.monitor.cycle_stats import KEEP_CYCLES, CycleStats
+from gpu_use.monitor.node_state import NodeState, process_user_name
+
+logger = logging.getLogger("gpu-used")
+
+gpus_table = GPU.__table__
+processes_table = GPUProcess.__table__
+jobs_table = SLURMJob.__table__
+users_table = User.__table__
+labs_table = Lab.__table__
+nodes_table = Node.__table__
+cycles_table = MonitorCycle.__table__
+status_table = GPUStatus.__table__
+
+# Old cycles are only pruned every this many writes
+PRUNE_EVERY = 10
+_num_cycle_writes = 0
+
+
+def upsert(session, table: sa.Table, rows: List[Dict[str, Any]]):
+    r"""Inserts rows, updating the ones whose primary key already exists.
+
+    Every row must contain every column of the table.
+    """
+    if len(rows) == 0:
+        return
+
+    dialect = session.get_bind().dialect.name
+    if dialect == "mysql":
+        stmt = mysql.insert(table)
+        stmt = stmt.on_duplicate_key_update(
+            {c.name: stmt.inserted[c.name] for c in table.columns if not c.primary_key}
+        )
+    elif dialect == "postgresql":
+        stmt = postgresql.insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[c.name for c in table.primary_key.columns],
+            set_={
+                c.name: stmt.excluded[c.name]
+                for c in table.columns
+                if not c.primary_key
+            },
+        )
+    elif dialect == "sqlite":
+        # SQLAlchemy has no construct for this on SQLite.  Not INSERT OR
+        # REPLACE, which deletes the old row and so trips foreign keys.
+        columns = [c.name for c in table.columns]
+        key_columns = [c.name for c in table.primary_key.columns]
+        stmt = sa.text(
+            "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}".format(
+                table.name,
+                ", ".join(columns),
+                ", ".join(":" + name for name in columns),
+                ", ".join(key_columns),
+                ", ".join(
+                    "{0} = excluded.{0}".format(name)
+                    for name in columns
+                    if name not in key_columns
+                ),
+            )
+        ).bindparams(*[sa.bindparam(c.name, type_=c.type) for c in table.columns])
+    else:
+        raise NotImplementedError("No upsert for {}".format(dialect))
+
+    session.execute(stmt, rows)
+
+
+def insert_missing(session, table: sa.Table, rows: List[Dict[str, Any]]):
+    r"""Inserts rows, leaving the ones whose primary key already exists as
+    they are.  For rows that other nodes may insert at the same time.
+    """
+    if len(rows) == 0:
+        return
+
+    dialect = session.get_bind().dialect.name
+    if dialect == "mysql":
+        # Not INSERT IGNORE, which also ignores e.g. foreign key errors
+        stmt = mysql.insert(table)
+        stmt = stmt.on_duplicate_key_update(
+            {c.name: stmt.inserted[c.name] for c in table.primary_key.columns}
+        )
+    elif dialect == "postgresql":
+        stmt = postgresql.insert(table).on_conflict_do_nothing(
+            index_elements=[c.name for c in table.primary_key.columns]
+        )
+    elif dialect == "sqlite":
+        stmt = sa.text(
+            "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO NOTHING".format(
+                table.name,
+                ", ".join(c.name for c in table.columns),
+                ", ".join(":" + c.name for c in table.columns),
+                ", ".join(c.name for c in table.primary_key.columns),
+            )
+        ).bindparams(*[sa.bindparam(c.name, type_=c.type) for c in table.columns])
+    else:
+        raise NotImplementedError("No insert_missing for {}".format(dialect))
+
+    session.execute(stmt, rows)
+
+
+def _select_in(session, table: sa.Table, column: sa.Column, values: Iterable) -> List:
+    values = list(values)
+    if len(values) == 0:
+        return []
+
+    return session.execute(sa.select([table]).where(column.in_(values))).fetchall()
+
+
+def _changed_rows(
+    new_rows: Dict[Any, Dict[str, Any]], existing_rows: Dict[Any, Any]
+) -> List[Dict[str, Any]]:
+    return [
+        row
+        for key, row in new_rows.items()
+        if key not in existing_rows
+        or any(existing_rows[key][name] != value for name, value in row.items())
+    ]
+
+
+def write_node_state_bulk(
+    session,
+    state: NodeState,
+    phase_times: Optional[Dict[str, float]] = None,
+    commit: bool = True,
+):
+    r"""Writes a collected node state with a handful of set based statements.
+
+    Only the rows this state refers to are read, rows are only written when
+    their values changed, and stale rows are removed with one DELETE per
+    table.  If given, the time spent reading, writing and cleaning up is
+    recorded in phase_times.  With commit=False, the caller commits, e.g.
+    to write several nodes in one transaction.
+    """
+    phase_times = phase_times if phase_times is not None else {}
+    hostname = state.hostname
+    now = datetime.datetime.now()
+    start_time = time.time()
+
+    existing_gpus = {
+        row.id: row
+        for row in session.execute(
+            sa.select([gpus_table]).where(gpus_table.c.node_name == hostname)
+        )
+    }
+    existing_processes = {
+        (row.id, row.gpu_id): row
+        for row in session.execute(
+            sa.select([processes_table]).where(processes_table.c.node_name == hostname)
+        )
+    }
+
+    gpu_rows = {}
+    for gpu_id in sorted(state.gpu2pid_info.keys()):
+        job_info = state.gpu2job_info.get(gpu_id)
+        gpu_rows[gpu_id] = dict(
+            id=gpu_id,
+            node_name=hostname,
+            slurm_job_id=job_info.jid if job_info is not None else None,
+            user_name=job_info.user_name if job_info is not None else None,
+        )
+
+    process_rows = {}
+    for gpu_id in sorted(state.gpu2pid_info.keys()):
+        gpu_user_name = gpu_rows[gpu_id]["user_name"]
+        for pid in state.gpu2pid_info[gpu_id]:
+            if pid not in state.pid2job_id:
+                continue
+
+            existing_proc = existing_processes.get((pid, gpu_id))
+            user_name = process_user_name(
+                state.pid2user_info[pid].user_name,
+                gpu_user_name,
+                existing_proc.user_name if existing_proc is not None else None,
+            )
+
+            process_rows[(pid, gpu_id)] = dict(
+                id=pid,
+                gpu_id=gpu_id,
+                node_name=hostname,
+                slurm_job_id=state.pid2job_id[pid],
+                user_name=user_name,
+                command=state.pid2user_info[pid].command[0:128],
+            )
+
+    job_ids = {
+        row["slurm_job_id"]
+        for row in list(gpu_rows.values()) + list(process_rows.values())
+        if row["slurm_job_id"] is not None
+    }
+
+    # Users of GPU jobs and processes are linked to the node, users of jobs
+    # without GPUs only need to exist
+    node_user_names = {
+        row["user_name"]
+        for row in list(gpu_rows.values()) + list(process_rows.values())
+        if row["user_name"] is not None
+    }
+    user_names = node_user_names | {
+        state.jid2job_info[jid].user_name for jid in job_ids
+    }
+
+    existing_users = {
+        row.name: row
+        for row in _select_in(session, users_table, users_table.c.name, user_names)
+    }
+    user2lab = {name: row.lab_name for name, row in existing_users.items()}
+    new_user_rows = []
+    for user_name in sorted(user_names - set(existing_users.keys())):
+        lab_name = state.user2lab.get(user_name)
+        logger.info("Adding user {}".format(user_name))
+        new_user_rows.append(dict(name=user_name, lab_name=lab_name))
+        user2lab[user_name] = lab_name
+
+    # People change labs, an unknown lab doesn't move anyone though
+    moved_user_rows = []
+    for user_name in sorted(existing_users.keys()):
+        lab_name = state.user2lab.get(user_name)
+        if lab_name and lab_name != user2lab[user_name]:
+            logger.info("Moving user {} to lab {}".format(user_name, lab_name))
+            moved_user_rows.append(dict(name=user_name, lab_name=lab_name))
+            user2lab[user_name] = lab_name
+
+    lab_names = {
+        row["lab_name"]
+        for row in new_user_rows + moved_user_rows
+        if row["lab_name"] is not None
+    }
+    existing_labs = {
+        row.name
+        for row in _select_in(session, labs_table, labs_table.c.name, lab_names)
+    }
+    new_lab_rows = [
+        dict(name=lab_name) for lab_name in sorted(lab_names - existing_labs)
+    ]
+    for row in new_lab_rows:
+        logger.info("Adding lab {}".format(row["name"]))
+
+    for row in gpu_rows.values():
+        row["lab_name"] = user2lab[row["user_name"]] if row["user_name"] else None
+
+    # Jobs can migrate between nodes, so look them up by id
+    existing_jobs = {
+        row.job_id: row
+        for row in _select_in(session, jobs_table, jobs_table.c.job_id, job_ids)
+    }
+    job_rows = {}
+    for jid in sorted(job_ids):
+        job_info = state.jid2job_info[jid]
+        job_rows[jid] = dict(
+            job_id=jid,
+            is_debug_job=job_info.is_debug,
+            is_overcap_job=job_info.is_overcap,
+            cpus=job_info.cpus,
+            node_name=hostname,
+            lab_name=user2lab[job_info.user_name],
+            user_name=job_info.user_name,
+        )
+
+    existing_node_users = {
+        row.user_name
+        for row in session.execute(
+            sa.select([user_node_association_table.c.user_name]).where(
+                user_node_association_table.c.node_name == hostname
+            )
+        )
+    }
+    active_user_names = {
+        job_info.user_name for job_info in state.jid2job_info.values()
+    } | {row["user_name"] for row in process_rows.values()}
+
+    phase_times["db_read"] = time.time() - start_time
+    start_time = time.time()
+
+    # Parents before children so this works with foreign keys enforced
+    insert_missing(session, labs_table, new_lab_rows)
+    insert_missing(session, users_table, new_user_rows)
+    upsert(session, users_table, moved_user_rows)
+
+    upsert(
+        session,
+        nodes_table,
+        [
+            dict(name=hostname, load=state.load, update_time=now),
+        ],
+    )
+    upsert(session, jobs_table, _changed_rows(job_rows, existing_jobs))
+
+    changed_gpus = _changed_rows(gpu_rows, existing_gpus)
+    for row in changed_gpus:
+        row["update_time"] = now
+    upsert(session, gpus_table, changed_gpus)
+    session.execute(
+        gpus_table.update()
+        .where(gpus_table.c.node_name == hostname)
+        .values(update_time=now)
+    )
+
+    upsert(session, processes_table, _changed_rows(process_rows, existing_processes))
+
+    new_node_users = sorted(node_user_names - existing_node_users)
+    for user_name in new_node_users:
+        logger.info("Adding user {} to node {}".format(user_name, hostname))
+    if len(new_node_users) > 0:
+        session.execute(
+            user_node_association_table.insert(),
+            [dict(user_name=name, node_name=hostname) for name in new_node_users],
+        )
+
+    phase_times["db_write"] = time.time() - start_time
+    start_time = time.time()
+
+    # Remove everything that is no longer on this node
+    stale_processes = sorted(set(existing_processes.keys()) - set(process_rows.keys()))
+    if len(stale_processes) > 0:
+        logger.info(
+            "Removing processes {} from node {}".format(
+                [pid for pid, _ in stale_processes], hostname
+            )
+        )
+        session.execute(
+            processes_table.delete().where(
+                (processes_table.c.node_name == hostname)
+                & sa.or_(
+                    *[
+                        (processes_table.c.id == pid)
+                        & (processes_table.c.gpu_id == gpu_id)
+                        for pid, gpu_id in stale_processes
+                    ]
+                )
+            )
+        )
+
+    stale_jobs = jobs_table.c.node_name == hostname
+    if len(state.jid2job_info) > 0:
+        stale_jobs = stale_jobs & jobs_table.c.job_id.notin_(
+            list(state.jid2job_info.keys())
+        )
+    session.execute(jobs_table.delete().where(stale_jobs))
+
+    stale_node_users = sorted(existing_node_users - active_user_names)
+    if len(stale_node_users) > 0:
+        logger.info("Removing users {} from node {}".format(stale_node_users, hostname))
+        session.execute(
+            user_node_association_table.delete().where(
+                (user_node_association_table.c.node_name == hostname)
+                & user_node_association_table.c.user_name.in_(stale_node_users)
+            )
+        )
+
+    phase_times["cleanup"] = time.time() - start_time
+    start_time = time.time()
+
+    write_gpu_status(session, hostname)
+
+    if commit:
+        session.commit()
+    phase_times["gpu_status"] = time.time() - start_time
+
+
+def touch_gpu_status(session, hostname: str):
+    r"""Copies the load and update times of a node and its GPUs into
+    gpu_status
+    """
+    session.execute(
+        status_table.update()
+        .where(status_table.c.node_name == hostname)
+        .values(
+            node_load=sa.select([nodes_table.c.load])
+            .where(nodes_table.c.name == hostname)
+            .as_scalar(),
+            node_update_time=sa.select([nodes_table.c.update_time])
+            .where(nodes_table.c.name == hostname)
+            .as_scalar(),
+            update_time=sa.select([gpus_table.c.update_time])
+            .where(
+                (gpus_table.c.node_name == status_table.c.node_name)
+                & (gpus_table.c.id == status_table.c.gpu_id)
+            )
+            .as_scalar(),
+        )
+    )
+
+
+def write_gpu_status(session, hostname: str):
+    r"""Derives the gpu_status rows of a node from its rows in the other
+    tables, in the transaction that wrote those.  Only rows whose status
+    changed are rewritten.
+    """
+    gpus = session.execute(
+        sa.select([gpus_table]).where(gpus_table.c.node_name == hostname)
+    ).fetchall()
+    gpu2processes = {}
+    for proc in session.execute(
+        sa.select([processes_table])
+        .where(processes_table.c.node_name == hostname)
+        .order_by(processes_table.c.id)
+    ):
+        gpu2processes.setdefault(proc.gpu_id, []).append(proc)
+
+    jobs = {
+        row.job_id: row
+        for row in _select_in(
+            session,
+            jobs_table,
+            jobs_table.c.job_id,
+            {gpu.slurm_job_id for gpu in gpus if gpu.slurm_job_id is not None}
+            | {
+                proc.slurm_job_id
+                for procs in gpu2processes.values()
+                for proc in procs
+                if proc.slurm_job_id is not None
+            },
+        )
+    }
+    node_user_names = json.dumps(
+        sorted(
+            row.user_name
+            for row in session.execute(
+                sa.select([user_node_association_table.c.user_name]).where(
+                    user_node_association_table.c.node_name == hostname
+                )
+            )
+            if row.user_name is not None
+        )
+    )
+    existing_rows = {
+        row.gpu_id: row
+        for row in session.execute(
+            sa.select([status_table]).where(status_table.c.node_name == hostname)
+        )
+    }
+
+    status_rows = {}
+    for gpu in gpus:
+        job = jobs.get(gpu.slurm_job_id)
+        job_id = job.job_id if job is not None else None
+        processes = [
+            (proc, proc.slurm_job_id if proc.slurm_job_id in jobs else None)
+            for proc in gpu2processes.get(gpu.id, [])
+        ]
+        valid_use = is_valid_use(
+            job_id,
+            job.user_name if job is not None else None,
+            [(proc_job_id, proc.user_name) for proc, proc_job_id in processes],
+        )
+        status_rows[gpu.id] = dict(
+            node_name=hostname,
+            gpu_id=gpu.id,
+            node_user_names=node_user_names,
+            slurm_job_id=job_id,
+            user_name=gpu.user_name,
+            lab_name=gpu.lab_name,
+            is_debug_job=job.is_debug_job if job is not None else None,
+            in_use=len(processes) > 0,
+            valid_use=valid_use,
+            error=gpu_error(
+                job is not None,
+                len(processes) > 0,
+                valid_use,
+                job is not None and job.is_debug_job,
+            ),
+            processes=json.dumps(
+                [
+                    [
+                        proc.id,
+                        proc.command,
+                        proc.user_name,
+                        proc_job_id,
+                        process_error(proc_job_id, job_id),
+                    ]
+                    for proc, proc_job_id in processes
+                ]
+            ),
+        )
+
+    # The load and update times change every cycle, they are set by
+    # touch_gpu_status
+    changed_rows = _changed_rows(status_rows, existing_rows)
+    for row in changed_rows:
+        row.update(node_load=None, node_update_time=None, update_time=None)
+    upsert(session, status_table, changed_rows)
+
+    stale_status = status_table.c.node_name == hostname
+    if len(status_rows) > 0:
+        stale_status = stale_status & status_table.c.gpu_id.notin_(
+            list(status_rows.keys())
+        )
+    session.execute(status_table.delete().where(stale_status))
+
+    touch_gpu_status(session, hostname)
+
+
+def delete_orphans(session):
+    r"""Deletes users with no nodes, jobs or processes, and labs with no users.
+
+    This looks at the whole cluster, so it is not part of writing a node's
+    state.  The caller commits.
+    """
+    num_users = session.execute(
+        users_table.delete().where(
+            users_table.c.name.notin_(
+                sa.select([user_node_association_table.c.user_name]).where(
+                    user_node_association_table.c.user_name.isnot(None)
+                )
+            )
+            & users_table.c.name.notin_(
+                sa.select([jobs_table.c.user_name]).where(
+                    jobs_table.c.user_name.isnot(None)
+                )
+            )
+            & users_table.c.name.notin_(
+                sa.select([processes_table.c.user_name]).where(
+                    processes_table.c.user_name.isnot(None)
+                )
+            )
+            & users_table.c.name.notin_(
+                sa.select([gpus_table.c.user_name]).where(
+                    gpus_table.c.user_name.isnot(None)
+                )
+            )
+        )
+    ).rowcount
+    num_labs = session.execute(
+        labs_table.delete().where(
+            labs_table.c.name.notin_(
+                sa.select([users_table.c.lab_name]).where(
+                    users_table.c.lab_name.isnot(None)
+                )
+            )
+        )
+    ).rowcount
+    logger.info(
+        "Deleted {} orphan users and {} orphan labs".format(num_users, num_labs)
+    )
+
+
+def write_cycle_stats(
+    session,
+    cycles: List[CycleStats],
+    keep: int = KEEP_CYCLES,
+    prune: Optional[bool] = None,
+):
+    r"""Stores the stats of monitor cycles, keeping the last keep per node.
+
+    Pruning happens every PRUNE_EVERY calls unless prune says otherwise, so
+    a node may briefly have a few more than keep cycles stored.
+    """
+    global _num_cycle_writes
+
+    if len(cycles) == 0:
+        return
+
+    session.execute(
+        cycles_table.insert(),
+        [
+            dict(
+                node_name=stats.node_name,
+                start_time=datetime.datetime.fromtimestamp(stats.start_time),
+                duration=stats.duration,
+                phase_times=json.dumps(stats.phase_times),
+                num_subprocesses=stats.num_subprocesses,
+                num_statements=stats.num_statements,
+                failed_phase=stats.failed_phase,
+            )
+            for stats in cycles
+        ],
+    )
+
+    _num_cycle_writes += 1
+    if prune is None:
+        prune = _num_cycle_writes % PRUNE_EVERY == 0
+
+    if prune:
+        for node_name in sorted({stats.node_name for stats in cycles}):
+            oldest_kept = session.execute(
+                sa.select([cycles_table.c.id])
+                .where(cycles_table.c.node_name == node_name)
+                .order_by(cycles_table.c.id.desc())
+                .offset(keep - 1)
+                .limit(1)
+            ).scalar()
+            if oldest_kept is not None:
+                session.execute(
+                    cycles_table.delete().where(
+                        (cycles_table.c.node_name == node_name)
+                        & (cycles_table.c.id < oldest_kept)
+                    )
+                )
+
+    session.commit()
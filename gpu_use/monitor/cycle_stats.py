@@ -0,0 +1,37 @@
+import threading
+from typing import Dict, Optional
+
+import attr
+
+# How many cycles are kept in the database for every node
+KEEP_CYCLES = 100
+
+_lock = threading.Lock()
+_num_subprocesses = 0
+
+
+def count_subprocess(num: int = 1):
+    r"""Called by everything that spawns subprocesses during a cycle"""
+    global _num_subprocesses
+    with _lock:
+        _num_subprocesses += num
+
+
+def num_subprocesses() -> int:
+    return _num_subprocesses
+
+
+@attr.s(auto_attribs=True)
+class CycleStats:
+    r"""Where the time of one monitor cycle went"""
+
+    node_name: str
+    # Seconds since the epoch
+    start_time: float
+    duration: float = 0.0
+    # Seconds spent in each phase, collection and database
+    phase_times: Dict[str, float] = attr.Factory(dict)
+    num_subprocesses: int = 0
+    num_statements: int = 0
+    # The phase that raised, if the cycle failed
+    failed_phase: Optional[str] = None
@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+from os import path as osp
+from typing import Dict, Iterable, Optional, Tuple
+
+from gpu_use.monitor.proc_table import PROC_ROOT
+
+READ_CHUNK_SIZE = 16 * 1024
+
+
+def read_environ(
+    pid: int, names: Iterable[str], proc_root: str = PROC_ROOT
+) -> Optional[Dict[str, str]]:
+    r"""Find the given variables in /proc/<pid>/environ.
+
+    The file is scanned in chunks and reading stops as soon as every
+    requested variable has been seen.  Returns None if the process is gone
+    or we are not allowed to read its environment.
+    """
+    prefixes = {name.encode("utf-8") + b"=": name for name in names}
+    found = {}
+
+    try:
+        with open(osp.join(proc_root, str(pid), "environ"), "rb") as f:
+            remainder = b""
+            while len(found) < len(prefixes):
+                chunk = f.read(READ_CHUNK_SIZE)
+                if len(chunk) == 0:
+                    entries = [remainder]
+                else:
+                    entries = (remainder + chunk).split(b"\0")
+                    remainder = entries.pop()
+
+                for entry in entries:
+                    for prefix, name in prefixes.items():
+                        if name not in found and entry.startswith(prefix):
+                            found[name] = entry[len(prefix) :].decode(
+                                "utf-8", "replace"
+                            )
+
+                if len(chunk) == 0:
+                    break
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+
+    return found
+
+
+class EnvironReader:
+    r"""Reads environments of many processes concurrently.
+
+    The environment of a running process never changes, so results are cached
+    by (pid, start time).  The start time guards against pid reuse.
+    """
+
+    def __init__(
+        self,
+        names: Iterable[str] = ("CUDA_VISIBLE_DEVICES",),
+        max_workers: int = 8,
+        proc_root: str = PROC_ROOT,
+    ):
+        self.names = tuple(names)
+        self.max_workers = max_workers
+        self.proc_root = proc_root
+        self._cache: Dict[Tuple[int, int], Dict[str, str]] = {}
+        self._pool = None
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        return self._pool
+
+    def read(self, pid: int) -> Optional[Dict[str, str]]:
+        return read_environ(pid, self.names, self.proc_root)
+
+    def read_many(
+        self, pid2start_time: Dict[int, int]
+    ) -> Dict[int, Optional[Dict[str, str]]]:
+        r"""Read the environments of all given processes.
+
+        Entries for processes not in this batch are dropped from the cache,
+        so it only ever holds processes that are still being monitored.
+        """
+        res = {}
+        to_read = []
+        for pid, start_time in pid2start_time.items():
+            if (pid, start_time) in self._cache:
+                res[pid] = self._cache[(pid, start_time)]
+            else:
+                to_read.append(pid)
+
+        if len(to_read) == 1:
+            res[to_read[0]] = self.read(to_read[0])
+        elif len(to_read) > 1:
+            res.update(zip(to_read, self.pool.map(self.read, to_read)))
+
+        self._cache = {
+            (pid, start_time): res[pid]
+            for pid, start_time in pid2start_time.items()
+            if res[pid] is not None
+        }
+
+        return res
@@ -0,0 +1,338 @@
+import abc
+import csv
+import io
+import logging
+import os
+import shlex
+import subprocess
+from typing import BinaryIO, Dict, List, Optional, Union
+from xml.etree import ElementTree as etree
+
+import attr
+
+from gpu_use.monitor.cycle_stats import count_subprocess
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+logger = logging.getLogger("gpu-used")
+
+FIXTURE_ENV_VAR = "GPU_USE_NVIDIA_SMI_FIXTURE"
+
+gpu_command = "timeout 5m nvidia-smi -q -x"
+gpu_query_command = (
+    "timeout 5m nvidia-smi --query-gpu=index,pci.bus_id --format=csv,noheader,nounits"
+)
+apps_query_command = (
+    "timeout 5m nvidia-smi --query-compute-apps=gpu_bus_id,pid,used_memory"
+    " --format=csv,noheader,nounits"
+)
+driver_gpu_information_file = "/proc/driver/nvidia/gpus/{}/information"
+
+
+class GPUCollectionError(RuntimeError):
+    pass
+
+
+@attr.s(auto_attribs=True)
+class GPUProcessInfo:
+    pid: int
+    # In MiB, None when the driver can't report it (e.g. in containers)
+    used_memory: Optional[int] = None
+
+
+@attr.s(auto_attribs=True)
+class GPUInfo:
+    minor_number: int
+    processes: List[GPUProcessInfo] = attr.Factory(list)
+
+
+class GPUCollector(abc.ABC):
+    r"""Lists the GPUs on this node and the processes running on them"""
+
+    name: str = ""
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return True
+
+    @abc.abstractmethod
+    def collect(self) -> List[GPUInfo]:
+        pass
+
+
+def _parse_memory(mem: str) -> Optional[int]:
+    try:
+        return int(mem.split()[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def parse_nvidia_smi_xml(smi_out: Union[str, bytes, BinaryIO]) -> List[GPUInfo]:
+    r"""Parses `nvidia-smi -q -x` output incrementally.
+
+    Only the handful of fields we need are kept and each <gpu> element is
+    dropped as soon as it has been read, so memory stays bounded by a single
+    GPU's section no matter how large the dump is.
+    """
+    if isinstance(smi_out, str):
+        smi_out = smi_out.encode("utf-8")
+    if isinstance(smi_out, bytes):
+        smi_out = io.BytesIO(smi_out)
+
+    gpus = []
+    minor_number = None
+    procs = []
+    pid = None
+    used_memory = None
+    for _, elem in etree.iterparse(smi_out, events=("end",)):
+        if elem.tag == "minor_number":
+            minor_number = int(elem.text)
+        elif elem.tag == "pid":
+            pid = int(elem.text)
+        elif elem.tag == "used_memory":
+            used_memory = _parse_memory(elem.text)
+        elif elem.tag == "process_info":
+            procs.append(GPUProcessInfo(pid=pid, used_memory=used_memory))
+            pid = None
+            used_memory = None
+        elif elem.tag == "gpu":
+            gpus.append(GPUInfo(minor_number=minor_number, processes=procs))
+            minor_number = None
+            procs = []
+            # Leaves behind an empty <gpu/> in the root, which is negligible
+            elem.clear()
+
+    return gpus
+
+
+def _parse_csv_memory(mem: str) -> Optional[int]:
+    try:
+        return int(mem)
+    except ValueError:
+        return None
+
+
+def _normalize_bus_id(bus_id: str) -> str:
+    # nvidia-smi reports an 8 digit PCI domain, the kernel uses 4
+    domain, rest = bus_id.strip().lower().split(":", 1)
+    return "{}:{}".format(domain[-4:], rest)
+
+
+def parse_nvidia_smi_csv(
+    gpu_csv: str, apps_csv: str, minor_numbers: Optional[Dict[str, int]] = None
+) -> List[GPUInfo]:
+    r"""Parses the `--query-gpu=index,pci.bus_id` and
+    `--query-compute-apps=gpu_bus_id,pid,used_memory` outputs.
+
+    minor_numbers maps normalized PCI bus ids to device minor numbers.  GPUs
+    missing from it fall back to their nvidia-smi index.
+
+    The outputs come from two nvidia-smi calls, so processes on a GPU that
+    went away in between are skipped.  nvidia-smi has no query for graphics
+    processes, so unlike the XML and NVML backends only compute processes
+    are listed.
+    """
+    minor_numbers = minor_numbers if minor_numbers is not None else {}
+
+    bus_id2gpu = {}
+    gpus = []
+    for row in csv.reader(io.StringIO(gpu_csv), skipinitialspace=True):
+        if len(row) == 0:
+            continue
+
+        bus_id = _normalize_bus_id(row[1])
+        gpu = GPUInfo(minor_number=minor_numbers.get(bus_id, int(row[0])))
+        bus_id2gpu[bus_id] = gpu
+        gpus.append(gpu)
+
+    for row in csv.reader(io.StringIO(apps_csv), skipinitialspace=True):
+        if len(row) == 0:
+            continue
+
+        bus_id = _normalize_bus_id(row[0])
+        if bus_id not in bus_id2gpu:
+            logger.warning(
+                "Skipping process {} on unknown GPU {}".format(row[1], bus_id)
+            )
+            continue
+
+        bus_id2gpu[bus_id].processes.append(
+            GPUProcessInfo(pid=int(row[1]), used_memory=_parse_csv_memory(row[2]))
+        )
+
+    return gpus
+
+
+def read_minor_numbers(gpu_csv: str) -> Dict[str, int]:
+    r"""Reads device minor numbers from the driver's procfs entries"""
+    minor_numbers = {}
+    for row in csv.reader(io.StringIO(gpu_csv), skipinitialspace=True):
+        if len(row) == 0:
+            continue
+
+        bus_id = _normalize_bus_id(row[1])
+        try:
+            with open(driver_gpu_information_file.format(bus_id), "rt") as f:
+                for line in f:
+                    if line.startswith("Device Minor:"):
+                        minor_numbers[bus_id] = int(line.split(":")[1])
+        except OSError:
+            pass
+
+    return minor_numbers
+
+
+class NvidiaSmiXMLGPUCollector(GPUCollector):
+    r"""Streams the full `nvidia-smi -q -x` dump.
+
+    Only used when neither NVML nor the nvidia-smi query mode work.
+    """
+
+    name = "nvidia-smi-xml"
+
+    def collect(self) -> List[GPUInfo]:
+        cmd = shlex.split(gpu_command)
+        count_subprocess()
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+            gpus = parse_nvidia_smi_xml(proc.stdout)
+            # Drain anything after the root element so nvidia-smi can exit
+            proc.stdout.read()
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+        return gpus
+
+
+class NvidiaSmiCSVGPUCollector(GPUCollector):
+    r"""Uses nvidia-smi's query mode to ask for just the fields we need"""
+
+    name = "nvidia-smi-csv"
+
+    def __init__(self):
+        self._minor_numbers = None
+
+    @classmethod
+    def is_available(cls) -> bool:
+        try:
+            subprocess.check_output(
+                shlex.split(gpu_query_command), stderr=subprocess.DEVNULL
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return False
+
+        return True
+
+    def collect(self) -> List[GPUInfo]:
+        # The two queries are independent, so run them at the same time
+        gpu_cmd = shlex.split(gpu_query_command)
+        apps_cmd = shlex.split(apps_query_command)
+        count_subprocess(2)
+        with subprocess.Popen(gpu_cmd, stdout=subprocess.PIPE) as gpu_proc:
+            apps_csv = subprocess.check_output(apps_cmd).decode("utf-8")
+            gpu_csv = gpu_proc.stdout.read().decode("utf-8")
+
+        if gpu_proc.returncode != 0:
+            raise subprocess.CalledProcessError(gpu_proc.returncode, gpu_cmd)
+
+        # The GPUs on a node don't change while the daemon is running
+        if self._minor_numbers is None:
+            self._minor_numbers = read_minor_numbers(gpu_csv)
+
+        return parse_nvidia_smi_csv(gpu_csv, apps_csv, self._minor_numbers)
+
+
+class FixtureGPUCollector(GPUCollector):
+    r"""Replays a captured `nvidia-smi -q -x` dump.
+
+    Used for tests and benchmarks on machines without GPUs.
+    """
+
+    name = "fixture"
+
+    def __init__(self, fixture_path: str):
+        with open(fixture_path, "rb") as f:
+            self.smi_out = f.read()
+
+    def collect(self) -> List[GPUInfo]:
+        return parse_nvidia_smi_xml(self.smi_out)
+
+
+class NVMLGPUCollector(GPUCollector):
+    r"""Queries only the process lists and minor numbers through NVML"""
+
+    name = "nvml"
+
+    def __init__(self):
+        try:
+            pynvml.nvmlInit()
+        except pynvml.NVMLError as e:
+            raise GPUCollectionError(str(e))
+
+    @classmethod
+    def is_available(cls) -> bool:
+        if pynvml is None:
+            return False
+
+        try:
+            pynvml.nvmlInit()
+            pynvml.nvmlShutdown()
+        except pynvml.NVMLError:
+            return False
+
+        return True
+
+    def collect(self) -> List[GPUInfo]:
+        try:
+            return self._collect()
+        except pynvml.NVMLError as e:
+            raise GPUCollectionError(str(e))
+
+    def _collect(self) -> List[GPUInfo]:
+        gpus = []
+        for idx in range(pynvml.nvmlDeviceGetCount()):
+            handle = pynvml.nvmlDeviceGetHandleByIndex(idx)
+
+            procs = {}
+            for p in pynvml.nvmlDeviceGetComputeRunningProcesses(
+                handle
+            ) + pynvml.nvmlDeviceGetGraphicsRunningProcesses(handle):
+                procs[p.pid] = GPUProcessInfo(
+                    pid=p.pid,
+                    used_memory=(
+                        None
+                        if p.usedGpuMemory is None
+                        else p.usedGpuMemory // (1024 * 1024)
+                    ),
+                )
+
+            gpus.append(
+                GPUInfo(
+                    minor_number=pynvml.nvmlDeviceGetMinorNumber(handle),
+                    processes=list(procs.values()),
+                )
+            )
+
+        return gpus
+
+
+def make_gpu_collector() -> GPUCollector:
+    r"""Picks the cheapest backend that works on this node.
+
+    A captured dump given through the GPU_USE_NVIDIA_SMI_FIXTURE environment
+    variable takes precedence over everything else.
+    """
+    fixture_path = os.environ.get(FIXTURE_ENV_VAR)
+    if fixture_path is not None:
+        return FixtureGPUCollector(fixture_path)
+
+    if NVMLGPUCollector.is_available():
+        return NVMLGPUCollector()
+
+    if NvidiaSmiCSVGPUCollector.is_available():
+        return NvidiaSmiCSVGPUCollector()
+
+    return NvidiaSmiXMLGPUCollector()
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import shlex
+import subprocess
+import time
+from os import path as osp
+from typing import Dict, Optional, Tuple
+
+from gpu_use.monitor.cycle_stats import count_subprocess
+
+ASSOC_COMMAND = "sacctmgr -np show assoc format=user,account"
+DEFAULT_CACHE_PATH = "/var/lib/gpu-use/lab-cache.json"
+DEFAULT_TTL = 24 * 60 * 60
+# Several new users in one cycle should still only cost one sacctmgr call
+MIN_WARM_INTERVAL = 5 * 60
+# Users sacctmgr doesn't know about are looked up again after this, so that
+# users added right after a refresh aren't labelled for a whole TTL
+NEGATIVE_TTL = MIN_WARM_INTERVAL
+
+logger = logging.getLogger("gpu-used")
+
+
+def parse_assoc(assoc_out: str) -> Dict[str, Optional[str]]:
+    r"""Maps every user to their first non-overcap account.
+
+    Users that only have the overcap account map to None.
+    """
+    user2accounts = {}
+    for line in assoc_out.split("\n"):
+        fields = line.strip().split("|")
+        if len(fields) < 2 or len(fields[0]) == 0:
+            # Account level associations have no user
+            continue
+
+        user2accounts.setdefault(fields[0], []).append(fields[1].strip())
+
+    user2lab = {}
+    for user_name, accounts in user2accounts.items():
+        user2lab[user_name] = None
+        for acc in accounts:
+            if acc != "overcap":
+                user2lab[user_name] = acc
+                break
+
+    return user2lab
+
+
+class LabResolver:
+    r"""Resolves user names to lab (account) names.
+
+    Results are cached with a TTL and persisted to disk, so they survive
+    both the per-node user cleanup and daemon restarts.  A miss refreshes
+    every user with a single sacctmgr call.  Users sacctmgr doesn't know
+    about (e.g. root) are cached too, for NEGATIVE_TTL, so that they cost
+    at most one sacctmgr call per MIN_WARM_INTERVAL.
+    """
+
+    def __init__(self, cache_path: str = DEFAULT_CACHE_PATH, ttl: float = DEFAULT_TTL):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self._cache: Dict[str, Tuple[Optional[str], float]] = {}
+        self._last_warm_time = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.cache_path, "rt") as f:
+                self._cache = {
+                    user_name: (lab_name, fetch_time)
+                    for user_name, (lab_name, fetch_time) in json.load(f).items()
+                }
+        except (OSError, ValueError) as e:
+            logger.info("Not loading lab cache: {}".format(e))
+
+    def _save(self):
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            os.makedirs(osp.dirname(self.cache_path), exist_ok=True)
+            with open(tmp_path, "wt") as f:
+                json.dump(self._cache, f)
+
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.error("Could not save lab cache: {}".format(e))
+
+    def _is_fresh(self, user_name: str, now: float) -> bool:
+        if user_name not in self._cache:
+            return False
+
+        lab_name, fetch_time = self._cache[user_name]
+        return now - fetch_time < (NEGATIVE_TTL if lab_name == "" else self.ttl)
+
+    def warm(self):
+        count_subprocess()
+        assoc_out = subprocess.check_output(shlex.split(ASSOC_COMMAND)).decode("utf-8")
+
+        now = time.time()
+        self._last_warm_time = now
+        self._cache.update(
+            {
+                user_name: (lab_name, now)
+                for user_name, lab_name in parse_assoc(assoc_out).items()
+            }
+        )
+
+    def lab_name(self, user_name: str) -> Optional[str]:
+        now = time.time()
+        if (
+            not self._is_fresh(user_name, now)
+            and self._last_warm_time is not None
+            and now - self._last_warm_time < MIN_WARM_INTERVAL
+        ):
+            # We just refreshed everyone and this user wasn't there.  Expires
+            # when the next refresh is allowed.
+            self._cache[user_name] = ("", self._last_warm_time)
+            self._save()
+        elif not self._is_fresh(user_name, now):
+            logger.info("Refreshing lab cache for {}".format(user_name))
+            try:
+                self.warm()
+            except subprocess.CalledProcessError:
+                # Stale is better than nothing
+                if user_name not in self._cache:
+                    raise
+
+                logger.error("Could not refresh lab cache, using stale entries")
+            else:
+                if not self._is_fresh(user_name, now):
+                    self._cache[user_name] = ("", now)
+
+                self._save()
+
+        return self._cache[user_name][0]
@@ -0,0 +1,347 @@
+import http.server
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from gpu_use.db.gpu_status import NO_ERROR, gpu_error, is_valid_use
+from gpu_use.monitor.node_state import NodeState, process_user_name
+
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+logger = logging.getLogger("gpu-used")
+
+Labels = Sequence[Tuple[str, str]]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_sample(name: str, labels: Labels, value) -> str:
+    if len(labels) > 0:
+        name = "{}{{{}}}".format(
+            name, ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+        )
+
+    return "{} {}".format(name, float(value))
+
+
+class Histogram:
+    r"""Cumulative histogram in the Prometheus sense"""
+
+    def __init__(self, buckets: Sequence[float] = DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name: str, labels: Labels = ()) -> List[str]:
+        labels = list(labels)
+        lines = [
+            _format_sample(name + "_bucket", labels + [("le", bound)], count)
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append(
+            _format_sample(name + "_bucket", labels + [("le", "+Inf")], self.count)
+        )
+        lines.append(_format_sample(name + "_count", labels, self.count))
+        lines.append(_format_sample(name + "_sum", labels, self.sum))
+        return lines
+
+
+def gpu_samples(state: NodeState) -> List[Tuple[Labels, Dict[str, bool]]]:
+    r"""Labels and status of every GPU in the snapshot, following what
+    `gpu-use view` reports as reserved, in use and errors.  Labs are the
+    users' labs, as in the database, rather than the jobs' accounts.
+    """
+    samples = []
+    for gpu_id in sorted(state.gpu2pid_info.keys()):
+        job_info = state.gpu2job_info.get(gpu_id)
+        job_id = job_info.jid if job_info is not None else None
+        job_user_name = job_info.user_name if job_info is not None else None
+        pids = [pid for pid in state.gpu2pid_info[gpu_id] if pid in state.pid2job_id]
+
+        # (job id, user name) of every process, as the monitor writes them
+        processes = [
+            (
+                (
+                    state.pid2job_id[pid]
+                    if state.pid2job_id[pid] in state.jid2job_info
+                    else None
+                ),
+                process_user_name(
+                    state.pid2user_info[pid].user_name, job_user_name, None
+                ),
+            )
+            for pid in pids
+        ]
+        proc_users = {user_name for _, user_name in processes}
+
+        reserved = job_info is not None
+        in_use = len(pids) > 0
+        valid_use = is_valid_use(job_id, job_user_name, processes)
+        error = gpu_error(reserved, in_use, valid_use, reserved and job_info.is_debug)
+
+        if reserved:
+            user_name = job_info.user_name
+            lab_name = state.user2lab.get(job_info.user_name)
+        else:
+            user_name = ",".join(sorted(proc_users))
+            lab_name = ",".join(
+                sorted({state.user2lab.get(u) or "" for u in proc_users} - {""})
+            )
+
+        labels = [
+            ("node", state.hostname),
+            ("gpu", gpu_id),
+            ("lab", lab_name or ""),
+            ("user", user_name),
+            ("job", job_id if reserved else ""),
+        ]
+        samples.append(
+            (
+                labels,
+                dict(
+                    reserved=reserved,
+                    in_use=in_use,
+                    error=error != NO_ERROR,
+                    processes=len(pids),
+                ),
+            )
+        )
+
+    return samples
+
+
+class MetricsExporter:
+    r"""Prometheus metrics for the node and the daemon itself.
+
+    Everything is computed from the last snapshot the daemon collected and
+    the stats of its writer and scheduler, so scrapes never touch the
+    database.  Metrics are served over HTTP on port, and/or written to
+    textfile for node_exporter's textfile collector (the file name has to
+    end in .prom for it to be picked up).
+    """
+
+    def __init__(
+        self,
+        port: Optional[int] = None,
+        textfile: Optional[str] = None,
+        writer=None,
+        scheduler=None,
+    ):
+        self.port = port
+        self.textfile = textfile
+        self.writer = writer
+        self.scheduler = scheduler
+
+        self._lock = threading.Lock()
+        self._state: Optional[NodeState] = None
+        self._last_success = 0.0
+        self._num_failed = 0
+        self._duration_histogram = Histogram()
+        self._phase_histograms: Dict[str, Histogram] = {}
+        self._server = None
+
+    def start(self):
+        if self.port is None:
+            return
+
+        exporter = self
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self._server = http.server.HTTPServer(("", self.port), _Handler)
+        threading.Thread(
+            target=self._server.serve_forever, name="gpu-use-metrics", daemon=True
+        ).start()
+        logger.info("Serving metrics on port {}".format(self._server.server_port))
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def update(self, state: Optional[NodeState]):
+        r"""Records the outcome of a cycle, None if collection failed"""
+        with self._lock:
+            if state is None:
+                self._num_failed += 1
+            else:
+                self._state = state
+                self._last_success = time.time()
+                if state.stats is not None:
+                    self._duration_histogram.observe(state.stats.duration)
+                    for phase, t in state.stats.phase_times.items():
+                        self._phase_histograms.setdefault(phase, Histogram()).observe(t)
+
+        if self.textfile is not None:
+            self.write_textfile()
+
+    def write_textfile(self):
+        tmp_path = self.textfile + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(self.render())
+            os.replace(tmp_path, self.textfile)
+        except OSError as e:
+            logger.error("Could not write metrics to {}: {}".format(self.textfile, e))
+
+    def render(self) -> str:
+        lines = []
+
+        def _metric(name, kind, help, samples):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.extend(samples)
+
+        with self._lock:
+            state = self._state
+            if state is not None:
+                gpus = gpu_samples(state)
+                for key, help in (
+                    ("reserved", "Whether the GPU is reserved by a SLURM job"),
+                    ("in_use", "Whether the GPU has processes running on it"),
+                    ("error", "Whether the GPU's use is flagged by gpu-use view"),
+                    ("processes", "Number of processes on the GPU"),
+                ):
+                    _metric(
+                        "gpu_use_gpu_" + key,
+                        "gauge",
+                        help,
+                        [
+                            _format_sample("gpu_use_gpu_" + key, labels, status[key])
+                            for labels, status in gpus
+                        ],
+                    )
+
+                _metric(
+                    "gpu_use_node_load",
+                    "gauge",
+                    "Load average of the node",
+                    [
+                        _format_sample(
+                            "gpu_use_node_load",
+                            [("node", state.hostname), ("period", period)],
+                            load,
+                        )
+                        for period, load in zip(
+                            ("1m", "5m", "15m"), state.load.split(" / ")
+                        )
+                    ],
+                )
+
+            node_labels = [("node", os.uname()[1] if state is None else state.hostname)]
+            _metric(
+                "gpu_use_cycle_duration_seconds",
+                "histogram",
+                "How long collecting a snapshot took",
+                self._duration_histogram.samples(
+                    "gpu_use_cycle_duration_seconds", node_labels
+                ),
+            )
+            _metric(
+                "gpu_use_cycle_phase_duration_seconds",
+                "histogram",
+                "How long each phase of collecting a snapshot took",
+                [
+                    line
+                    for phase in sorted(self._phase_histograms.keys())
+                    for line in self._phase_histograms[phase].samples(
+                        "gpu_use_cycle_phase_duration_seconds",
+                        node_labels + [("phase", phase)],
+                    )
+                ],
+            )
+            _metric(
+                "gpu_use_cycles_failed_total",
+                "counter",
+                "Cycles whose collection failed",
+                [
+                    _format_sample(
+                        "gpu_use_cycles_failed_total", node_labels, self._num_failed
+                    )
+                ],
+            )
+            _metric(
+                "gpu_use_last_collection_timestamp_seconds",
+                "gauge",
+                "When the last snapshot was collected",
+                [
+                    _format_sample(
+                        "gpu_use_last_collection_timestamp_seconds",
+                        node_labels,
+                        self._last_success,
+                    )
+                ],
+            )
+
+        if self.writer is not None:
+            for name, kind, help, value in (
+                (
+                    "gpu_use_writer_lag_seconds",
+                    "gauge",
+                    "Time between collecting the last written snapshot and writing it",
+                    self.writer.lag,
+                ),
+                (
+                    "gpu_use_writer_queue_depth",
+                    "gauge",
+                    "Snapshots waiting to be written",
+                    self.writer.queue_depth,
+                ),
+                (
+                    "gpu_use_writer_written_total",
+                    "counter",
+                    "Writes to the database",
+                    self.writer.num_written,
+                ),
+                (
+                    "gpu_use_writer_dropped_total",
+                    "counter",
+                    "Snapshots skipped because a newer one was already queued",
+                    self.writer.num_dropped,
+                ),
+            ):
+                _metric(name, kind, help, [_format_sample(name, node_labels, value)])
+
+        if self.scheduler is not None:
+            _metric(
+                "gpu_use_poll_interval_seconds",
+                "gauge",
+                "Current time between monitor cycles",
+                [
+                    _format_sample(
+                        "gpu_use_poll_interval_seconds",
+                        node_labels,
+                        self.scheduler.current_interval,
+                    )
+                ],
+            )
+
+        return "\n".join(lines) + "\n"
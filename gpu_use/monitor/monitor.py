@@ -1,29 +1,40 @@
 #!/usr/bin/python
+import asyncio
+import collections
 import datetime
 import logging
 import os
-import re
+import random
 import shlex
 import subprocess
 import sys
-from os import path as osp
-from typing import Any
-from xml.etree import ElementTree as etree
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
-import attr
 import sqlalchemy as sa
 
-from gpu_use.db.schema import GPU, GPUProcess, Lab, Node, SLURMJob, User
+from gpu_use.db.schema import GPU, Node
 from gpu_use.db.session import SessionMaker
-
-ACCOUNT_REGEX = re.compile(r"Account=(?P<account>\w.*?)\s")
-PARTITION_REGEX = re.compile(r"Partition=(?P<part>\w.*?)\s")
-CPU_REGEX = re.compile(r"cpu=(?P<cpus>\d+)")
-
-JOB_INFO = "scontrol show job {}"
-
-LAB_NAME_COMMAND = "sacctmgr -np show assoc format=account user={}"
-
+from gpu_use.monitor.bulk_writer import (
+    delete_orphans,
+    touch_gpu_status,
+    write_cycle_stats,
+    write_node_state_bulk,
+)
+from gpu_use.monitor.cycle_stats import (
+    KEEP_CYCLES,
+    CycleStats,
+    count_subprocess,
+    num_subprocesses,
+)
+from gpu_use.monitor.environ import EnvironReader
+from gpu_use.monitor.gpu_collector import GPUCollectionError, make_gpu_collector
+from gpu_use.monitor.lab_resolver import LabResolver
+from gpu_use.monitor.node_state import JobInfo, NodeState
+from gpu_use.monitor.proc_table import ProcessTable
+from gpu_use.monitor.slurm import SLURMJobCache
+from gpu_use.monitor.spool import SnapshotSpool
 
 NODE_GPU_ORDER = {
     "ripl-s1": {
@@ -35,12 +46,7 @@ NODE_GPU_ORDER = {
     "brainiac": {smi_id: cuda_id for cuda_id, smi_id in enumerate([1, 0, 3, 2])},
 }
 
-gpu_command = "timeout 5m nvidia-smi -q -x"
-pid_command = "ps -o %p,:,%P,:,%a,:,%t --no-header -p "
-user_command = "ps -o pid,user:32 --no-header -p "
 listpids_command = "scontrol listpids"
-environ_file = "/proc/{}/environ"
-print_environ_file_command = "cat {} | xargs --null --max-args=1 echo"
 
 formatter = logging.Formatter(
     "[%(asctime)s] p%(process)s {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s",
@@ -54,414 +60,477 @@ logger = logging.getLogger("gpu-used")
 logger.addHandler(ch)
 logger.setLevel(logging.INFO)
 
+# These live for as long as the daemon so that they can cache across cycles
+environ_reader = EnvironReader(names=("CUDA_VISIBLE_DEVICES",))
+job_cache = SLURMJobCache(hostname=os.uname()[1])
+# Stats of cycles that failed, written along with the next snapshot
+failed_cycles = collections.deque(maxlen=KEEP_CYCLES)
 
-@attr.s(auto_attribs=True)
-class ProcInfo:
-    pid: int
-    ppid: int
-    command: str
-    running_time: str
-    user_name: str
+_gpu_collector = None
+# Created on first use, as loading it reads the lab cache from disk
+_lab_resolver = None
+# Likewise, shared by the collector and the writer threads
+_spool = None
+_spool_lock = threading.Lock()
 
+# Users and labs are shared by the whole cluster, so garbage collecting them
+# is done by an occasional sweep instead of every cycle
+ORPHAN_SWEEP_INTERVAL = 60 * 60
+# Spread the sweeps of all the nodes over the interval
+_next_orphan_sweep = time.time() + random.uniform(0, ORPHAN_SWEEP_INTERVAL)
 
-@attr.s(auto_attribs=True)
-class JobInfo:
-    jid: int
-    user_name: str
-    user: User = None
 
-    _info_str: str = None
+def get_gpu_collector():
+    global _gpu_collector
+    if _gpu_collector is None:
+        _gpu_collector = make_gpu_collector()
+        logger.info("Using the {} GPU collector".format(_gpu_collector.name))
 
-    @property
-    def info_str(self) -> str:
-        if self._info_str is None:
-            self._info_str = subprocess.check_output(
-                shlex.split(JOB_INFO.format(self.jid))
-            ).decode("utf-8")
+    return _gpu_collector
 
-        return self._info_str
 
-    @property
-    def cpus(self):
-        cpus = CPU_REGEX.search(self.info_str)
-        return int(cpus.group("cpus"))
+def get_lab_resolver() -> LabResolver:
+    global _lab_resolver
+    if _lab_resolver is None:
+        _lab_resolver = LabResolver()
 
-    @property
-    def lab_name(self):
-        lab_name = ACCOUNT_REGEX.search(self.info_str)
-        return lab_name.group("account").strip()
+    return _lab_resolver
 
-    @property
-    def partition(self):
-        return PARTITION_REGEX.search(self.info_str).group("part").strip()
 
-    @property
-    def is_debug(self):
-        return self.partition.lower() == "debug"
+def get_spool() -> SnapshotSpool:
+    global _spool
+    with _spool_lock:
+        if _spool is None:
+            _spool = SnapshotSpool()
 
-    @property
-    def is_overcap(self):
-        return self.lab_name == "overcap"
+    return _spool
 
 
-def _get_lab_name_from_user_name(user_name: str) -> str:
-    res = (
-        subprocess.check_output(shlex.split(LAB_NAME_COMMAND.format(user_name)))
-        .decode("utf-8")
-        .strip()
-    )
+def node_monitor(last_fingerprint: Optional[str] = None) -> Optional[str]:
+    r"""Runs one monitor cycle.
 
-    accounts = res.split("|")
-    for acc in accounts:
-        acc = acc.strip()
-        if acc != "overcap":
-            return acc
-
-
-def get_lineage(pid):
-    ancestors = [pid]
-    ppid = pid
-    while not ppid == 1:
-        try:
-            ppid = int(
-                subprocess.check_output(shlex.split(f"ps -p {ppid} -oppid="))
-                .decode("utf-8")
-                .strip()
-            )
-        except subprocess.CalledProcessError:
-            return None
+    Returns the fingerprint of the state that is now in the database, to be
+    passed back in on the next cycle.  If the state hasn't changed since
+    then, only the update times are refreshed.
+    """
+    logger.info("Monitor Start")
 
-        ancestors.append(ppid)
-    return ancestors
+    state = collect_snapshot()
+    if state is not None:
+        # Spool first, so the snapshot isn't lost if the database is down
+        get_spool().append(state)
 
+    fingerprint = write_spooled_states(last_fingerprint)
 
-def is_gpu_state_same_and_all_in_use(node: Node, gpu2pid_info):
-    gpus = node.gpus
-    for gpu_id in sorted(gpu2pid_info.keys()):
-        if gpu_id >= len(gpus):
-            return False
+    logger.info("Monitor End")
 
-        gpu = gpus[gpu_id]
-        known_pids = {proc.id for proc in gpu.processes}
-        new_pids = set(gpu2pid_info[gpu_id])
+    return fingerprint
 
-        if known_pids != new_pids:
-            return False
 
-        if len(known_pids) == 0:
-            return False
+def collect_snapshot() -> Optional[NodeState]:
+    r"""collect_node_state, but errors are logged and give None.  The stats
+    of failed cycles are written with the next snapshot.
+    """
+    stats = CycleStats(node_name=os.uname()[1], start_time=time.time())
+    try:
+        return collect_node_state(stats)
+    except UnicodeDecodeError as e:
+        logger.error(str(e))
+    except OSError as e:
+        logger.error(str(e))
+    except subprocess.CalledProcessError as e:
+        logger.error(str(e))
+    except GPUCollectionError as e:
+        logger.error(str(e))
 
-    return True
+    if stats.failed_phase is None:
+        stats.failed_phase = "collect"
+    stats.duration = time.time() - stats.start_time
+    failed_cycles.append(stats)
 
+    return None
 
-def node_monitor():
-    logger.info("Monitor Start")
+
+def _discard_failed_cycles(written: List[CycleStats]):
+    r"""Removes the stats that were written.  The collector thread may have
+    appended more since, or pushed some of them out of the full deque.
+    """
+    for stats in written:
+        if len(failed_cycles) > 0 and failed_cycles[0] is stats:
+            failed_cycles.popleft()
+
+
+def write_spooled_states(last_fingerprint: Optional[str] = None) -> Optional[str]:
+    r"""Writes the newest spooled snapshot of every node to the database.
+
+    Returns the fingerprint of what is now in the database, or None if it
+    couldn't be written, in which case the snapshots stay spooled for the
+    next cycle.
+    """
+    states, marker = get_spool().pending()
+    if len(states) == 0:
+        return last_fingerprint
 
     try:
         session = SessionMaker()
     except sa.exc.OperationalError as e:
         logger.info("Got {} while trying to make DB session, exiting".format(e))
-        return
+        return None
+
+    num_statements = 0
+
+    def _count_statement(*args):
+        nonlocal num_statements
+        num_statements += 1
 
+    engine = session.get_bind()
+    sa.event.listen(engine, "before_cursor_execute", _count_statement)
+
+    fingerprint = None
+    cycles = []
     try:
-        do_node_monitor(session)
-    except UnicodeDecodeError as e:
-        logger.error(str(e))
-    except OSError as e:
-        logger.error(str(e))
-    except subprocess.CalledProcessError as e:
+        for state in states.values():
+            stats = (
+                state.stats
+                if state.stats is not None
+                else CycleStats(node_name=state.hostname, start_time=time.time())
+            )
+            num_statements = 0
+            start_time = time.time()
+
+            fingerprint = state.fingerprint()
+            if fingerprint == last_fingerprint:
+                logger.info("State same, only updating heartbeat")
+                write_heartbeat(session, state)
+                stats.phase_times["db_write"] = time.time() - start_time
+            else:
+                write_node_state_bulk(session, state, stats.phase_times)
+
+            stats.duration += time.time() - start_time
+            stats.num_statements = num_statements
+            cycles.append(stats)
+
+        get_spool().discard(marker)
+    except (sa.exc.SQLAlchemyError, subprocess.CalledProcessError) as e:
         logger.error(str(e))
+        session.rollback()
+        failed_cycles.append(
+            CycleStats(
+                node_name=os.uname()[1],
+                start_time=start_time,
+                duration=time.time() - start_time,
+                num_statements=num_statements,
+                failed_phase="db",
+            )
+        )
+        # Make sure the next cycle does a full write
+        fingerprint = None
     finally:
-        session.close()
+        sa.event.remove(engine, "before_cursor_execute", _count_statement)
 
-    logger.info("Monitor End")
+    try:
+        if fingerprint is not None:
+            failed = list(failed_cycles)
+            write_cycle_stats(session, failed + cycles)
+            _discard_failed_cycles(failed)
+    except sa.exc.SQLAlchemyError as e:
+        logger.error("Could not write cycle stats: {}".format(e))
+    finally:
+        session.close()
 
+    return fingerprint
 
-# Put this in a seperate function,
-# that way we can always do session.close()
-def do_node_monitor(session):
-    # Collect information about system health overall
-    hostname = os.uname()[1]
 
-    node = (
-        session.query(Node)
-        .filter_by(name=hostname)
-        .options(
-            sa.orm.joinedload(Node.gpus),
-            sa.orm.joinedload(Node.slurm_jobs),
-            sa.orm.joinedload(Node.gpus).joinedload("processes"),
-            sa.orm.joinedload(Node.slurm_jobs).joinedload("processes"),
-        )
-        .first()
-    )
-    if node is None:
-        node = Node(name=hostname)
-        session.add(node)
+def push_spooled_states(push_url: str) -> bool:
+    r"""Sends the newest spooled snapshots, and the stats of failed cycles,
+    to an ingest server instead of writing them to the database.
 
-    # Init container variables
-    gpu_info = {}
+    Returns whether they were accepted; if not they stay spooled.
+    """
+    from gpu_use.ingest.client import load_token, push_states
 
-    # Process info containers
-    gpu2pid_info = {}
-    pid2job_info = {}
-    pid2user_info = {}
+    states, marker = get_spool().pending()
+    cycles = list(failed_cycles)
+    if len(states) == 0 and len(cycles) == 0:
+        return True
 
-    logger.info("Querying nvidia-smi")
-    pids = []
-    smi_out = subprocess.check_output(shlex.split(gpu_command)).decode("utf-8")
-    logger.info("Done query nvidia-smi")
+    try:
+        push_states(push_url, list(states.values()), cycles, token=load_token())
+    except OSError as e:
+        logger.error("Could not push snapshots to {}: {}".format(push_url, e))
+        return False
 
-    # some nodes have a weird GPU order according to CUDA, so
-    # we need to re-order nvidia-smi
-    gpu_order_mapping = NODE_GPU_ORDER.get(
-        hostname, {smi_id: cuda_id for cuda_id, smi_id in enumerate(range(8))}
-    )
-    gpu_xml = etree.fromstring(smi_out)  # nvidia-smi
-    for gpu in gpu_xml.findall("gpu"):
-        gpu_id = int(gpu.find("minor_number").text)
-        gpu_id = gpu_order_mapping[gpu_id]
-        procs = []
-        for p in gpu.find("processes").findall("process_info"):
-            if p.find("used_memory").text == "0 MiB":
-                continue
+    get_spool().discard(marker)
+    _discard_failed_cycles(cycles)
 
-            procs.append(int(p.find("pid").text))
+    return True
 
-        gpu2pid_info[gpu_id] = procs
-        pids.extend(gpu2pid_info[gpu_id])
 
-        if gpu_id not in (gpu.id for gpu in node.gpus):
-            gpu = GPU(id=gpu_id, node=node)
-            session.add(gpu)
+def sweep_orphans(force: bool = False) -> bool:
+    r"""Deletes users and labs that nothing refers to anymore.
 
-        gpu = [gpu for gpu in node.gpus if gpu.id == gpu_id][0]
+    Runs at most once every ORPHAN_SWEEP_INTERVAL unless forced.  Returns
+    whether a sweep ran.
+    """
+    global _next_orphan_sweep
 
-        gpu.update_time = datetime.datetime.now()
+    now = time.time()
+    if not force and now < _next_orphan_sweep:
+        return False
 
-    node.load = "{:.2f} / {:.2f} / {:.2f}".format(*os.getloadavg())
-    node.update_time = datetime.datetime.now()
-    session.commit()
+    _next_orphan_sweep = now + ORPHAN_SWEEP_INTERVAL
 
-    #  if is_gpu_state_same_and_all_in_use(node, gpu2pid_info):
-    #  logger.info("State same, exiting")
-    #  return
+    try:
+        session = SessionMaker()
+    except sa.exc.OperationalError as e:
+        logger.info("Got {} while trying to make DB session".format(e))
+        return False
 
-    logger.info("Querying slurm PIDs")
-    # Get jobid to pid mappings
     try:
-        slurm_pids = (
-            subprocess.check_output(shlex.split(listpids_command))
-            .decode("utf-8")
-            .strip()
-            .split("\n")[1:]
-        )  # job -> pid mappings
-    except subprocess.CalledProcessError as e:
+        delete_orphans(session)
+        session.commit()
+    except sa.exc.SQLAlchemyError as e:
         logger.error(str(e))
-        slurm_pids = []
+        return False
+    finally:
+        session.close()
+
+    return True
+
+
+def collect_node_state(stats: Optional[CycleStats] = None) -> Optional[NodeState]:
+    r"""Gathers the GPU, process and SLURM state of this node.
+
+    Returns None if the state can't be trusted this cycle.  Phase timings
+    go into stats, which is also attached to the returned state.
+    """
+    if stats is None:
+        stats = CycleStats(node_name=os.uname()[1], start_time=time.time())
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(_collect_node_state(stats))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+async def _gather(*aws):
+    # Unlike a plain gather, waits for everything to finish before raising, so
+    # nothing is left running when the loop is closed
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for res in results:
+        if isinstance(res, BaseException):
+            raise res
+
+    return results
+
+
+async def _timed(stats: CycleStats, phase: str, aw):
+    start_time = time.time()
+    try:
+        return await aw
+    except BaseException:
+        if stats.failed_phase is None:
+            stats.failed_phase = phase
+        raise
+    finally:
+        stats.phase_times[phase] = time.time() - start_time
 
-    logger.info("Done quering slurm PIDs")
 
+async def _list_slurm_pids() -> List[Dict[str, int]]:
+    cmd = shlex.split(listpids_command)
+    count_subprocess()
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE)
+    listpids_out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        logger.error(str(subprocess.CalledProcessError(proc.returncode, cmd)))
+        return []
+
+    # job -> pid mappings
+    slurm_pids = listpids_out.decode("utf-8").strip().split("\n")[1:]
     slurm_pids = [info.split() for info in slurm_pids]
-    slurm_pids = [dict(pid=int(info[0]), jid=int(info[1])) for info in slurm_pids]
-    slurm_pids = list(
-        filter(lambda info: osp.exists(environ_file.format(info["pid"])), slurm_pids)
-    )
+    return [dict(pid=int(info[0]), jid=int(info[1])) for info in slurm_pids]
 
-    # Get process info including who is running it
-    pid_list = ",".join(
-        set([str(y) for y in pids] + [str(info["pid"]) for info in slurm_pids])
-    )
-    pid2user = {}
-    if len(pid_list) > 0:
-        ps_info = (
-            subprocess.check_output(
-                shlex.split(pid_command + pid_list), stderr=subprocess.STDOUT
-            )
-            .decode("utf-8")
-            .strip()
-            .split("\n")
-        )
 
-        user_names_long = (
-            subprocess.check_output(
-                shlex.split(user_command + pid_list), stderr=subprocess.STDOUT
+def _add_user_info(
+    proc_table: ProcessTable, pid: int, pid2user_info: Dict[int, Any]
+) -> bool:
+    r"""Adds who is running pid to pid2user_info.  Returns False if the user
+    can't be trusted this cycle.
+    """
+    # There is a race between listing the processes
+    # and a process dying
+    proc_info = proc_table.info(pid)
+    if proc_info is None:
+        return True
+
+    try:
+        int(proc_info.user_name)
+        logger.info(
+            "Got integer only user ID {}, exiting to try again later".format(
+                proc_info.user_name
             )
-            .decode("utf-8")
-            .strip()
-            .split("\n")
         )
+        return False
+    except ValueError:
+        pass
 
-        for line in user_names_long:
-            line = line.strip()
-            if len(line) == 0:
-                continue
+    proc_info.user_name = proc_info.user_name[0:32]
+    pid2user_info[pid] = proc_info
+    return True
 
-            pid, user = line.split(" ")
-            try:
-                int(user)
-                logger.info(
-                    "Got integer only user ID {}, exiting to try again later".format(
-                        user
-                    )
-                )
-                return
-            except ValueError:
-                pass
-
-            pid2user[int(pid)] = user
-    else:
-        ps_info = []
-
-    all_pids = set()
-
-    for info_line in ps_info:
-        info = info_line.split(",:,")
-        pid = int(info[0])
-        # There is a race between getting the long user-name
-        # and a process dying
-        if pid in pid2user:
-            all_pids.add(pid)
-            pid2user_info[pid] = ProcInfo(
-                pid, int(info[1]), info[2], info[3], pid2user[pid].strip()[0:32]
-            )
 
-    jid2job_info = dict()
-    gpu2job_info = dict()
-    slurm_pids.sort(key=lambda v: v["pid"])
+async def _collect_slurm_state(stats: CycleStats) -> Optional[Tuple]:
+    r"""The SLURM processes, the process table, the users of the SLURM
+    processes, their environments and the metadata of their jobs.  Each step
+    starts as soon as what it needs is there.
 
-    for info in slurm_pids:
-        pid = info["pid"]
-        jid = info["jid"]
-        if pid not in all_pids:
-            continue
+    Returns None if the state can't be trusted this cycle.
+    """
+    loop = asyncio.get_event_loop()
 
-        pid2job_info[pid] = jid
-        jid2job_info[jid] = JobInfo(jid=jid, user_name=pid2user_info[pid].user_name)
+    slurm_pids, proc_table = await _gather(
+        _timed(stats, "listpids", _list_slurm_pids()),
+        _timed(stats, "proc_table", loop.run_in_executor(None, ProcessTable.snapshot)),
+    )
 
-        if osp.exists(environ_file.format(pid)):
-            p_environ = (
-                subprocess.check_output(
-                    print_environ_file_command.format(environ_file.format(pid)),
-                    shell=True,
-                )
-                .decode("utf-8")
-                .split("\n")
-            )
-            cuda_devices = list(
-                filter(lambda var: var.startswith("CUDA_VISIBLE_DEVICES="), p_environ)
-            )
-            if len(cuda_devices) == 0:
-                continue
+    job_cache.evict(info["jid"] for info in slurm_pids)
 
-            cuda_devices = cuda_devices[0].split("=")[1].strip()
-            if cuda_devices == "NoDevFiles":
-                continue
+    slurm_pids = list(filter(lambda info: info["pid"] in proc_table, slurm_pids))
+    slurm_pids.sort(key=lambda v: v["pid"])
 
-            if cuda_devices == "":
-                continue
+    pid2user_info = {}
+    for info in slurm_pids:
+        if not _add_user_info(proc_table, info["pid"], pid2user_info):
+            return None
 
-            for gpu_id in cuda_devices.split(","):
-                gpu_id = int(gpu_id)
-                gpu2job_info[gpu_id] = jid2job_info[jid]
+    # Jobs we haven't seen before are all looked up with a single SLURM call
+    # while the environments are being read
+    slurm_environs, jid2metadata = await _gather(
+        _timed(
+            stats,
+            "environ",
+            loop.run_in_executor(
+                None,
+                environ_reader.read_many,
+                {
+                    info["pid"]: proc_table.start_time(info["pid"])
+                    for info in slurm_pids
+                    if info["pid"] in pid2user_info
+                },
+            ),
+        ),
+        _timed(
+            stats,
+            "jobs",
+            loop.run_in_executor(
+                None,
+                job_cache.get,
+                {info["jid"] for info in slurm_pids if info["pid"] in pid2user_info},
+            ),
+        ),
+    )
+
+    return slurm_pids, proc_table, pid2user_info, slurm_environs, jid2metadata
 
-        else:
-            all_pids.remove(pid)
 
-    existing_users = {user.name: user for user in session.query(User).all()}
-    existing_labs = {lab.name: lab for lab in session.query(Lab).all()}
-    # Jobs can migrate between nodes, so we need to query all jobs!
-    existing_jobs = {job.job_id: job for job in session.query(SLURMJob).all()}
+async def _collect_node_state(stats: CycleStats) -> Optional[NodeState]:
+    loop = asyncio.get_event_loop()
+    hostname = os.uname()[1]
+    start_num_subprocesses = num_subprocesses()
+
+    # The SLURM side doesn't need the GPUs, so it runs alongside the GPU
+    # probe, which is usually the slowest
+    gpus, slurm_state = await _gather(
+        _timed(stats, "gpus", loop.run_in_executor(None, get_gpu_collector().collect)),
+        _collect_slurm_state(stats),
+    )
+    if slurm_state is None:
+        return None
 
-    def _get_lab(lab_name):
-        if lab_name not in existing_labs:
-            lab = Lab(name=lab_name)
-            logger.info("Adding lab {}".format(lab_name))
-            session.add(lab)
-            existing_labs[lab_name] = lab
+    slurm_pids, proc_table, pid2user_info, slurm_environs, jid2metadata = slurm_state
 
-        return existing_labs[lab_name]
+    # Process info containers
+    gpu2pid_info = {}
+    pid2job_info = {}
 
-    for job_info in gpu2job_info.values():
-        user_name = job_info.user_name
-        if user_name not in existing_users:
-            logger.info("Adding user {}".format(user_name))
-            user = User(name=user_name)
-            session.add(user)
+    # some nodes have a weird GPU order according to CUDA, so
+    # we need to re-order nvidia-smi
+    gpu_order_mapping = NODE_GPU_ORDER.get(
+        hostname, {smi_id: cuda_id for cuda_id, smi_id in enumerate(range(8))}
+    )
+    pids = []
+    for gpu in gpus:
+        gpu_id = gpu_order_mapping.get(gpu.minor_number, gpu.minor_number)
+        procs = []
+        for p in gpu.processes:
+            if p.used_memory == 0:
+                continue
 
-            user.lab = _get_lab(_get_lab_name_from_user_name(user_name))
+            procs.append(p.pid)
 
-            existing_users[user_name] = user
+        gpu2pid_info[gpu_id] = procs
+        pids.extend(gpu2pid_info[gpu_id])
 
-        user = existing_users[user_name]
+    load = "{:.2f} / {:.2f} / {:.2f}".format(*os.getloadavg())
 
-        job_info.user = user
-        job_info.lab = user.lab
+    # Get process info including who is running it
+    for pid in set(pids) - set(pid2user_info.keys()):
+        if not _add_user_info(proc_table, pid, pid2user_info):
+            return None
 
-        if user not in node.users:
-            logger.info("Adding user {} to node {}".format(user.name, node.name))
-            node.users.append(user)
+    all_pids = set(pid2user_info.keys())
 
-    existing_processes = {
-        (proc.id, proc.node_name, proc.gpu_id): proc
-        for gpu in node.gpus
-        for proc in gpu.processes
-    }
+    jid2job_info = dict()
+    gpu2job_info = dict()
+    for info in slurm_pids:
+        pid = info["pid"]
+        jid = info["jid"]
+        if pid not in all_pids:
+            continue
 
-    def _add_job(job_info: JobInfo):
-        jid = job_info.jid
-        user = job_info.user
-        if jid not in existing_jobs:
-            job = SLURMJob(
-                job_id=jid,
-                node=node,
-                user=user,
-                is_debug_job=job_info.is_debug,
-                is_overcap_job=job_info.is_overcap,
+        pid2job_info[pid] = jid
+        if jid not in jid2job_info:
+            jid2job_info[jid] = JobInfo(
+                jid=jid,
+                user_name=pid2user_info[pid].user_name,
+                metadata=jid2metadata[jid],
             )
-            job.cpus = job_info.cpus
 
-            session.add(job)
-            existing_jobs[jid] = job
+        p_environ = slurm_environs[pid]
+        if p_environ is None:
+            all_pids.remove(pid)
+            continue
 
-        job = existing_jobs[jid]
-        job.node = node
-        job.user = user
-        job.lab = user.lab
+        cuda_devices = p_environ.get("CUDA_VISIBLE_DEVICES")
+        if cuda_devices is None:
+            continue
 
-        return job
+        cuda_devices = cuda_devices.strip()
+        if cuda_devices == "NoDevFiles":
+            continue
 
-    new_processes = []
+        if cuda_devices == "":
+            continue
 
-    for gpu_id in sorted(gpu2pid_info.keys()):
-        gpu = [gpu for gpu in node.gpus if gpu.id == gpu_id][0]
-
-        if gpu_id in gpu2job_info:
-            job_info = gpu2job_info[gpu_id]
-            gpu.slurm_job = _add_job(job_info)
-            gpu.user = job_info.user
-            gpu.user_name = job_info.user.name
-            gpu.lab = job_info.lab
-        else:
-            gpu.slurm_job = None
-            gpu.user = None
-            gpu.user_name = None
-            gpu.lab = None
+        for gpu_id in cuda_devices.split(","):
+            gpu_id = int(gpu_id)
+            gpu2job_info[gpu_id] = jid2job_info[jid]
 
+    lineage_start_time = time.time()
+    pid2job_id = {}
+    for gpu_id in sorted(gpu2pid_info.keys()):
         for pid in gpu2pid_info[gpu_id]:
             if pid not in all_pids:
                 continue
 
-            ancestors = get_lineage(pid)
+            ancestors = proc_table.lineage(pid)
             if ancestors is None:
                 logger.error("{} has no ancestors".format(pid))
                 continue
 
-            if (pid, hostname, gpu_id) in existing_processes:
-                proc = existing_processes[(pid, hostname, gpu_id)]
-            else:
-                proc = GPUProcess(id=pid, gpu=gpu)
-                new_processes.append(proc)
-
             job_ids = list(
                 {pid2job_info[i] for i in ancestors if i in pid2job_info.keys()}
             )
@@ -470,110 +539,61 @@ def do_node_monitor(session):
                     "More than 1 job ID for a process: {}".format(job_ids)
                 )
 
-            if len(job_ids) == 1:
-                jid = job_ids[0]
-                slurm_job = _add_job(jid2job_info[jid])
-            else:
-                slurm_job = None
-
-            cmnd = pid2user_info[pid].command[0:128]
-
-            user_name = pid2user_info[pid].user_name
-
-            # The first time we see a DOCKER_USERS user,
-            # it is likely it is docker
-            # and running on the correct GPU, so just assign that
-            # We then keep that username till the end of time
-            DOCKER_USERS = {"root", "coc-admin", "docker", "dockerd"}
-            if (
-                proc.user_name is None
-                and user_name in DOCKER_USERS
-                and gpu.user_name is not None
-            ):
-                user_name = gpu.user_name
-            elif proc.user_name is not None and user_name in DOCKER_USERS:
-                user_name = proc.user_name
-
-            if user_name not in existing_users:
-                logger.info("Adding user {}".format(user_name))
-                user = User(name=user_name)
-                session.add(user)
-
-                lab_name = _get_lab_name_from_user_name(user_name)
-
-                lab = session.query(Lab).filter_by(name=lab_name).first()
-                if lab is None:
-                    lab = Lab(name=lab_name)
-                    logger.info("Adding lab {}".format(lab_name))
-                    session.add(lab)
-
-                user.lab = lab
-
-                existing_users[user_name] = user
-
-            user = existing_users[user_name]
-
-            if node not in user.nodes:
-                logger.info("Adding user {} to node {}".format(user.name, node.name))
-                user.nodes.append(node)
-
-            proc.user = user
-            proc.user_name = user_name
-            proc.lab = user.lab
-            proc.command = cmnd
-            proc.slurm_job = slurm_job
-
-    session.add_all(new_processes)
-    session.commit()
-
-    for proc in (
-        session.query(GPUProcess)
-        .filter(
-            (GPUProcess.node_name == hostname)
-            & sa.not_(GPUProcess.id.in_(list(all_pids)))
-        )
-        .all()
-    ):
-        logger.info("Removing process {} from node {}".format(proc.id, hostname))
-        session.delete(proc)
-
-    for job in (
-        session.query(SLURMJob)
-        .filter(
-            (SLURMJob.node_name == hostname)
-            & sa.not_(SLURMJob.job_id.in_(list(jid2job_info.keys())))
-        )
-        .all()
-    ):
-        logger.info("Removing job {} from node {}".format(job.job_id, hostname))
-        session.delete(job)
-
-    for user in (
-        session.query(User)
-        .filter(
-            User.nodes.any(Node.name == hostname)
-            & sa.not_(
-                User.slurm_jobs.any(SLURMJob.job_id.in_(list(jid2job_info.keys())))
-                | User.processes.any(GPUProcess.id.in_(list(all_pids)))
-            )
-        )
-        .all()
-    ):
-        logger.info("Removing user {} from node {}".format(user.name, hostname))
-        user.nodes.remove(node)
-
-    for user in (
-        session.query(User)
-        .filter(
-            sa.not_(User.nodes.any() | User.slurm_jobs.any() | User.processes.any())
+            pid2job_id[pid] = job_ids[0] if len(job_ids) == 1 else None
+
+    stats.phase_times["lineage"] = time.time() - lineage_start_time
+
+    user_names = {job_info.user_name for job_info in jid2job_info.values()} | {
+        pid2user_info[pid].user_name for pid in pid2job_id
+    }
+    lab_resolver = get_lab_resolver()
+    user2lab = await _timed(
+        stats,
+        "labs",
+        loop.run_in_executor(
+            None,
+            lambda: {
+                user_name: lab_resolver.lab_name(user_name) for user_name in user_names
+            },
+        ),
+    )
+
+    stats.duration = time.time() - stats.start_time
+    stats.num_subprocesses = num_subprocesses() - start_num_subprocesses
+    logger.info(
+        "Collected node state in {:.3f}s with {} subprocesses ({})".format(
+            stats.duration,
+            stats.num_subprocesses,
+            ", ".join(
+                "{} {:.3f}s".format(phase, secs)
+                for phase, secs in stats.phase_times.items()
+            ),
         )
-        .all()
-    ):
-        logger.info("Deleting user {}".format(user.name))
-        session.delete(user)
+    )
+
+    return NodeState(
+        hostname=hostname,
+        load=load,
+        gpu2pid_info=gpu2pid_info,
+        pid2user_info=pid2user_info,
+        pid2job_id=pid2job_id,
+        jid2job_info=jid2job_info,
+        gpu2job_info=gpu2job_info,
+        all_pids=all_pids,
+        user2lab=user2lab,
+        stats=stats,
+    )
 
-    for lab in session.query(Lab).filter(sa.not_(Lab.users.any())).all():
-        logger.info("Deleting lab {}".format(lab.name))
-        session.delete(lab)
 
-    session.commit()
+def write_heartbeat(session, state: NodeState, commit: bool = True):
+    r"""Marks the node and its GPUs as up to date without reconciling"""
+    now = datetime.datetime.now()
+    session.query(Node).filter_by(name=state.hostname).update(
+        {Node.load: state.load, Node.update_time: now}, synchronize_session=False
+    )
+    session.query(GPU).filter_by(node_name=state.hostname).update(
+        {GPU.update_time: now}, synchronize_session=False
+    )
+    touch_gpu_status(session, state.hostname)
+    if commit:
+        session.commit()
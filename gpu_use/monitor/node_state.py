@@ -0,0 +1,191 @@
+import hashlib
+from typing import Any, Dict, List, Optional, Set
+
+import attr
+
+from gpu_use.db.schema import User
+from gpu_use.monitor.cycle_stats import CycleStats
+from gpu_use.monitor.proc_table import ProcInfo
+from gpu_use.monitor.slurm import JobMetadata
+
+# Processes run by these users are most likely docker containers, which are
+# attributed to whoever has the GPU reserved
+DOCKER_USERS = {"root", "coc-admin", "docker", "dockerd"}
+
+
+def process_user_name(
+    user_name: str, gpu_user_name: Optional[str], known_user_name: Optional[str]
+) -> str:
+    r"""Who a process of user_name on a GPU reserved by gpu_user_name is
+    attributed to, known_user_name being who it was attributed to before.
+
+    The first time we see a DOCKER_USERS user, it is likely docker running on
+    the correct GPU, so it is assigned to the GPU's user.  We then keep that
+    user name till the end of time.
+    """
+    if user_name not in DOCKER_USERS:
+        return user_name
+
+    if known_user_name is not None:
+        return known_user_name
+
+    if gpu_user_name is not None:
+        return gpu_user_name
+
+    return user_name
+
+
+@attr.s(auto_attribs=True)
+class JobInfo:
+    jid: int
+    user_name: str
+    user: User = None
+
+    metadata: JobMetadata = None
+
+    @property
+    def cpus(self):
+        return self.metadata.cpus
+
+    @property
+    def lab_name(self):
+        return self.metadata.account
+
+    @property
+    def partition(self):
+        return self.metadata.partition
+
+    @property
+    def is_debug(self):
+        return self.partition.lower() == "debug"
+
+    @property
+    def is_overcap(self):
+        return self.lab_name == "overcap"
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class NodeState:
+    r"""Everything collected about a node in one cycle, before touching the DB.
+
+    Snapshots are handed from the collector to the writer thread, so they
+    are frozen once collected.
+    """
+
+    hostname: str
+    load: str
+    gpu2pid_info: Dict[int, List[int]]
+    pid2user_info: Dict[int, ProcInfo]
+    # Job of every live GPU process, None for processes outside of SLURM
+    pid2job_id: Dict[int, Optional[int]]
+    jid2job_info: Dict[int, JobInfo]
+    gpu2job_info: Dict[int, JobInfo]
+    all_pids: Set[int]
+    # Resolved while collecting so that writing never needs to call SLURM
+    user2lab: Dict[str, Optional[str]] = attr.Factory(dict)
+    # How collecting this state went
+    stats: Optional[CycleStats] = None
+
+    def fingerprint(self) -> str:
+        r"""Digest of everything that ends up in the database besides
+        update times and load.  Equal fingerprints mean there is nothing
+        to reconcile.
+        """
+        state = (
+            sorted(
+                (gpu_id, sorted(pid for pid in pids if pid in self.pid2job_id))
+                for gpu_id, pids in self.gpu2pid_info.items()
+            ),
+            sorted(
+                (
+                    pid,
+                    jid,
+                    self.pid2user_info[pid].user_name,
+                    self.pid2user_info[pid].command[0:128],
+                )
+                for pid, jid in self.pid2job_id.items()
+            ),
+            sorted(
+                (gpu_id, job_info.jid) for gpu_id, job_info in self.gpu2job_info.items()
+            ),
+            sorted(
+                (
+                    jid,
+                    job_info.user_name,
+                    # Account, partition and CPUs
+                    (
+                        attr.astuple(job_info.metadata)
+                        if job_info.metadata is not None
+                        else None
+                    ),
+                )
+                for jid, job_info in self.jid2job_info.items()
+            ),
+            sorted(self.all_pids),
+            sorted(self.user2lab.items()),
+        )
+
+        return hashlib.sha1(repr(state).encode("utf-8")).hexdigest()
+
+    def to_dict(self) -> Dict[str, Any]:
+        r"""A JSON serializable version of the state.  Integer keyed
+        dicts become lists of pairs, since JSON keys are always strings.
+        """
+        return dict(
+            hostname=self.hostname,
+            load=self.load,
+            gpu2pid_info=list(self.gpu2pid_info.items()),
+            pid2user_info=[attr.asdict(info) for info in self.pid2user_info.values()],
+            pid2job_id=list(self.pid2job_id.items()),
+            jobs=[
+                dict(
+                    jid=job_info.jid,
+                    user_name=job_info.user_name,
+                    metadata=(
+                        attr.asdict(job_info.metadata)
+                        if job_info.metadata is not None
+                        else None
+                    ),
+                )
+                for job_info in self.jid2job_info.values()
+            ],
+            gpu2jid=[
+                (gpu_id, job_info.jid) for gpu_id, job_info in self.gpu2job_info.items()
+            ],
+            all_pids=sorted(self.all_pids),
+            user2lab=self.user2lab,
+            stats=attr.asdict(self.stats) if self.stats is not None else None,
+        )
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> "NodeState":
+        jid2job_info = {
+            job["jid"]: JobInfo(
+                jid=job["jid"],
+                user_name=job["user_name"],
+                metadata=(
+                    JobMetadata(**job["metadata"])
+                    if job["metadata"] is not None
+                    else None
+                ),
+            )
+            for job in state["jobs"]
+        }
+        return cls(
+            hostname=state["hostname"],
+            load=state["load"],
+            gpu2pid_info={gpu_id: pids for gpu_id, pids in state["gpu2pid_info"]},
+            pid2user_info={
+                info["pid"]: ProcInfo(**info) for info in state["pid2user_info"]
+            },
+            pid2job_id={pid: jid for pid, jid in state["pid2job_id"]},
+            jid2job_info=jid2job_info,
+            gpu2job_info={
+                gpu_id: jid2job_info[jid] for gpu_id, jid in state["gpu2jid"]
+            },
+            all_pids=set(state["all_pids"]),
+            user2lab=state["user2lab"],
+            stats=(
+                CycleStats(**state["stats"]) if state["stats"] is not None else None
+            ),
+        )
@@ -0,0 +1,170 @@
+import os
+import pwd
+from os import path as osp
+from typing import Dict, List, Optional
+
+import attr
+
+PROC_ROOT = "/proc"
+
+
+@attr.s(auto_attribs=True)
+class ProcInfo:
+    pid: int
+    ppid: int
+    command: str
+    start_time: int
+    user_name: str
+
+
+# Only names that were found, a miss may be NSS or LDAP failing for a moment
+_uid2user_name: Dict[int, str] = {}
+
+
+def _uid_to_user_name(uid: int) -> str:
+    # Mirrors ps, which prints the numeric uid when the name can't be resolved
+    if uid not in _uid2user_name:
+        try:
+            _uid2user_name[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            return str(uid)
+
+    return _uid2user_name[uid]
+
+
+def _read_file(fname: str, mode: str = "rt") -> Optional[str]:
+    try:
+        with open(fname, mode) as f:
+            return f.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+
+
+class ProcessTable:
+    r"""A snapshot of the process table read directly from /proc.
+
+    Every /proc/<pid>/stat is read once when the snapshot is taken so that
+    parents and ancestor chains can be answered from memory.  The status and
+    cmdline files are only needed for the handful of processes we report on,
+    so those are read on first access and then memoized.
+    """
+
+    def __init__(self, proc_root: str = PROC_ROOT):
+        self.proc_root = proc_root
+        self._stats: Dict[int, List[str]] = {}
+        self._infos: Dict[int, Optional[ProcInfo]] = {}
+
+        for entry in os.listdir(proc_root):
+            if not entry.isdigit():
+                continue
+
+            stat = self._read_stat(int(entry))
+            if stat is not None:
+                self._stats[int(entry)] = stat
+
+    @classmethod
+    def snapshot(cls, proc_root: str = PROC_ROOT) -> "ProcessTable":
+        return cls(proc_root)
+
+    def _read_stat(self, pid: int) -> Optional[List[str]]:
+        stat = _read_file(osp.join(self.proc_root, str(pid), "stat"))
+        if stat is None:
+            return None
+
+        # The command name is wrapped in parens and can itself contain
+        # spaces and parens, so split around the last closing paren
+        comm_start = stat.find("(")
+        comm_end = stat.rfind(")")
+        if comm_start == -1 or comm_end == -1:
+            return None
+
+        return [stat[comm_start + 1 : comm_end]] + stat[comm_end + 2 :].split()
+
+    def __contains__(self, pid: int) -> bool:
+        return pid in self._stats
+
+    def __len__(self) -> int:
+        return len(self._stats)
+
+    @property
+    def pids(self) -> List[int]:
+        return sorted(self._stats.keys())
+
+    def ppid(self, pid: int) -> Optional[int]:
+        if pid not in self._stats:
+            return None
+
+        return int(self._stats[pid][2])
+
+    def start_time(self, pid: int) -> Optional[int]:
+        r"""Start time of the process in clock ticks after boot"""
+        if pid not in self._stats:
+            return None
+
+        return int(self._stats[pid][20])
+
+    def lineage(self, pid: int) -> Optional[List[int]]:
+        r"""The process and all its ancestors, ending at init.
+
+        Returns None if the chain is broken, i.e. the process or one of its
+        ancestors exited before the snapshot was taken.
+        """
+        ancestors = [pid]
+        ppid = pid
+        while ppid != 1:
+            ppid = self.ppid(ppid)
+            if ppid is None or ppid in ancestors:
+                return None
+
+            # Processes whose parent is outside our pid namespace report 0
+            if ppid == 0:
+                break
+
+            ancestors.append(ppid)
+
+        return ancestors
+
+    def uid(self, pid: int) -> Optional[int]:
+        status = _read_file(osp.join(self.proc_root, str(pid), "status"))
+        if status is None:
+            return None
+
+        for line in status.split("\n"):
+            if line.startswith("Uid:"):
+                # Real, effective, saved, filesystem.  ps reports the effective
+                return int(line.split()[2])
+
+        return None
+
+    def command(self, pid: int) -> Optional[str]:
+        cmdline = _read_file(osp.join(self.proc_root, str(pid), "cmdline"), "rb")
+        if cmdline is None:
+            return None
+
+        args = [arg.decode("utf-8", "replace") for arg in cmdline.split(b"\0")]
+        command = " ".join(arg for arg in args if len(arg) > 0)
+        if len(command) == 0:
+            # Kernel threads and zombies have no cmdline, ps shows [comm]
+            command = "[{}]".format(self._stats[pid][0])
+
+        return command
+
+    def info(self, pid: int) -> Optional[ProcInfo]:
+        if pid not in self._stats:
+            return None
+
+        if pid not in self._infos:
+            uid = self.uid(pid)
+            command = self.command(pid)
+            if uid is None or command is None:
+                self._infos[pid] = None
+            else:
+                self._infos[pid] = ProcInfo(
+                    pid=pid,
+                    ppid=self.ppid(pid),
+                    command=command,
+                    start_time=self.start_time(pid),
+                    user_name=_uid_to_user_name(uid),
+                )
+
+        return self._infos[pid]
@@ -0,0 +1,98 @@
+import math
+import random
+import time
+from typing import Callable, Optional
+
+DEFAULT_INTERVAL = 60
+# How often to poll right after something changed on the node, e.g. a job
+# starting, so that its other processes show up quickly
+FAST_INTERVAL = 10
+FAST_PERIOD = 2 * 60
+# The interval doubles after this many cycles without a change...
+BACKOFF_CYCLES = 10
+# ...up to this.  By default stable nodes keep polling every DEFAULT_INTERVAL,
+# so backing off is opt-in.  The CLI considers nodes out of date after 10
+# minutes, so anything above 4 minutes risks them dropping out after a
+# missed cycle
+MAX_INTERVAL = DEFAULT_INTERVAL
+
+
+class PollScheduler:
+    r"""Decides when the next monitor cycle runs.
+
+    Cycles run on a fixed grid of ticks, so the time a cycle takes doesn't
+    push back the ones after it, and ticks that were missed because a cycle
+    overran are skipped rather than run back to back.  The grid starts at a
+    random phase, so that the daemons of a whole cluster don't all hit the
+    database in the same second.
+
+    After the node's fingerprint changes, it polls every FAST_INTERVAL for
+    FAST_PERIOD.  Once the fingerprint has been stable for BACKOFF_CYCLES
+    cycles, the interval doubles, up to max_interval.  That defaults to
+    MAX_INTERVAL, the same as interval, so there is no backoff unless
+    max_interval is raised.
+    """
+
+    def __init__(
+        self,
+        interval: float = DEFAULT_INTERVAL,
+        fast_interval: float = FAST_INTERVAL,
+        fast_period: float = FAST_PERIOD,
+        backoff_cycles: int = BACKOFF_CYCLES,
+        max_interval: float = MAX_INTERVAL,
+        phase: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.fast_period = fast_period
+        self.backoff_cycles = backoff_cycles
+        self.max_interval = max_interval
+        self.clock = clock
+
+        if phase is None:
+            phase = random.uniform(0, interval)
+
+        self._next_tick = self.clock() + phase
+        self._fast_until = None
+        self._stable_cycles = 0
+        self._last_fingerprint = None
+
+    @property
+    def current_interval(self) -> float:
+        if self._fast_until is not None and self.clock() < self._fast_until:
+            return self.fast_interval
+
+        num_backoffs = self._stable_cycles // self.backoff_cycles
+        return min(self.interval * 2**num_backoffs, self.max_interval)
+
+    def record(self, fingerprint: Optional[str]):
+        r"""Records the fingerprint the last cycle returned.
+
+        None means the cycle failed, which doesn't count as stable, but
+        doesn't speed up polling either.
+        """
+        if fingerprint is None:
+            self._stable_cycles = 0
+        elif fingerprint == self._last_fingerprint:
+            self._stable_cycles += 1
+        else:
+            if self._last_fingerprint is not None:
+                self._fast_until = self.clock() + self.fast_period
+
+            self._stable_cycles = 0
+
+        self._last_fingerprint = fingerprint
+
+        interval = self.current_interval
+        now = self.clock()
+        self._next_tick += interval
+        if self._next_tick < now:
+            self._next_tick += math.ceil((now - self._next_tick) / interval) * interval
+
+    def delay(self) -> float:
+        r"""Seconds until the next cycle should start"""
+        return max(self._next_tick - self.clock(), 0.0)
+
+    def wait(self):
+        time.sleep(self.delay())
@@ -0,0 +1,108 @@
+import logging
+import re
+import shlex
+import subprocess
+from typing import Dict, Iterable, Optional
+
+import attr
+
+from gpu_use.monitor.cycle_stats import count_subprocess
+
+ACCOUNT_REGEX = re.compile(r"Account=(?P<account>\w.*?)\s")
+PARTITION_REGEX = re.compile(r"Partition=(?P<part>\w.*?)\s")
+CPU_REGEX = re.compile(r"cpu=(?P<cpus>\d+)")
+
+JOB_INFO = "scontrol show job {}"
+# %A is the raw job id, also for elements of job arrays
+NODE_JOBS_INFO = "squeue --noheader --nodelist={} --format=%A|%a|%P|%C"
+
+logger = logging.getLogger("gpu-used")
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class JobMetadata:
+    jid: int
+    account: str
+    partition: str
+    cpus: int
+
+    @classmethod
+    def from_scontrol(cls, jid: int, info_str: str) -> "JobMetadata":
+        return cls(
+            jid=jid,
+            account=ACCOUNT_REGEX.search(info_str).group("account").strip(),
+            partition=PARTITION_REGEX.search(info_str).group("part").strip(),
+            cpus=int(CPU_REGEX.search(info_str).group("cpus")),
+        )
+
+    @classmethod
+    def from_squeue(cls, line: str) -> "JobMetadata":
+        jid, account, partition, cpus = line.strip().split("|")
+        return cls(jid=int(jid), account=account, partition=partition, cpus=int(cpus))
+
+
+def parse_squeue(squeue_out: str) -> Dict[int, JobMetadata]:
+    jobs = {}
+    for line in squeue_out.split("\n"):
+        if len(line.strip()) == 0:
+            continue
+
+        job = JobMetadata.from_squeue(line)
+        jobs[job.jid] = job
+
+    return jobs
+
+
+class SLURMJobCache:
+    r"""Node-local cache of job metadata keyed by job id.
+
+    Jobs that aren't in the cache yet are all fetched with a single squeue
+    call listing every job on this node.  Anything squeue didn't return (e.g.
+    because the job started in between) falls back to `scontrol show job`.
+    """
+
+    def __init__(self, hostname: str):
+        self.hostname = hostname
+        self._jobs: Dict[int, JobMetadata] = {}
+
+    def __contains__(self, jid: int) -> bool:
+        return jid in self._jobs
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def _fetch_node_jobs(self) -> Dict[int, JobMetadata]:
+        count_subprocess()
+        try:
+            squeue_out = subprocess.check_output(
+                shlex.split(NODE_JOBS_INFO.format(self.hostname))
+            ).decode("utf-8")
+        except subprocess.CalledProcessError as e:
+            logger.error(str(e))
+            return {}
+
+        return parse_squeue(squeue_out)
+
+    def _fetch_job(self, jid: int) -> JobMetadata:
+        count_subprocess()
+        info_str = subprocess.check_output(shlex.split(JOB_INFO.format(jid))).decode(
+            "utf-8"
+        )
+        return JobMetadata.from_scontrol(jid, info_str)
+
+    def get(self, jids: Iterable[int]) -> Dict[int, JobMetadata]:
+        jids = set(jids)
+        missing = jids - set(self._jobs.keys())
+        if len(missing) > 0:
+            logger.info("Fetching metadata for jobs {}".format(sorted(missing)))
+            self._jobs.update(self._fetch_node_jobs())
+
+            for jid in sorted(missing - set(self._jobs.keys())):
+                self._jobs[jid] = self._fetch_job(jid)
+
+        return {jid: self._jobs[jid] for jid in jids}
+
+    def evict(self, active_jids: Iterable[int]):
+        r"""Forget jobs that no longer have processes on this node"""
+        active_jids = set(active_jids)
+        self._jobs = {jid: job for jid, job in self._jobs.items() if jid in active_jids}
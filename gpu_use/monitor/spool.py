@@ -0,0 +1,166 @@
+import copy
+import json
+import logging
+import os
+import threading
+from os import path as osp
+from typing import Dict, List, Set, Tuple
+
+import attr
+
+from gpu_use.monitor.node_state import NodeState
+
+DEFAULT_SPOOL_PATH = "/var/lib/gpu-use/spool.jsonl"
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+logger = logging.getLogger("gpu-used")
+
+
+class SnapshotSpool:
+    r"""Journal of collected node states that haven't been written to the
+    database yet.
+
+    The newest snapshot per node is kept in memory, so draining after an
+    outage costs one write per node no matter how many cycles were missed.
+    While writes keep up, snapshots never touch the file; once one is still
+    pending when the next comes in, both are appended to it.  The file is
+    compacted down to the newest snapshots whenever it would grow past
+    max_bytes, and truncated once everything has been written.
+
+    If the spool file can't be written, snapshots are only kept in memory.
+    """
+
+    def __init__(
+        self, path: str = DEFAULT_SPOOL_PATH, max_bytes: int = DEFAULT_MAX_BYTES
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._newest: Dict[str, Tuple[int, NodeState]] = {}
+        # Hosts whose newest snapshot isn't in the file
+        self._unsaved: Set[str] = set()
+        self._seq = 0
+        try:
+            for seq, state in self._read_entries():
+                self._add(seq, state)
+            self._on_disk = osp.getsize(self.path) > 0
+        except OSError:
+            self._on_disk = False
+
+    def _read_entries(self) -> List[Tuple[int, NodeState]]:
+        entries = []
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Torn write from a crash, everything before it is
+                        # still good
+                        break
+
+                    try:
+                        entry = json.loads(line.decode("utf-8"))
+                        entries.append(
+                            (entry["seq"], NodeState.from_dict(entry["state"]))
+                        )
+                    except (ValueError, KeyError, TypeError) as e:
+                        logger.error("Skipping bad spool entry: {}".format(e))
+        except FileNotFoundError:
+            pass
+
+        return entries
+
+    def _add(self, seq: int, state: NodeState):
+        if state.hostname not in self._newest or self._newest[state.hostname][0] < seq:
+            self._newest[state.hostname] = (seq, state)
+        self._seq = max(self._seq, seq)
+
+    def _rewrite(self, lines):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self.path)
+
+    def _save_newest(self):
+        self._rewrite([self._encode(seq, st) for seq, st in self._newest.values()])
+        self._unsaved = set()
+        self._on_disk = True
+
+    @staticmethod
+    def _encode(seq: int, state: NodeState) -> bytes:
+        return (json.dumps(dict(seq=seq, state=state.to_dict())) + "\n").encode("utf-8")
+
+    def append(self, state: NodeState):
+        with self._lock:
+            self._seq += 1
+            caught_up = len(self._newest) == 0 and not self._on_disk
+            self._newest[state.hostname] = (self._seq, state)
+            self._unsaved.add(state.hostname)
+            if caught_up:
+                # Everything before was written, so this one most likely will
+                # be too
+                return
+
+            lines = [
+                self._encode(*self._newest[hostname]) for hostname in self._unsaved
+            ]
+            try:
+                os.makedirs(osp.dirname(self.path), exist_ok=True)
+                size = osp.getsize(self.path) if osp.exists(self.path) else 0
+                if size + sum(len(line) for line in lines) > self.max_bytes:
+                    logger.info(
+                        "Compacting spool to {} snapshots".format(len(self._newest))
+                    )
+                    self._save_newest()
+                    return
+
+                with open(self.path, "ab") as f:
+                    f.writelines(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._unsaved = set()
+                self._on_disk = True
+            except OSError as e:
+                logger.error("Could not append to spool: {}".format(e))
+
+    def pending(self) -> Tuple[Dict[str, NodeState], int]:
+        r"""Returns the newest spooled snapshot of every node, and a marker to
+        pass to discard once they have been written.
+        """
+        with self._lock:
+            # Writers fill in the stats, which mustn't stick if the write fails
+            return (
+                {
+                    hostname: attr.evolve(state, stats=copy.deepcopy(state.stats))
+                    for hostname, (_, state) in self._newest.items()
+                },
+                self._seq,
+            )
+
+    def discard(self, marker: int):
+        r"""Removes everything that was spooled before pending returned marker"""
+        with self._lock:
+            num_pending = len(self._newest)
+            self._newest = {
+                hostname: (seq, state)
+                for hostname, (seq, state) in self._newest.items()
+                if seq > marker
+            }
+            self._unsaved &= set(self._newest)
+            if not self._on_disk or len(self._newest) == num_pending:
+                return
+
+            try:
+                if len(self._newest) == 0:
+                    os.truncate(self.path, 0)
+                    self._on_disk = False
+                else:
+                    self._save_newest()
+            except OSError as e:
+                logger.error("Could not truncate spool: {}".format(e))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._newest)
@@ -0,0 +1,122 @@
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
+from gpu_use.monitor import monitor
+from gpu_use.monitor.node_state import NodeState
+
+DEFAULT_MAX_QUEUE_SIZE = 8
+
+logger = logging.getLogger("gpu-used")
+
+_STOP = object()
+
+
+class SnapshotWriter:
+    r"""Writes snapshots to the database on a background thread.
+
+    The collector hands snapshots over with submit, which spools them and
+    returns right away, so a slow commit or a lock wait never delays the
+    next sample.  The queue between the two is bounded: when it is full the
+    oldest entry is dropped.  Only the newest snapshot matters anyway, so
+    when the writer falls behind it skips straight to it.
+
+    With a push_url, snapshots are sent to an ingest server instead of
+    being written to the database directly.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+        push_url: Optional[str] = None,
+    ):
+        self.push_url = push_url
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(
+            target=self._run, name="gpu-use-writer", daemon=True
+        )
+        self.last_fingerprint: Optional[str] = None
+        # Seconds between collecting the newest snapshot and writing it
+        self.lag = 0.0
+        # Snapshots that were queued when the writer last woke up
+        self.last_queue_depth = 0
+        self.num_written = 0
+        self.num_dropped = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._put(_STOP)
+        self._thread.join()
+
+    def submit(self, state: NodeState):
+        monitor.get_spool().append(state)
+        self._put(time.time())
+
+    def _put(self, item):
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+
+            try:
+                self._queue.get_nowait()
+                self.num_dropped += 1
+            except queue.Empty:
+                pass
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            items = [self._queue.get()]
+            # Everything else that is queued is older than what the spool has
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = any(item is _STOP for item in items)
+            collected_ats = [item for item in items if item is not _STOP]
+            if len(collected_ats) == 0:
+                continue
+
+            self.last_queue_depth = len(collected_ats)
+            self.num_dropped += len(collected_ats) - 1
+            try:
+                self.write(max(collected_ats))
+            except Exception:
+                # Keep the thread alive, the snapshot is still spooled
+                logger.exception("Writing snapshot failed")
+
+    def write(self, collected_at: float):
+        if self.push_url is not None:
+            if not monitor.push_spooled_states(self.push_url):
+                return
+        else:
+            self.last_fingerprint = monitor.write_spooled_states(self.last_fingerprint)
+
+        self.lag = time.time() - collected_at
+        self.num_written += 1
+        logger.info(
+            "{} snapshot {:.3f}s after it was collected"
+            " (queue depth {}, {} dropped so far)".format(
+                "Pushed" if self.push_url is not None else "Wrote",
+                self.lag,
+                self.last_queue_depth,
+                self.num_dropped,
+            )
+        )
+
+        # The ingest server sweeps when pushing
+        if self.push_url is None:
+            monitor.sweep_orphans()
@@ -1,5 +1,4 @@
 import os
-import time
 
 from daemon.runner import DaemonRunner
 
@@ -28,15 +27,56 @@ class MonitorDaemon:
     stdout_path = "/var/log/gpu-used/gpu-used.log"
     stderr_path = "/var/log/gpu-used/gpu-used.log"
 
+    # Set either to export Prometheus metrics, see MetricsExporter
+    metrics_port = os.environ.get("GPU_USED_METRICS_PORT")
+    metrics_textfile = os.environ.get("GPU_USED_METRICS_TEXTFILE")
+    # Push snapshots to an ingest server instead of writing to the database,
+    # e.g. http://ingest-host:9743 or unix:///run/gpu-use/ingest.sock.  Over
+    # TCP, ingest_token from the config file is sent along
+    push_url = os.environ.get("GPU_USED_PUSH_URL")
+    # Seconds stable nodes may back off to between cycles, e.g. 240.  Unset,
+    # they keep polling every minute
+    max_interval = os.environ.get("GPU_USED_MAX_INTERVAL")
+
     def __init__(self):
         os.makedirs(os.path.dirname(self.stdout_path), exist_ok=True)
 
     def run(self):
-        from gpu_use.monitor.monitor import node_monitor
+        from gpu_use.db.engine import set_profile
+        from gpu_use.monitor.metrics import MetricsExporter
+        from gpu_use.monitor.monitor import collect_snapshot, get_gpu_collector
+        from gpu_use.monitor.scheduler import MAX_INTERVAL, PollScheduler
+        from gpu_use.monitor.writer import SnapshotWriter
+
+        set_profile("daemon")
+
+        # Pick the GPU backend once at startup
+        get_gpu_collector()
 
+        # Collection runs on schedule here, the database is written to by
+        # the writer's thread
+        writer = SnapshotWriter(push_url=self.push_url or None)
+        writer.start()
+
+        scheduler = PollScheduler(
+            max_interval=float(self.max_interval) if self.max_interval else MAX_INTERVAL
+        )
+        exporter = MetricsExporter(
+            port=int(self.metrics_port) if self.metrics_port else None,
+            textfile=self.metrics_textfile or None,
+            writer=writer,
+            scheduler=scheduler,
+        )
+        exporter.start()
         while True:
-            node_monitor()
-            time.sleep(60)
+            scheduler.wait()
+            state = collect_snapshot()
+            if state is not None:
+                writer.submit(state)
+
+            exporter.update(state)
+
+            scheduler.record(state.fingerprint() if state is not None else None)
 
 
 def run_daemon():
@@ -0,0 +1,21 @@
+import pytest
+
+from gpu_use.db import engine as engine_module
+from gpu_use.db.engine import make_engine
+from gpu_use.db.schema import create_schema
+
+
+@pytest.fixture
+def engine(tmpdir, monkeypatch):
+    r"""A SQLite database in WAL mode, which is also what SessionMaker uses
+    during the test.
+    """
+    engine = make_engine(
+        "daemon", config=dict(url="sqlite:///{}".format(tmpdir.join("gpu_use.db")))
+    )
+    create_schema(engine)
+    monkeypatch.setattr(engine_module, "_engine", engine)
+
+    yield engine
+
+    engine.dispose()
@@ -0,0 +1,232 @@
+import sqlite3
+
+import sqlalchemy as sa
+
+from gpu_use.db.engine import make_engine
+from gpu_use.db.schema import Base, create_schema
+from gpu_use.monitor import bulk_writer
+from gpu_use.monitor.bulk_writer import delete_orphans, write_node_state_bulk
+from gpu_use.monitor.node_state import JobInfo, NodeState
+from gpu_use.monitor.proc_table import ProcInfo
+from gpu_use.monitor.slurm import JobMetadata
+
+USER2LAB = {"alice": "lab-a", "bob": "lab-b", "root": "lab-a"}
+
+
+def _make_session():
+    engine = make_engine("daemon", config=dict(url="sqlite://"))
+    create_schema(engine)
+    return sa.orm.sessionmaker(bind=engine)()
+
+
+def _make_state(jid2user, gpu2jid, procs, hostname="node1"):
+    r"""procs is a list of (pid, gpu, jid, user_name)"""
+    jid2job_info = {
+        jid: JobInfo(
+            jid=jid,
+            user_name=user_name,
+            metadata=JobMetadata(
+                jid=jid, account=USER2LAB[user_name], partition="short", cpus=6
+            ),
+        )
+        for jid, user_name in jid2user.items()
+    }
+    gpu2pid_info = {gpu: [] for gpu in range(4)}
+    for pid, gpu, _, _ in procs:
+        gpu2pid_info[gpu].append(pid)
+
+    return NodeState(
+        hostname=hostname,
+        load="0.00 / 0.00 / 0.00",
+        gpu2pid_info=gpu2pid_info,
+        pid2user_info={
+            pid: ProcInfo(pid, 1, "python train.py", 0, user_name)
+            for pid, _, _, user_name in procs
+        },
+        pid2job_id={pid: jid for pid, _, jid, _ in procs},
+        jid2job_info=jid2job_info,
+        gpu2job_info={gpu: jid2job_info[jid] for gpu, jid in gpu2jid.items()},
+        all_pids={pid for pid, _, _, _ in procs},
+        user2lab=dict(USER2LAB),
+    )
+
+
+def _dump(session):
+    tables = {}
+    for table in Base.metadata.sorted_tables:
+        columns = [c for c in table.columns if not c.name.endswith("update_time")]
+        tables[table.name] = sorted(
+            session.execute(sa.select(columns)).fetchall(), key=str
+        )
+
+    return tables
+
+
+def test_bulk_writer_cycles():
+    states = [
+        _make_state(
+            {1: "alice", 2: "bob"},
+            {0: 1, 1: 1, 2: 2},
+            [(10, 0, 1, "alice"), (11, 1, 1, "alice"), (20, 2, 2, "root")],
+        ),
+        # bob's job ended, alice's job moved a process and a docker process
+        # showed up on her GPU
+        _make_state(
+            {1: "alice"},
+            {0: 1, 1: 1},
+            [(10, 0, 1, "alice"), (12, 1, 1, "alice"), (30, 1, 1, "root")],
+        ),
+        _make_state({}, {}, []),
+    ]
+    # GPUs as (id, job, user), processes as (pid, GPU, job, user), jobs and
+    # the users on the node.  Processes in a job are attributed to its user.
+    expected = [
+        (
+            [(0, 1, "alice"), (1, 1, "alice"), (2, 2, "bob"), (3, None, None)],
+            [(10, 0, 1, "alice"), (11, 1, 1, "alice"), (20, 2, 2, "bob")],
+            [1, 2],
+            ["alice", "bob"],
+        ),
+        (
+            [(0, 1, "alice"), (1, 1, "alice"), (2, None, None), (3, None, None)],
+            [(10, 0, 1, "alice"), (12, 1, 1, "alice"), (30, 1, 1, "alice")],
+            [1],
+            ["alice"],
+        ),
+        ([(gpu, None, None) for gpu in range(4)], [], [], []),
+    ]
+
+    bulk_session = _make_session()
+    for state, (gpus, processes, jobs, node_users) in zip(states, expected):
+        write_node_state_bulk(bulk_session, state)
+
+        tables = _dump(bulk_session)
+        assert [
+            (row.id, row.slurm_job_id, row.user_name) for row in tables["gpus"]
+        ] == gpus
+        assert [
+            (row.id, row.gpu_id, row.slurm_job_id, row.user_name)
+            for row in tables["gpu_processes"]
+        ] == processes
+        assert [row.job_id for row in tables["slurm_jobs"]] == jobs
+        assert [
+            row.user_name for row in tables["user_node_association_table"]
+        ] == node_users
+
+    # Users and labs are only garbage collected by the sweep
+    assert len(_dump(bulk_session)["users"]) > 0
+    delete_orphans(bulk_session)
+    bulk_session.commit()
+    assert _dump(bulk_session)["users"] == []
+    assert _dump(bulk_session)["labs"] == []
+
+
+def test_bulk_writer_skips_unchanged_rows():
+    state = _make_state(
+        {1: "alice"}, {0: 1}, [(10, 0, 1, "alice"), (11, 0, 1, "alice")]
+    )
+
+    session = _make_session()
+    write_node_state_bulk(session, state)
+
+    statements = []
+
+    def _count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sa.event.listen(session.get_bind(), "before_cursor_execute", _count)
+    write_node_state_bulk(session, state)
+
+    assert not any(s.startswith("INSERT") and "gpu_processes" in s for s in statements)
+    assert not any(s.startswith("INSERT") and "slurm_jobs" in s for s in statements)
+
+
+def test_users_and_labs_added_by_another_node(monkeypatch):
+    session = _make_session()
+    write_node_state_bulk(session, _make_state({1: "alice"}, {0: 1}, []))
+
+    # node2 read before node1 added alice and lab-a
+    select_in = bulk_writer._select_in
+
+    def _select_in(session, table, column, values):
+        if table.name in ("users", "labs"):
+            return []
+        return select_in(session, table, column, values)
+
+    monkeypatch.setattr(bulk_writer, "_select_in", _select_in)
+    write_node_state_bulk(
+        session, _make_state({2: "alice"}, {0: 2}, [], hostname="node2")
+    )
+
+    assert _dump(session)["users"] == [("alice", "lab-a")]
+    assert _dump(session)["labs"] == [("lab-a",)]
+
+
+class _CountingCursor(sqlite3.Cursor):
+    rows_read = 0
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _CountingCursor.rows_read += 1
+
+        return row
+
+    def fetchmany(self, *args):
+        rows = super().fetchmany(*args)
+        _CountingCursor.rows_read += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _CountingCursor.rows_read += len(rows)
+        return rows
+
+
+class _CountingConnection(sqlite3.Connection):
+    def cursor(self, *args):
+        return super().cursor(_CountingCursor)
+
+
+def _node_state(node_idx):
+    jid = 100 * node_idx
+    return _make_state(
+        {jid: "alice", jid + 1: "bob"},
+        {0: jid, 1: jid, 2: jid + 1},
+        [
+            (10, 0, jid, "alice"),
+            (11, 1, jid, "alice"),
+            (20, 2, jid + 1, "root"),
+        ],
+        hostname="node{}".format(node_idx),
+    )
+
+
+def _rows_read_per_cycle(num_nodes):
+    engine = sa.create_engine(
+        "sqlite://",
+        creator=lambda: sqlite3.connect(":memory:", factory=_CountingConnection),
+    )
+    Base.metadata.create_all(engine)
+    session = sa.orm.sessionmaker(bind=engine)()
+    for node_idx in range(num_nodes):
+        write_node_state_bulk(session, _node_state(node_idx))
+
+    # Something changes on node 0 every cycle
+    state = _node_state(0)
+    state.gpu2pid_info[3] = [30]
+    state.pid2user_info[30] = ProcInfo(30, 1, "python eval.py", 0, "bob")
+    state.pid2job_id[30] = None
+    state.all_pids.add(30)
+
+    _CountingCursor.rows_read = 0
+    write_node_state_bulk(session, state)
+    return _CountingCursor.rows_read
+
+
+def test_rows_read_do_not_grow_with_cluster():
+    small = _rows_read_per_cycle(num_nodes=5)
+    large = _rows_read_per_cycle(num_nodes=50)
+
+    assert small > 0
+    assert large == small
@@ -0,0 +1,73 @@
+import datetime
+
+from gpu_use.cli.cluster_state import (
+    ClusterState,
+    GPURecord,
+    JobRecord,
+    NodeRecord,
+    ProcessRecord,
+    is_user_on_gpu,
+)
+
+
+def _make_state():
+    now = datetime.datetime.now()
+    stale = now - datetime.timedelta(minutes=20)
+
+    return ClusterState(
+        nodes=[NodeRecord("node2", "", stale), NodeRecord("node1", "", now)],
+        jobs=[
+            JobRecord(1, "node1", "lab", "alice", 4, False, False),
+            JobRecord(2, "node1", "lab", "alice", 4, True, False),
+            JobRecord(3, "node2", "lab", "bob", 4, False, False),
+        ],
+        gpus=[
+            GPURecord(1, "node1", 2, "lab", "alice", now),
+            GPURecord(0, "node1", 1, "lab", "alice", now),
+            GPURecord(2, "node1", None, None, None, now),
+            GPURecord(0, "node2", 3, "lab", "bob", stale),
+        ],
+        processes=[
+            ProcessRecord(11, 0, "node1", 1, "alice", "python"),
+            ProcessRecord(10, 0, "node1", 3, "bob", "python"),
+            ProcessRecord(12, 2, "node1", None, "eve", "python"),
+        ],
+        user2lab=dict(alice="lab", bob="lab", eve=None),
+        lab_names=["lab"],
+    )
+
+
+def test_derived_status():
+    state = _make_state()
+    node1 = state.name2node["node1"]
+    assert [gpu.id for gpu in node1.gpus] == [0, 1, 2]
+
+    shared, debug, unreserved = node1.gpus
+    assert [proc.id for proc in shared.processes] == [10, 11]
+    # All processes belong neither to the job nor to its user
+    assert shared.status.error and not shared.status.valid_use
+    assert shared.processes[0].status.err_msg == "[Wrong Job (3)]"
+    assert shared.processes[1].status.err_msg == ""
+
+    assert debug.status.err_msg == "[Idle reservation - DEBUG]"
+    assert not debug.status.idle
+    assert unreserved.status.err_msg == "[Use without reservation]"
+    assert unreserved.processes[0].status.err_msg == "[No Job]"
+
+    node2 = state.name2node["node2"]
+    assert node2.stale and node2.gpus[0].stale
+    assert node2.gpus[0].status.idle
+
+
+def test_indexes():
+    state = _make_state()
+    assert [node.name for node in state.nodes] == ["node1", "node2"]
+    assert state.users_by_lab == dict(lab=["alice", "bob"])
+    assert [job.job_id for job in state.jobs_by_user["alice"]] == [1, 2]
+    assert len(state.gpus_by_lab["lab"]) == 3
+    assert [gpu.node_name for gpu in state.gpus_by_user["bob"]] == ["node2"]
+
+    shared = state.name2node["node1"].gpus[0]
+    assert is_user_on_gpu(shared, {"bob"})
+    assert is_user_on_gpu(shared, None)
+    assert not is_user_on_gpu(shared, {"eve"})
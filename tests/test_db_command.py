@@ -0,0 +1,19 @@
+import sqlalchemy as sa
+from click.testing import CliRunner
+
+from gpu_use.cli.cli import gpu_use_cli
+from gpu_use.db import engine
+
+
+def test_db_init(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        engine, "_engine", sa.create_engine("sqlite:///{}".format(tmpdir.join("db")))
+    )
+
+    result = CliRunner().invoke(gpu_use_cli, ["db", "init"])
+    assert result.exit_code == 0, result.output
+    assert "monitor_cycles" in result.output
+    assert "monitor_cycles" in sa.inspect(engine.get_engine()).get_table_names()
+
+    result = CliRunner().invoke(gpu_use_cli, ["db", "init"])
+    assert result.output.strip() == "Schema is up to date"
@@ -0,0 +1,51 @@
+import os
+from os import path as osp
+
+from gpu_use.monitor import environ
+from gpu_use.monitor.environ import EnvironReader, read_environ
+
+
+def _write_environ(proc_root, pid, variables):
+    pid_dir = osp.join(proc_root, str(pid))
+    os.makedirs(pid_dir, exist_ok=True)
+    with open(osp.join(pid_dir, "environ"), "wb") as f:
+        f.write(b"\0".join(v.encode("utf-8") for v in variables) + b"\0")
+
+
+def test_read_environ(tmpdir, monkeypatch):
+    proc_root = str(tmpdir)
+    # Small chunks so that variables straddle chunk boundaries
+    monkeypatch.setattr(environ, "READ_CHUNK_SIZE", 7)
+    _write_environ(
+        proc_root,
+        10,
+        ["HOME=/home/user", "PATH=/usr/bin:/bin", "CUDA_VISIBLE_DEVICES=0,3", "A=B"],
+    )
+
+    assert read_environ(10, ["CUDA_VISIBLE_DEVICES"], proc_root) == {
+        "CUDA_VISIBLE_DEVICES": "0,3"
+    }
+    assert read_environ(10, ["A", "HOME", "MISSING"], proc_root) == {
+        "A": "B",
+        "HOME": "/home/user",
+    }
+    assert read_environ(11, ["CUDA_VISIBLE_DEVICES"], proc_root) is None
+
+
+def test_reader_caches_by_start_time(tmpdir):
+    proc_root = str(tmpdir)
+    for pid in range(1, 6):
+        _write_environ(proc_root, pid, ["CUDA_VISIBLE_DEVICES={}".format(pid)])
+
+    reader = EnvironReader(max_workers=2, proc_root=proc_root)
+    res = reader.read_many({pid: 100 for pid in range(1, 7)})
+    assert res[6] is None
+    assert {pid: res[pid]["CUDA_VISIBLE_DEVICES"] for pid in range(1, 6)} == {
+        pid: str(pid) for pid in range(1, 6)
+    }
+
+    # A live process's environment is served from the cache...
+    _write_environ(proc_root, 1, ["CUDA_VISIBLE_DEVICES=7"])
+    assert reader.read_many({1: 100})[1]["CUDA_VISIBLE_DEVICES"] == "1"
+    # ...but a reused pid is read again
+    assert reader.read_many({1: 200})[1]["CUDA_VISIBLE_DEVICES"] == "7"
@@ -0,0 +1,65 @@
+from os import path as osp
+
+from gpu_use.monitor.gpu_collector import (
+    FIXTURE_ENV_VAR,
+    FixtureGPUCollector,
+    GPUInfo,
+    GPUProcessInfo,
+    make_gpu_collector,
+    parse_nvidia_smi_csv,
+)
+
+FIXTURES_DIR = osp.join(osp.dirname(osp.abspath(__file__)), "fixtures", "nvidia-smi")
+
+
+def test_fixture_collector():
+    gpus = FixtureGPUCollector(osp.join(FIXTURES_DIR, "4gpu.xml")).collect()
+
+    assert [gpu.minor_number for gpu in gpus] == [0, 1, 2, 3]
+    assert [len(gpu.processes) for gpu in gpus] == [1, 6, 9, 0]
+    assert gpus[0].processes[0].pid == 10000
+    assert gpus[0].processes[0].used_memory == 10000
+    # nvidia-persistenced shows up with no memory
+    assert gpus[1].processes[-1].used_memory == 0
+
+
+def test_make_gpu_collector_uses_fixture(monkeypatch):
+    monkeypatch.setenv(FIXTURE_ENV_VAR, osp.join(FIXTURES_DIR, "4gpu.xml"))
+
+    collector = make_gpu_collector()
+    assert collector.name == "fixture"
+    assert len(collector.collect()) == 4
+
+
+def test_csv_matches_xml():
+    for num_gpus in (4, 8, 16):
+        with open(osp.join(FIXTURES_DIR, "{}gpu.gpus.csv".format(num_gpus))) as f:
+            gpu_csv = f.read()
+        with open(osp.join(FIXTURES_DIR, "{}gpu.apps.csv".format(num_gpus))) as f:
+            apps_csv = f.read()
+
+        xml_gpus = FixtureGPUCollector(
+            osp.join(FIXTURES_DIR, "{}gpu.xml".format(num_gpus))
+        ).collect()
+        assert len(xml_gpus) == num_gpus
+        assert parse_nvidia_smi_csv(gpu_csv, apps_csv) == xml_gpus
+
+
+def test_csv_minor_numbers():
+    gpu_csv = "0, 00000000:1A:00.0\n1, 00000000:1B:00.0\n"
+    apps_csv = "00000000:1B:00.0, 42, [N/A]\n"
+
+    gpus = parse_nvidia_smi_csv(
+        gpu_csv, apps_csv, {"0000:1a:00.0": 1, "0000:1b:00.0": 0}
+    )
+    assert [gpu.minor_number for gpu in gpus] == [1, 0]
+    assert gpus[1].processes == [GPUProcessInfo(pid=42, used_memory=None)]
+
+
+def test_csv_skips_processes_on_unknown_gpus():
+    # The GPU fell off the bus between the two nvidia-smi calls
+    gpu_csv = "0, 00000000:1A:00.0\n"
+    apps_csv = "00000000:1A:00.0, 41, 100\n00000000:1B:00.0, 42, 100\n"
+
+    gpus = parse_nvidia_smi_csv(gpu_csv, apps_csv)
+    assert gpus == [GPUInfo(minor_number=0, processes=[GPUProcessInfo(41, 100)])]
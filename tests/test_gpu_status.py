@@ -0,0 +1,76 @@
+import attr
+
+from gpu_use.cli.cluster_state import ClusterState
+from gpu_use.db import gpu_status
+from gpu_use.db.schema import GPUStatus
+from gpu_use.db.session import SessionMaker
+from gpu_use.monitor import monitor
+from gpu_use.monitor.bulk_writer import write_node_state_bulk
+from tests.test_bulk_writer import _make_state
+from tests.test_watch import _count_selects
+
+
+def _write_states(session):
+    states = [
+        _make_state(
+            {1: "alice", 2: "bob"},
+            {0: 1, 1: 1, 2: 2},
+            [(10, 0, 1, "alice"), (11, 1, 2, "bob"), (20, 3, None, "root")],
+            hostname="node1",
+        ),
+        _make_state({3: "bob"}, {3: 3}, [], hostname="node2"),
+    ]
+    job_info = states[1].jid2job_info[3]
+    job_info.metadata = attr.evolve(job_info.metadata, partition="debug")
+
+    write_node_state_bulk(session, states[0])
+    write_node_state_bulk(session, states[1])
+
+
+def _statuses(state):
+    return {
+        (gpu.node_name, gpu.id): (
+            gpu.status.err_msg,
+            [proc.status.err_msg for proc in gpu.processes],
+        )
+        for node in state.nodes
+        for gpu in node.gpus
+    }
+
+
+def test_gpu_status_rows(engine):
+    session = SessionMaker()
+    _write_states(session)
+
+    errors = {
+        (row.node_name, row.gpu_id): row.error for row in session.query(GPUStatus)
+    }
+    assert errors == {
+        ("node1", 0): gpu_status.NO_ERROR,
+        ("node1", 1): gpu_status.INVALID_USE,
+        ("node1", 2): gpu_status.IDLE,
+        ("node1", 3): gpu_status.NO_RESERVATION,
+        ("node2", 0): gpu_status.NO_ERROR,
+        ("node2", 1): gpu_status.NO_ERROR,
+        ("node2", 2): gpu_status.NO_ERROR,
+        ("node2", 3): gpu_status.IDLE_DEBUG,
+    }
+
+
+def test_load_gpu_status_matches_load(engine):
+    session = SessionMaker()
+    # Nothing written yet, so the tables are read
+    assert not ClusterState.load_gpu_status(session).from_gpu_status
+
+    _write_states(session)
+    session.close()
+
+    connection = engine.connect()
+    num_selects = _count_selects(engine)
+    state = ClusterState.load_gpu_status(connection, with_users=False)
+    # The marker and gpu_status
+    assert num_selects() == 2
+    assert state.from_gpu_status
+    assert _statuses(state) == _statuses(ClusterState.load(connection))
+
+    connection.close()
@@ -0,0 +1,60 @@
+from gpu_use.cli.health_command.health_command import percentile, summarize_nodes
+from gpu_use.db.schema import MonitorCycle
+from gpu_use.monitor.bulk_writer import write_cycle_stats
+from gpu_use.monitor.cycle_stats import CycleStats
+from tests.test_bulk_writer import _make_session
+
+
+def test_keeps_last_cycles_per_node():
+    session = _make_session()
+    for i in range(10):
+        write_cycle_stats(
+            session,
+            [
+                CycleStats("node1", start_time=1000.0 + i, duration=float(i)),
+                CycleStats("node2", start_time=1000.0 + i, duration=1.0),
+            ],
+            keep=3,
+            prune=False,
+        )
+
+    write_cycle_stats(
+        session, [CycleStats("node1", start_time=2000.0)], keep=3, prune=True
+    )
+
+    node1 = session.query(MonitorCycle).filter_by(node_name="node1").all()
+    assert sorted(cycle.duration for cycle in node1) == [0.0, 8.0, 9.0]
+    # Only nodes that were written to are pruned
+    assert session.query(MonitorCycle).filter_by(node_name="node2").count() == 10
+
+
+def test_summarize_nodes():
+    assert percentile([], 50) == 0.0
+    assert percentile([3.0, 1.0, 2.0], 50) == 2.0
+    assert percentile(list(range(1, 101)), 99) == 99
+
+    cycles = [
+        MonitorCycle(
+            node_name="fast",
+            duration=1.0,
+            phase_times='{"gpus": 0.5, "jobs": 0.1}',
+        ),
+        MonitorCycle(
+            node_name="slow",
+            duration=20.0,
+            phase_times='{"gpus": 0.5, "jobs": 18.0}',
+        ),
+        MonitorCycle(
+            node_name="slow",
+            duration=40.0,
+            phase_times='{"jobs": 30.0}',
+            failed_phase="db",
+        ),
+    ]
+    slow, fast = summarize_nodes(cycles)
+    assert slow.node_name == "slow" and fast.node_name == "fast"
+    # Failed cycles don't count towards durations
+    assert slow.p90 == 20.0
+    assert slow.slowest_phase == "jobs"
+    assert slow.failed_phases == {"db": 1}
+    assert fast.failed_phases == {}
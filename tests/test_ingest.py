@@ -0,0 +1,192 @@
+import collections
+import threading
+
+import attr
+import pytest
+import sqlalchemy as sa
+
+from gpu_use.db.schema import GPUProcess, MonitorCycle, Node
+from gpu_use.ingest import push_states
+from gpu_use.ingest import server as ingest_server
+from gpu_use.ingest.server import IngestServer
+from gpu_use.monitor import monitor
+from gpu_use.monitor.cycle_stats import CycleStats
+from gpu_use.monitor.spool import SnapshotSpool
+from tests.test_spool import _make_state
+
+TOKEN = "secret"
+
+
+def _make_server(tmpdir, nodes=["node{}".format(i) for i in range(8)]):
+    return IngestServer(
+        port=0,
+        host="localhost",
+        socket_path=str(tmpdir.join("ingest.sock")),
+        # Only write when the test flushes
+        batch_interval=3600,
+        token=TOKEN,
+        nodes=nodes,
+    )
+
+
+def test_coalesces_pushes_from_many_nodes(tmpdir, engine):
+    server = _make_server(tmpdir)
+    server.start()
+    urls = [
+        "http://localhost:{}".format(server.port),
+        "unix://{}".format(tmpdir.join("ingest.sock")),
+    ]
+
+    def _node_client(i):
+        for pid in range(100, 105):
+            push_states(
+                urls[i % 2],
+                [_make_state("node{}".format(i), pid=pid)],
+                [CycleStats("node{}".format(i), start_time=0.0, failed_phase="jobs")],
+                token=TOKEN,
+            )
+
+    clients = [threading.Thread(target=_node_client, args=(i,)) for i in range(8)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+
+    assert server.num_received == 40
+    assert server.flush() == 8
+
+    # Unchanged snapshots only refresh the heartbeat
+    push_states(urls[0], [_make_state("node0", pid=104)], token=TOKEN)
+    server.stop()
+    assert server.num_batches == 2
+
+    session = server.session_maker()
+    assert session.query(Node).count() == 8
+    assert sorted(proc.id for proc in session.query(GPUProcess)) == [104] * 8
+    assert session.query(MonitorCycle).filter_by(failed_phase="jobs").count() == 40
+
+
+def test_bad_snapshot_doesnt_block_the_batch(tmpdir, engine, monkeypatch):
+    server = _make_server(tmpdir)
+
+    write_node_state_bulk = ingest_server.write_node_state_bulk
+
+    def _write_node_state_bulk(session, state, *args, **kwargs):
+        if state.hostname == "bad":
+            raise sa.exc.OperationalError("INSERT", {}, Exception("broken"))
+        return write_node_state_bulk(session, state, *args, **kwargs)
+
+    monkeypatch.setattr(ingest_server, "write_node_state_bulk", _write_node_state_bulk)
+
+    server.submit([_make_state("node1"), _make_state("bad"), _make_state("node2")])
+    assert server.flush() == 2
+
+    session = server.session_maker()
+    assert sorted(node.name for node in session.query(Node)) == ["node1", "node2"]
+    # Holding a transaction open would keep the writer waiting
+    session.close()
+
+    # Kept for the next batch, unless something newer comes in
+    monkeypatch.setattr(ingest_server, "write_node_state_bulk", write_node_state_bulk)
+    server.submit([_make_state("bad", pid=11)])
+    assert server.flush() == 1
+    assert [
+        proc.id for proc in session.query(GPUProcess).filter_by(node_name="bad")
+    ] == [11]
+
+
+def test_retried_batch_is_timed_once(tmpdir, engine, monkeypatch):
+    server = _make_server(tmpdir)
+    clock = [0.0]
+    monkeypatch.setattr(ingest_server.time, "time", lambda: clock[0])
+
+    write_node_state_bulk = ingest_server.write_node_state_bulk
+
+    def _write_node_state_bulk(session, state, *args, **kwargs):
+        if state.hostname == "bad":
+            raise sa.exc.OperationalError("INSERT", {}, Exception("broken"))
+        write_node_state_bulk(session, state, *args, **kwargs)
+        clock[0] += 1.0
+
+    monkeypatch.setattr(ingest_server, "write_node_state_bulk", _write_node_state_bulk)
+
+    states = [
+        attr.evolve(_make_state(hostname), stats=CycleStats(hostname, start_time=0.0))
+        for hostname in ["node1", "bad"]
+    ]
+    server.submit(states)
+    assert server.flush() == 1
+
+    assert states[0].stats.duration == 1.0
+    assert states[1].stats.duration == 0.0
+    session = server.session_maker()
+    assert session.query(MonitorCycle).one().duration == 1.0
+    session.close()
+
+
+def test_push_spooled_states(tmpdir, engine, monkeypatch):
+    monkeypatch.setattr(
+        monitor, "_spool", SnapshotSpool(path=str(tmpdir.join("spool.jsonl")))
+    )
+    monkeypatch.setattr(monitor, "failed_cycles", collections.deque())
+    monitor.get_spool().append(_make_state("node1"))
+    monitor.failed_cycles.append(
+        CycleStats("node1", start_time=0.0, failed_phase="gpus")
+    )
+
+    # Nothing is lost while the server is down
+    url = "unix://{}".format(tmpdir.join("ingest.sock"))
+    assert not monitor.push_spooled_states(url)
+    assert len(monitor.get_spool()) == 1
+
+    server = _make_server(tmpdir)
+    server.start()
+    assert monitor.push_spooled_states(url)
+    server.stop()
+
+    assert len(monitor.get_spool()) == 0
+    assert len(monitor.failed_cycles) == 0
+    session = server.session_maker()
+    assert session.query(Node).one().name == "node1"
+    assert session.query(MonitorCycle).one().failed_phase == "gpus"
+
+
+def test_rejects_unauthenticated_and_unknown_nodes(tmpdir, engine, monkeypatch):
+    monkeypatch.setattr(ingest_server, "KNOWN_NODES_REFRESH_INTERVAL", 0.0)
+    server = _make_server(tmpdir, nodes=["node1"])
+    server.start()
+    url = "http://localhost:{}".format(server.port)
+    try:
+        for token, status in [(None, 401), ("guess", 403)]:
+            with pytest.raises(OSError, match=str(status)):
+                push_states(url, [_make_state("node1")], token=token)
+
+        # Neither in the database nor in the config
+        with pytest.raises(OSError, match="403"):
+            push_states(url, [_make_state("node2")], token=TOKEN)
+        with pytest.raises(OSError, match="403"):
+            push_states(
+                url,
+                [_make_state("node1")],
+                [CycleStats("node2", start_time=0.0)],
+                token=TOKEN,
+            )
+
+        push_states(url, [_make_state("node1")], token=TOKEN)
+        server.flush()
+
+        # Nodes in the database are known too
+        server.nodes = set()
+        session = server.session_maker()
+        session.add(Node(name="node2"))
+        session.commit()
+        push_states(url, [_make_state("node1", pid=11)], token=TOKEN)
+        push_states(url, [_make_state("node2")], token=TOKEN)
+    finally:
+        server.stop()
+
+    assert server.num_received == 3
+    assert [proc.id for proc in session.query(GPUProcess).order_by("node_name")] == [
+        11,
+        10,
+    ]
@@ -0,0 +1,159 @@
+import datetime
+
+import sqlalchemy as sa
+from click.testing import CliRunner
+
+from gpu_use.cli.cli import gpu_use_cli
+from gpu_use.cli.cluster_state import LabUsage, Usage
+from gpu_use.db.schema import GPU, GPUProcess, Lab, Node, SLURMJob, User
+from gpu_use.db.session import SessionMaker
+
+
+def _populate(session):
+    now = datetime.datetime.now()
+    stale = now - datetime.timedelta(minutes=20)
+
+    session.add_all([Lab(name="lab-a"), Lab(name="overcap")])
+    session.flush()
+    session.add_all([User(name="alice", lab_name="lab-a"), User(name="bob")])
+    session.add_all(
+        [Node(name="fresh", update_time=now), Node(name="stale", update_time=stale)]
+    )
+    session.flush()
+    session.add_all(
+        [
+            SLURMJob(
+                job_id=1, cpus=8, node_name="fresh", lab_name="lab-a", user_name="alice"
+            ),
+            SLURMJob(
+                job_id=2,
+                cpus=4,
+                node_name="fresh",
+                lab_name="overcap",
+                user_name="alice",
+                is_overcap_job=True,
+            ),
+            SLURMJob(
+                job_id=3, cpus=6, node_name="stale", lab_name="lab-a", user_name="alice"
+            ),
+        ]
+    )
+    session.flush()
+    session.add_all(
+        [
+            # In use
+            GPU(
+                id=0,
+                node_name="fresh",
+                slurm_job_id=1,
+                lab_name="lab-a",
+                user_name="alice",
+                update_time=now,
+            ),
+            # Idle
+            GPU(
+                id=1,
+                node_name="fresh",
+                slurm_job_id=1,
+                lab_name="lab-a",
+                user_name="alice",
+                update_time=now,
+            ),
+            # Overcap
+            GPU(
+                id=2,
+                node_name="fresh",
+                slurm_job_id=2,
+                lab_name="overcap",
+                user_name="alice",
+                update_time=now,
+            ),
+            GPU(
+                id=0,
+                node_name="stale",
+                slurm_job_id=3,
+                lab_name="lab-a",
+                user_name="alice",
+                update_time=stale,
+            ),
+        ]
+    )
+    session.flush()
+    session.add_all(
+        [
+            GPUProcess(
+                id=100, gpu_id=0, node_name="fresh", slurm_job_id=1, user_name="alice"
+            ),
+            # Someone else in alice's job
+            GPUProcess(id=101, gpu_id=0, node_name="fresh", user_name="bob"),
+        ]
+    )
+    session.commit()
+
+
+def test_usage_by_lab_and_user(engine):
+    session = SessionMaker()
+    _populate(session)
+
+    usage = LabUsage.load(session)
+    lab_usage, user_usage = usage.usage_by_lab_and_user(False)
+    # Nothing on the stale node counts, except towards the job's GPUs
+    assert lab_usage["lab-a"] == Usage(
+        gpus=2, cpus=8, invalid_gpus=1, idle_gpus=1, job_gpus=3
+    )
+    assert user_usage["alice"] == lab_usage["lab-a"]
+    assert lab_usage["overcap"] == Usage()
+
+    lab_usage, user_usage = usage.usage_by_lab_and_user(True)
+    assert lab_usage["overcap"] == Usage(gpus=1, cpus=4, idle_gpus=1, job_gpus=1)
+    assert user_usage["alice"].gpus == 3
+    assert user_usage["alice"].cpus == 12
+
+
+def test_lab_usage_refresh(engine):
+    session = SessionMaker()
+    _populate(session)
+
+    usage = LabUsage.load(session)
+    assert not usage.refresh(session)
+    # The GPUs of the fresh node stop counting once it's out of date
+    assert usage.expires_at is not None
+    usage.expires_at = datetime.datetime.now()
+    assert usage.refresh(session)
+    assert usage.usage_by_lab_and_user(True)[0]["lab-a"].gpus == 2
+
+    session.query(Node).filter_by(name="fresh").update(
+        {Node.update_time: datetime.datetime.now() - datetime.timedelta(hours=1)}
+    )
+    session.query(GPU).update(
+        {GPU.update_time: datetime.datetime.now() - datetime.timedelta(hours=1)}
+    )
+    session.commit()
+    assert usage.refresh(session)
+    assert usage.usage_by_lab_and_user(True)[0]["lab-a"] == Usage(job_gpus=3)
+    assert usage.expires_at is None
+
+
+def test_lab_query_count(engine):
+    session = SessionMaker()
+    _populate(session)
+    session.close()
+
+    statements = []
+    sa.event.listen(
+        engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    result = CliRunner().invoke(gpu_use_cli, ["lab"])
+    assert result.exit_code == 0, result.output
+    assert "lab-a" in result.output
+
+    selects = [s for s in statements if s.lstrip().startswith("SELECT")]
+    # Independent of the number of labs and users
+    assert len(selects) <= 5
+    # GPUs, processes and jobs are only summed up by the database, never read
+    for statement in selects:
+        if any(table in statement for table in ("gpus", "gpu_processes", "slurm_jobs")):
+            assert "GROUP BY" in statement
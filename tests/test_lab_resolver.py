@@ -0,0 +1,85 @@
+import json
+import subprocess
+
+from gpu_use.monitor import lab_resolver
+from gpu_use.monitor.lab_resolver import LabResolver, parse_assoc
+
+ASSOC_OUT = """\
+|lab-a|
+alice|lab-a|
+bob|overcap|
+bob|lab-b|
+carol|overcap|
+"""
+
+
+def test_parse_assoc():
+    assert parse_assoc(ASSOC_OUT) == {"alice": "lab-a", "bob": "lab-b", "carol": None}
+
+
+def test_resolver_warms_once_and_persists(tmpdir, monkeypatch):
+    calls = []
+
+    def _check_output(cmd):
+        calls.append(cmd)
+        return ASSOC_OUT.encode("utf-8")
+
+    monkeypatch.setattr(subprocess, "check_output", _check_output)
+    cache_path = str(tmpdir.join("lab-cache.json"))
+
+    resolver = LabResolver(cache_path=cache_path)
+    assert resolver.lab_name("alice") == "lab-a"
+    assert resolver.lab_name("bob") == "lab-b"
+    assert resolver.lab_name("carol") is None
+    assert len(calls) == 1
+
+    # Unknown users are remembered as well, and right after a refresh
+    # don't cause another one
+    assert resolver.lab_name("root") == ""
+    assert resolver.lab_name("docker") == ""
+    assert len(calls) == 1
+
+    with open(cache_path, "rt") as f:
+        assert json.load(f)["alice"][0] == "lab-a"
+
+    restarted = LabResolver(cache_path=cache_path)
+    assert restarted.lab_name("bob") == "lab-b"
+    assert restarted.lab_name("root") == ""
+    assert len(calls) == 1
+
+    expired = LabResolver(cache_path=cache_path, ttl=0)
+    assert expired.lab_name("bob") == "lab-b"
+    assert len(calls) == 2
+
+
+def test_resolver_uses_stale_entries_on_failure(tmpdir, monkeypatch):
+    cache_path = str(tmpdir.join("lab-cache.json"))
+    with open(cache_path, "wt") as f:
+        json.dump({"alice": ["lab-a", 0]}, f)
+
+    def _check_output(cmd):
+        raise subprocess.CalledProcessError(1, cmd)
+
+    monkeypatch.setattr(subprocess, "check_output", _check_output)
+
+    assert LabResolver(cache_path=cache_path).lab_name("alice") == "lab-a"
+
+
+def test_unknown_users_are_resolved_again(tmpdir, monkeypatch):
+    assoc_outs = [ASSOC_OUT, ASSOC_OUT + "dave|lab-a|\n"]
+    monkeypatch.setattr(
+        subprocess, "check_output", lambda cmd: assoc_outs.pop(0).encode("utf-8")
+    )
+    now = [1000.0]
+    monkeypatch.setattr(lab_resolver.time, "time", lambda: now[0])
+
+    resolver = LabResolver(cache_path=str(tmpdir.join("lab-cache.json")))
+    assert resolver.lab_name("alice") == "lab-a"
+    # Added to SLURM right after the refresh
+    assert resolver.lab_name("dave") == ""
+
+    now[0] += lab_resolver.NEGATIVE_TTL
+    assert resolver.lab_name("dave") == "lab-a"
+    assert assoc_outs == []
+    # Known users keep the long TTL
+    assert resolver.lab_name("alice") == "lab-a"
@@ -0,0 +1,68 @@
+import urllib.request
+
+import attr
+
+from gpu_use.monitor.cycle_stats import CycleStats
+from gpu_use.monitor.metrics import MetricsExporter, gpu_samples
+from tests import test_bulk_writer
+from tests.test_spool import _make_state
+
+
+def test_render(tmpdir):
+    state = attr.evolve(
+        _make_state("node1", load="1.50 / 1.00 / 0.50"),
+        stats=CycleStats(
+            "node1", start_time=0.0, duration=0.3, phase_times={"gpus": 0.2}
+        ),
+    )
+    textfile = str(tmpdir.join("gpu_use.prom"))
+    exporter = MetricsExporter(port=0, textfile=textfile)
+    exporter.start()
+    try:
+        exporter.update(state)
+        exporter.update(None)
+
+        url = "http://localhost:{}/metrics".format(exporter._server.server_port)
+        text = urllib.request.urlopen(url).read().decode("utf-8")
+    finally:
+        exporter.stop()
+
+    assert text == open(textfile).read()
+
+    labels = 'node="node1",gpu="{}",lab="{}",user="{}",job="{}"'
+    # GPU 0 is used by the job that reserved it, GPU 1 is idle
+    assert (
+        "gpu_use_gpu_reserved{" + labels.format(0, "lab-a", "alice", 1) + "} 1.0"
+        in text
+    )
+    assert (
+        "gpu_use_gpu_error{" + labels.format(0, "lab-a", "alice", 1) + "} 0.0" in text
+    )
+    assert "gpu_use_gpu_in_use{" + labels.format(1, "", "", "") + "} 0.0" in text
+    assert 'gpu_use_node_load{node="node1",period="1m"} 1.5' in text
+    assert 'gpu_use_cycle_duration_seconds_bucket{node="node1",le="0.25"} 0.0' in text
+    assert 'gpu_use_cycle_duration_seconds_bucket{node="node1",le="0.5"} 1.0' in text
+    assert 'gpu_use_cycle_duration_seconds_count{node="node1"} 1.0' in text
+    assert (
+        'gpu_use_cycle_phase_duration_seconds_count{node="node1",phase="gpus"} 1.0'
+        in text
+    )
+    assert 'gpu_use_cycles_failed_total{node="node1"} 1.0' in text
+
+
+def test_gpu_samples_follow_the_database():
+    state = test_bulk_writer._make_state(
+        {1: "alice", 2: "bob"},
+        {0: 1, 1: 2},
+        [(10, 0, 1, "alice"), (11, 1, 2, "root"), (12, 1, 1, "alice")],
+    )
+    job_info = state.jid2job_info[1]
+    job_info.metadata = attr.evolve(job_info.metadata, account="overcap")
+
+    (labels0, status0), (labels1, status1) = gpu_samples(state)[:2]
+    # Labelled with alice's lab, not the account of the job
+    assert dict(labels0)["lab"] == "lab-a"
+    assert not status0["error"]
+    # root counts as bob, but alice's process makes it invalid
+    assert dict(labels1)["lab"] == "lab-b"
+    assert status1["error"] and status1["processes"] == 2
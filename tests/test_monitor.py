@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import os
+import time
+
+import attr
+import pytest
+
+from gpu_use.db.schema import GPU, SLURMJob, User
+from gpu_use.db.session import SessionMaker
+from gpu_use.monitor import monitor
+from gpu_use.monitor.cycle_stats import CycleStats
+from gpu_use.monitor.gpu_collector import GPUCollector, GPUInfo, GPUProcessInfo
+from gpu_use.monitor.monitor import JobInfo, NodeState, _gather, _timed
+from gpu_use.monitor.proc_table import ProcInfo
+from gpu_use.monitor.slurm import JobMetadata
+from gpu_use.monitor.spool import SnapshotSpool
+from tests import test_bulk_writer
+
+
+def _make_state(gpu2pids, pid2job_id, gpu2jid=None):
+    gpu2jid = gpu2jid if gpu2jid is not None else {}
+    jid2job_info = {
+        jid: JobInfo(jid=jid, user_name="user{}".format(jid))
+        for jid in set(pid2job_id.values()) | set(gpu2jid.values())
+        if jid is not None
+    }
+    return NodeState(
+        hostname="node1",
+        load="0.00 / 0.00 / 0.00",
+        gpu2pid_info=gpu2pids,
+        pid2user_info={
+            pid: ProcInfo(pid, 1, "python train.py", 0, "user") for pid in pid2job_id
+        },
+        pid2job_id=pid2job_id,
+        jid2job_info=jid2job_info,
+        gpu2job_info={gpu: jid2job_info[jid] for gpu, jid in gpu2jid.items()},
+        all_pids=set(pid2job_id.keys()),
+    )
+
+
+def test_fingerprint():
+    state = _make_state({0: [10], 1: [11]}, {10: 1, 11: None}, {0: 1})
+    same = _make_state({1: [11], 0: [10]}, {11: None, 10: 1}, {0: 1})
+    assert state.fingerprint() == same.fingerprint()
+
+    moved = _make_state({0: [], 1: [10, 11]}, {10: 1, 11: None}, {0: 1})
+    assert state.fingerprint() != moved.fingerprint()
+
+    reserved = _make_state({0: [10], 1: [11]}, {10: 1, 11: None}, {0: 1, 1: 2})
+    assert state.fingerprint() != reserved.fingerprint()
+
+
+def test_fingerprint_covers_labs_and_jobs():
+    state = test_bulk_writer._make_state({1: "alice"}, {0: 1}, [(10, 0, 1, "alice")])
+    same = test_bulk_writer._make_state({1: "alice"}, {0: 1}, [(10, 0, 1, "alice")])
+    assert state.fingerprint() == same.fingerprint()
+
+    same.user2lab["alice"] = "lab-b"
+    assert state.fingerprint() != same.fingerprint()
+
+    same.user2lab["alice"] = "lab-a"
+    job_info = same.jid2job_info[1]
+    job_info.metadata = attr.evolve(job_info.metadata, partition="debug")
+    assert state.fingerprint() != same.fingerprint()
+
+
+def test_lab_change_is_written(engine, tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        monitor, "_spool", SnapshotSpool(path=str(tmpdir.join("spool.jsonl")))
+    )
+    monkeypatch.setattr(monitor, "failed_cycles", collections.deque())
+
+    def _state():
+        return test_bulk_writer._make_state({1: "alice"}, {0: 1}, [(10, 0, 1, "alice")])
+
+    monitor.get_spool().append(_state())
+    fingerprint = monitor.write_spooled_states()
+
+    # Only alice's lab changed
+    moved = _state()
+    moved.user2lab["alice"] = "lab-b"
+    monitor.get_spool().append(moved)
+    assert monitor.write_spooled_states(fingerprint) != fingerprint
+
+    session = SessionMaker()
+    assert session.query(User).get("alice").lab_name == "lab-b"
+    assert session.query(SLURMJob).get(1).lab_name == "lab-b"
+    assert session.query(GPU).filter_by(id=0).one().lab_name == "lab-b"
+    session.close()
+
+
+def test_idle_fingerprint():
+    idle = _make_state({gpu: [] for gpu in range(8)}, {})
+    assert (
+        idle.fingerprint()
+        == _make_state({gpu: [] for gpu in range(8)}, {}).fingerprint()
+    )
+
+    # A GPU disappearing is a change even if nothing runs on the node
+    assert (
+        idle.fingerprint()
+        != _make_state({gpu: [] for gpu in range(7)}, {}).fingerprint()
+    )
+
+
+def test_gather_is_concurrent():
+    finished = []
+
+    async def _probe(secs, fail=False):
+        await asyncio.sleep(secs)
+        finished.append(secs)
+        if fail:
+            raise OSError("probe failed")
+
+        return secs
+
+    stats = CycleStats(node_name="node1", start_time=time.time())
+    loop = asyncio.new_event_loop()
+    try:
+        start_time = time.time()
+        assert loop.run_until_complete(
+            _gather(
+                _timed(stats, "slow", _probe(0.2)),
+                _timed(stats, "fast", _probe(0.1)),
+            )
+        ) == [0.2, 0.1]
+        assert time.time() - start_time < 0.3
+        assert stats.phase_times["fast"] < stats.phase_times["slow"]
+
+        # Nothing is left running when a probe fails
+        finished.clear()
+        with pytest.raises(OSError):
+            loop.run_until_complete(
+                _gather(_timed(stats, "broken", _probe(0.0, fail=True)), _probe(0.1))
+            )
+        assert sorted(finished) == [0.0, 0.1]
+        assert stats.failed_phase == "broken"
+    finally:
+        loop.close()
+
+
+class _SlowGPUCollector(GPUCollector):
+    def collect(self):
+        time.sleep(0.3)
+        self.end_time = time.time()
+        return [GPUInfo(minor_number=0, processes=[GPUProcessInfo(os.getpid())])]
+
+
+def test_slurm_lookups_overlap_the_gpu_probe(monkeypatch):
+    collector = _SlowGPUCollector()
+    monkeypatch.setattr(monitor, "get_gpu_collector", lambda: collector)
+
+    async def _list_slurm_pids():
+        return [dict(pid=os.getpid(), jid=1)]
+
+    start_times = {}
+
+    def _read_many(pid2start_time):
+        start_times["environ"] = time.time()
+        return {pid: {"CUDA_VISIBLE_DEVICES": "0"} for pid in pid2start_time}
+
+    def _get(jids):
+        start_times["jobs"] = time.time()
+        return {
+            jid: JobMetadata(jid=jid, account="lab-a", partition="short", cpus=6)
+            for jid in jids
+        }
+
+    class _LabResolver:
+        def lab_name(self, user_name):
+            return "lab-a"
+
+    monkeypatch.setattr(monitor, "_list_slurm_pids", _list_slurm_pids)
+    monkeypatch.setattr(monitor.environ_reader, "read_many", _read_many)
+    monkeypatch.setattr(monitor.job_cache, "get", _get)
+    monkeypatch.setattr(monitor, "_lab_resolver", _LabResolver())
+
+    state = monitor.collect_node_state()
+
+    assert start_times["environ"] < collector.end_time
+    assert start_times["jobs"] < collector.end_time
+    assert state.gpu2job_info[0].jid == 1
+    assert state.pid2job_id == {os.getpid(): 1}
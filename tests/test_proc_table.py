@@ -0,0 +1,88 @@
+import os
+import types
+from os import path as osp
+
+from gpu_use.monitor import proc_table
+from gpu_use.monitor.proc_table import ProcessTable
+
+
+def _make_proc(proc_root, pid, ppid, comm, cmdline, uid=None, start_time=100):
+    uid = os.getuid() if uid is None else uid
+    pid_dir = osp.join(proc_root, str(pid))
+    os.makedirs(pid_dir)
+
+    fields = ["S", str(ppid)] + ["0"] * 17 + [str(start_time)] + ["0"] * 10
+    with open(osp.join(pid_dir, "stat"), "wt") as f:
+        f.write("{} ({}) {}\n".format(pid, comm, " ".join(fields)))
+
+    with open(osp.join(pid_dir, "status"), "wt") as f:
+        f.write("Name:\t{}\nUid:\t{uid}\t{uid}\t{uid}\t{uid}\n".format(comm, uid=uid))
+
+    with open(osp.join(pid_dir, "cmdline"), "wb") as f:
+        f.write(b"\0".join(arg.encode("utf-8") for arg in cmdline))
+
+
+def _make_tree(tmpdir):
+    proc_root = str(tmpdir)
+    _make_proc(proc_root, 1, 0, "systemd", ["/sbin/init"])
+    _make_proc(proc_root, 2, 0, "kthreadd", [])
+    _make_proc(proc_root, 100, 1, "slurmstepd", ["slurmstepd: [12.0]"])
+    _make_proc(proc_root, 200, 100, "python", ["python", "train.py"], start_time=4)
+    _make_proc(proc_root, 300, 200, "pt_data_worker) (0", ["python", "train.py"])
+    # Parent exited between the directory listing and reading stat
+    _make_proc(proc_root, 400, 999, "orphan", ["sleep", "10"])
+    os.makedirs(osp.join(proc_root, "self"))
+    return proc_root
+
+
+def test_parents_and_lineage(tmpdir):
+    table = ProcessTable.snapshot(_make_tree(tmpdir))
+
+    assert table.pids == [1, 2, 100, 200, 300, 400]
+    assert table.ppid(300) == 200
+    assert table.lineage(300) == [300, 200, 100, 1]
+    assert table.lineage(1) == [1]
+    assert table.lineage(400) is None
+    assert table.lineage(12345) is None
+    assert 12345 not in table
+
+
+def test_info(tmpdir):
+    table = ProcessTable.snapshot(_make_tree(tmpdir))
+
+    info = table.info(200)
+    assert info.ppid == 100
+    assert info.command == "python train.py"
+    assert info.start_time == 4
+
+    assert table.info(300).command == "python train.py"
+    assert table.info(2).command == "[kthreadd]"
+    assert table.info(12345) is None
+
+
+def test_unknown_uid(tmpdir):
+    proc_root = str(tmpdir)
+    _make_proc(proc_root, 1, 0, "systemd", ["/sbin/init"], uid=987654)
+
+    assert ProcessTable.snapshot(proc_root).info(1).user_name == "987654"
+
+
+def test_failed_lookup_is_retried(tmpdir, monkeypatch):
+    proc_root = str(tmpdir)
+    _make_proc(proc_root, 1, 0, "systemd", ["/sbin/init"], uid=987655)
+
+    lookups = []
+
+    def _getpwuid(uid):
+        lookups.append(uid)
+        # LDAP is down the first time
+        if len(lookups) == 1:
+            raise KeyError(uid)
+        return types.SimpleNamespace(pw_name="alice")
+
+    monkeypatch.setattr(proc_table.pwd, "getpwuid", _getpwuid)
+
+    assert ProcessTable.snapshot(proc_root).info(1).user_name == "987655"
+    assert ProcessTable.snapshot(proc_root).info(1).user_name == "alice"
+    assert ProcessTable.snapshot(proc_root).info(1).user_name == "alice"
+    assert lookups == [987655, 987655]
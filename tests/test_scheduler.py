@@ -0,0 +1,74 @@
+from gpu_use.monitor.scheduler import PollScheduler
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _make_scheduler(clock, **kwargs):
+    return PollScheduler(
+        interval=60,
+        fast_interval=10,
+        fast_period=30,
+        backoff_cycles=2,
+        max_interval=240,
+        phase=5,
+        clock=clock,
+        **kwargs
+    )
+
+
+def _run_cycle(clock, scheduler, fingerprint, duration=1.0):
+    clock.now += scheduler.delay()
+    start = clock.now
+    clock.now += duration
+    scheduler.record(fingerprint)
+    return start
+
+
+def test_ticks_do_not_drift():
+    clock = _Clock()
+    scheduler = _make_scheduler(clock)
+
+    starts = [_run_cycle(clock, scheduler, None, duration=7.0) for _ in range(4)]
+    assert starts == [1005.0, 1065.0, 1125.0, 1185.0]
+
+    # A cycle that overruns skips the ticks it missed
+    _run_cycle(clock, scheduler, None, duration=130.0)
+    assert _run_cycle(clock, scheduler, None) == 1425.0
+
+
+def test_fast_after_change_and_backoff_when_stable():
+    clock = _Clock()
+    scheduler = _make_scheduler(clock)
+
+    _run_cycle(clock, scheduler, "a")
+    assert scheduler.current_interval == 60
+
+    _run_cycle(clock, scheduler, "b")
+    assert scheduler.current_interval == 10
+    clock.now += 30
+    assert scheduler.current_interval == 60
+
+    intervals = []
+    for _ in range(8):
+        _run_cycle(clock, scheduler, "b")
+        intervals.append(scheduler.current_interval)
+    assert intervals == [60, 120, 120, 240, 240, 240, 240, 240]
+
+    # A failed cycle isn't stable
+    _run_cycle(clock, scheduler, None)
+    assert scheduler.current_interval == 60
+
+
+def test_no_backoff_by_default():
+    clock = _Clock()
+    scheduler = PollScheduler(phase=5, clock=clock)
+
+    for _ in range(50):
+        _run_cycle(clock, scheduler, "a")
+    assert scheduler.current_interval == 60
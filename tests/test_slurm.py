@@ -0,0 +1,63 @@
+import subprocess
+
+from gpu_use.monitor import slurm
+from gpu_use.monitor.slurm import JobMetadata, SLURMJobCache, parse_squeue
+
+SCONTROL_OUT = (
+    "JobId=103 JobName=bash UserId=user(1000) GroupId=user(1000) "
+    "Priority=1 Account=overcap QOS=normal JobState=RUNNING "
+    "Partition=debug AllocNode:Sid=login:1 "
+    "TRES=cpu=6,mem=40G,node=1,billing=6,gres/gpu=1 Socks/Node=*\n"
+)
+
+
+def test_parse():
+    assert parse_squeue("101|lab-a|short|8\n102|lab-b|long|4\n\n") == {
+        101: JobMetadata(jid=101, account="lab-a", partition="short", cpus=8),
+        102: JobMetadata(jid=102, account="lab-b", partition="long", cpus=4),
+    }
+
+    assert JobMetadata.from_scontrol(103, SCONTROL_OUT) == JobMetadata(
+        jid=103, account="overcap", partition="debug", cpus=6
+    )
+
+
+def test_cache_batches_lookups(monkeypatch):
+    calls = []
+
+    def _check_output(cmd):
+        calls.append(cmd[0])
+        if cmd[0] == "squeue":
+            return b"101|lab-a|short|8\n102|lab-b|long|4\n"
+
+        return SCONTROL_OUT.encode("utf-8")
+
+    monkeypatch.setattr(subprocess, "check_output", _check_output)
+    cache = SLURMJobCache(hostname="node1")
+
+    jobs = cache.get([101, 102, 103])
+    assert jobs[101].account == "lab-a"
+    assert jobs[103].partition == "debug"
+    # One squeue for the node plus one scontrol for the job it missed
+    assert calls == ["squeue", "scontrol"]
+
+    cache.get([101, 102, 103])
+    assert len(calls) == 2
+
+    cache.evict([101])
+    assert 101 in cache and 102 not in cache and 103 not in cache
+
+    cache.get([101, 102])
+    assert calls == ["squeue", "scontrol", "squeue"]
+
+
+def test_squeue_failure_falls_back(monkeypatch):
+    def _check_output(cmd):
+        if cmd[0] == "squeue":
+            raise subprocess.CalledProcessError(1, cmd)
+
+        return SCONTROL_OUT.encode("utf-8")
+
+    monkeypatch.setattr(subprocess, "check_output", _check_output)
+
+    assert SLURMJobCache(hostname="node1").get([103])[103].cpus == 6
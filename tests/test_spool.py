@@ -0,0 +1,102 @@
+from gpu_use.monitor.node_state import JobInfo, NodeState
+from gpu_use.monitor.proc_table import ProcInfo
+from gpu_use.monitor.slurm import JobMetadata
+from gpu_use.monitor.spool import SnapshotSpool
+
+
+def _make_state(hostname, load="0.00 / 0.00 / 0.00", pid=10):
+    job_info = JobInfo(
+        jid=1,
+        user_name="alice",
+        metadata=JobMetadata(jid=1, account="lab-a", partition="short", cpus=6),
+    )
+    return NodeState(
+        hostname=hostname,
+        load=load,
+        gpu2pid_info={0: [pid], 1: []},
+        pid2user_info={pid: ProcInfo(pid, 1, "python train.py", 0, "alice")},
+        pid2job_id={pid: 1},
+        jid2job_info={1: job_info},
+        gpu2job_info={0: job_info},
+        all_pids={pid},
+        user2lab={"alice": "lab-a"},
+    )
+
+
+def test_round_trip():
+    state = _make_state("node1")
+    assert NodeState.from_dict(state.to_dict()) == state
+
+
+def test_pending_is_newest_per_node(tmpdir):
+    spool = SnapshotSpool(path=str(tmpdir.join("spool.jsonl")))
+    for pid in range(10, 15):
+        spool.append(_make_state("node1", pid=pid))
+    spool.append(_make_state("node2"))
+
+    states, marker = spool.pending()
+    assert states == {
+        "node1": _make_state("node1", pid=14),
+        "node2": _make_state("node2"),
+    }
+
+    # Anything appended while writing is kept
+    spool.append(_make_state("node1", pid=20))
+    spool.discard(marker)
+    assert spool.pending()[0] == {"node1": _make_state("node1", pid=20)}
+
+    # and survives a restart
+    restarted = SnapshotSpool(path=spool.path)
+    assert restarted.pending()[0] == {"node1": _make_state("node1", pid=20)}
+    restarted.append(_make_state("node1", pid=21))
+    assert restarted.pending()[0] == {"node1": _make_state("node1", pid=21)}
+
+
+def test_bounded_and_tolerates_torn_writes(tmpdir):
+    path = str(tmpdir.join("spool.jsonl"))
+    spool = SnapshotSpool(path=path, max_bytes=4096)
+    for pid in range(100):
+        spool.append(_make_state("node1", pid=pid))
+        spool.append(_make_state("node2", pid=pid))
+    assert tmpdir.join("spool.jsonl").size() <= 4096
+
+    with open(path, "ab") as f:
+        f.write(b'{"seq": 1000, "state": {"hostn')
+
+    assert spool.pending()[0] == {
+        "node1": _make_state("node1", pid=99),
+        "node2": _make_state("node2", pid=99),
+    }
+
+
+def test_falls_back_to_memory(tmpdir):
+    tmpdir.join("not-a-dir").write("")
+    spool = SnapshotSpool(path=str(tmpdir.join("not-a-dir", "spool.jsonl")))
+    spool.append(_make_state("node1"))
+
+    states, marker = spool.pending()
+    assert states == {"node1": _make_state("node1")}
+    spool.discard(marker)
+    assert len(spool) == 0
+
+
+def test_file_only_used_while_behind(tmpdir, monkeypatch):
+    spool_file = tmpdir.join("spool.jsonl")
+    spool = SnapshotSpool(path=str(spool_file))
+    monkeypatch.setattr(spool, "_read_entries", None)
+
+    # Every snapshot gets written before the next one comes in
+    for pid in range(10, 15):
+        spool.append(_make_state("node1", pid=pid))
+        spool.discard(spool.pending()[1])
+    assert not spool_file.exists()
+
+    # A failed write leaves the snapshot pending
+    spool.append(_make_state("node1", pid=20))
+    spool.pending()
+    spool.append(_make_state("node1", pid=21))
+    assert spool_file.size() > 0
+
+    spool.discard(spool.pending()[1])
+    assert len(spool) == 0
+    assert spool_file.size() == 0
@@ -0,0 +1,48 @@
+import threading
+
+import sqlalchemy as sa
+
+from gpu_use.db.engine import make_engine
+from gpu_use.db.schema import GPUProcess, Node
+from gpu_use.db.session import SessionMaker
+from gpu_use.monitor.bulk_writer import write_node_state_bulk
+from tests.test_spool import _make_state
+
+
+def test_concurrent_writers(engine):
+    assert engine.execute("PRAGMA journal_mode").scalar() == "wal"
+    cli_engine = make_engine("cli", config=dict(url=str(engine.url)))
+
+    errors = []
+
+    def _node(i):
+        try:
+            for pid in range(100, 110):
+                session = SessionMaker()
+                write_node_state_bulk(session, _make_state("node{}".format(i), pid=pid))
+                session.close()
+        except Exception as e:
+            errors.append(e)
+
+    def _cli():
+        try:
+            for _ in range(20):
+                cli_engine.execute(
+                    sa.select([sa.func.count()]).select_from(Node.__table__)
+                )
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=_node, args=(i,)) for i in range(4)]
+    threads.append(threading.Thread(target=_cli))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    session = SessionMaker()
+    assert session.query(Node).count() == 4
+    assert sorted(proc.id for proc in session.query(GPUProcess)) == [109] * 4
+    # Foreign keys are enforced like on MySQL
+    assert engine.execute("PRAGMA foreign_keys").scalar() == 1
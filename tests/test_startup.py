@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+_SCRIPT = """
+import atexit
+import sys
+
+def _report():
+    engine = sys.modules.get("gpu_use.db.engine")
+    created = engine is not None and engine._engine is not None
+    print("engine created: {}".format(created), file=sys.stderr)
+
+atexit.register(_report)
+
+from gpu_use.cli.cli import gpu_use_cli
+
+gpu_use_cli(prog_name="gpu-use")
+"""
+
+
+def _run_cli(*args):
+    start_time = time.time()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _SCRIPT] + list(args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    elapsed = time.time() - start_time
+
+    imported = {
+        line.split("|")[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    return result, imported, elapsed
+
+
+@pytest.mark.parametrize("args", [["version"], ["--help"]])
+def test_cli_startup_doesnt_touch_the_db(args):
+    result, imported, elapsed = _run_cli(*args)
+    assert result.returncode == 0, result.stderr
+    assert len(result.stdout) > 0
+    assert "engine created: False" in result.stderr
+
+    if args == ["version"]:
+        assert "sqlalchemy" not in imported
+
+    # Generous, this catches DB round trips and connection timeouts rather
+    # than slow imports
+    assert elapsed < 5.0
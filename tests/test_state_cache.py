@@ -0,0 +1,226 @@
+import datetime
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import zlib
+
+import pytest
+from click.testing import CliRunner
+
+from gpu_use.cli import state_cache
+from gpu_use.cli.cli import gpu_use_cli
+from gpu_use.cli.cluster_state import ClusterState
+from gpu_use.cli.state_cache import StateCache, load_cluster_state
+from gpu_use.db.schema import Node
+from gpu_use.db.session import SessionMaker
+from tests.test_gpu_status import _write_states
+from tests.test_lab_command import _populate
+from tests.test_watch import _count_selects
+
+NOBODY = 65534
+
+
+def _summary(state):
+    # What the views show of every GPU, and the CPUs of every job
+    return (
+        [
+            (gpu.node_name, gpu.id, gpu.user_name, gpu.stale, gpu.status.err_msg)
+            for gpu in state.gpus
+        ],
+        sorted((job.job_id, job.cpus) for job in state.jobs.values()),
+    )
+
+
+def test_read_through(engine, tmpdir, monkeypatch):
+    _populate(SessionMaker())
+    cache_dir = tmpdir.mkdir("cache")
+    monkeypatch.setenv(state_cache.CACHE_DIR_ENV_VAR, str(cache_dir))
+    monkeypatch.setenv(state_cache.CACHE_TTL_ENV_VAR, "60")
+    num_selects = _count_selects(engine)
+
+    state = load_cluster_state()
+    num_fetched = num_selects()
+    assert num_fetched > 0
+    assert cache_dir.listdir()[0].basename.endswith(".cache")
+
+    cached = load_cluster_state()
+    assert num_selects() == num_fetched
+    assert _summary(cached) == _summary(state)
+    assert [gpu.status for gpu in cached.gpus] == [gpu.status for gpu in state.gpus]
+    assert cached.marker == state.marker
+
+    # Once expired, only whether anything was written is checked
+    expired = StateCache(state_cache.cache_path(str(cache_dir)), ttl=0)
+    assert _summary(expired.load()) == _summary(state)
+    assert num_selects() == num_fetched + 1
+
+
+def test_corrupt_cache_is_rewritten(engine, tmpdir):
+    _populate(SessionMaker())
+    path = tmpdir.join("gpu-use.cache")
+    path.write_binary(b"gpu-use-cache 1\nnot zlib")
+
+    state = StateCache(str(path)).load()
+    assert state_cache.decode_state(path.read_binary()) is not None
+    assert _summary(state) == _summary(ClusterState.load(SessionMaker()))
+
+
+def test_symlinked_cache_falls_back_to_db(engine, tmpdir):
+    _populate(SessionMaker())
+    target = tmpdir.join("target")
+    target.write("untouched")
+    path = tmpdir.join("gpu-use.cache")
+    path.mksymlinkto(target)
+
+    state = StateCache(str(path)).load()
+    assert _summary(state) == _summary(ClusterState.load(SessionMaker()))
+    assert target.read() == "untouched"
+
+
+def test_cache_writable_by_others_is_not_used(engine, tmpdir):
+    _populate(SessionMaker())
+    path = tmpdir.join("gpu-use.cache")
+    StateCache(str(path)).load()
+    assert stat.S_IMODE(path.stat().mode) == 0o660
+
+    session = SessionMaker()
+    expected = _summary(ClusterState.load(session))
+    session.close()
+
+    path.write_binary(b"planted")
+    path.chmod(0o666)
+    assert _summary(StateCache(str(path)).load()) == expected
+    assert path.read_binary() == b"planted"
+
+    # Anyone could have put it there
+    path.chmod(0o660)
+    tmpdir.chmod(0o777)
+    assert _summary(StateCache(str(path)).load()) == expected
+    assert path.read_binary() == b"planted"
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="Needs to switch users")
+def test_users_share_one_refresh(engine, monkeypatch):
+    _populate(SessionMaker())
+    # Owned by the group of everyone using the cache, which is inherited
+    directory = tempfile.mkdtemp()
+    os.chown(directory, 0, NOBODY)
+    os.chmod(directory, 0o3770)
+    path = os.path.join(directory, "gpu-use.cache")
+
+    loads = []
+    load_from_db = state_cache._load_from_db
+
+    def _load_from_db(load):
+        loads.append(load)
+        return load_from_db(load)
+
+    monkeypatch.setattr(state_cache, "_load_from_db", _load_from_db)
+
+    try:
+        state = StateCache(path, ttl=60).load()
+        assert len(loads) == 1
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.setgroups([])
+                os.setgid(NOBODY)
+                os.setuid(NOBODY)
+                cached = StateCache(path, ttl=60).load()
+                code = 0 if not loads[1:] and _summary(cached) == _summary(state) else 2
+            finally:
+                os._exit(code)
+
+        assert os.waitpid(pid, 0)[1] == 0
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_wrong_types_are_rejected(engine):
+    _populate(SessionMaker())
+    data = state_cache.encode_state(ClusterState.load(SessionMaker()), time.time())
+    assert state_cache.decode_state(data) is not None
+
+    def _with(change):
+        entry = json.loads(zlib.decompress(data[len(state_cache._MAGIC) :]))
+        change(entry)
+        return state_cache._MAGIC + zlib.compress(json.dumps(entry).encode())
+
+    def _cpus(entry):
+        entry["jobs"][0][4] = "8"
+
+    def _fetched_at(entry):
+        entry["fetched_at"] = "now"
+
+    def _lab_names(entry):
+        entry["lab_names"] = [1]
+
+    def _update_time(entry):
+        entry["nodes"][0][2] = 1
+
+    for change in (_cpus, _fetched_at, _lab_names, _update_time):
+        assert state_cache.decode_state(_with(change)) is None
+
+
+def test_concurrent_invocations_share_one_refresh(engine, tmpdir, monkeypatch):
+    _populate(SessionMaker())
+    path = str(tmpdir.join("gpu-use.cache"))
+
+    loads = []
+    load = ClusterState.load
+
+    def _load(session):
+        loads.append(session)
+        return load(session)
+
+    monkeypatch.setattr(ClusterState, "load", _load)
+
+    states = []
+    invocations = [
+        threading.Thread(target=lambda: states.append(StateCache(path).load()))
+        for _ in range(8)
+    ]
+    for invocation in invocations:
+        invocation.start()
+    for invocation in invocations:
+        invocation.join()
+
+    assert len(loads) == 1
+    assert len(states) == 8
+
+
+def test_cached_output_matches_uncached(engine, tmpdir, monkeypatch):
+    session = SessionMaker()
+    _write_states(session)
+    # Not in gpu_status, as it has no GPUs
+    session.add(Node(name="cpu-only", update_time=datetime.datetime.now()))
+    session.commit()
+    cache_dir = tmpdir.mkdir("cache")
+
+    for args in (
+        ["view"],
+        ["view", "-e"],
+        ["view", "-u", "bob"],
+        ["lab"],
+        ["lab", "-noc"],
+    ):
+        uncached = CliRunner().invoke(gpu_use_cli, args)
+        assert uncached.exit_code == 0
+
+        with monkeypatch.context() as env:
+            env.setenv(state_cache.CACHE_DIR_ENV_VAR, str(cache_dir))
+            env.setenv(state_cache.CACHE_TTL_ENV_VAR, "60")
+            # Read from the database, then from the cache
+            for _ in range(2):
+                assert CliRunner().invoke(gpu_use_cli, args).output == uncached.output
+
+    assert sorted(path.basename.rsplit("-", 1)[1] for path in cache_dir.listdir()) == [
+        "gpu_status.cache",
+        "lab_usage.cache",
+    ]
@@ -0,0 +1,77 @@
+import datetime
+
+import sqlalchemy as sa
+
+from gpu_use.cli import watch as watch_module
+from gpu_use.cli.cluster_state import ClusterState
+from gpu_use.db.schema import GPUProcess, Node
+from gpu_use.db.session import SessionMaker
+from tests.test_lab_command import _populate
+
+
+def _count_selects(engine):
+    statements = []
+    sa.event.listen(
+        engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    return lambda: len([s for s in statements if s.lstrip().startswith("SELECT")])
+
+
+def test_refresh_reads_only_updated_nodes(engine):
+    session = SessionMaker()
+    _populate(session)
+
+    connection = engine.connect()
+    state = ClusterState.load(connection)
+    stale_node = state.name2node["stale"]
+    num_selects = _count_selects(engine)
+
+    assert not state.refresh(connection)
+    assert num_selects() == 1
+
+    session.add(
+        GPUProcess(
+            id=102, gpu_id=1, node_name="fresh", slurm_job_id=1, user_name="alice"
+        )
+    )
+    session.query(Node).filter_by(name="fresh").update(
+        {Node.update_time: datetime.datetime.now()}
+    )
+    session.commit()
+
+    assert state.refresh(connection)
+    assert [proc.id for proc in state.name2node["fresh"].gpus[1].processes] == [102]
+    assert not state.name2node["fresh"].gpus[1].status.idle
+    # Not read again
+    assert state.name2node["stale"] is stale_node
+    assert state.name2node["stale"].gpus[0].slurm_job is state.jobs[3]
+
+    connection.close()
+
+
+def test_watch_redraws_only_on_change(engine, monkeypatch, capsys):
+    _populate(SessionMaker())
+
+    sleeps = []
+
+    def _sleep(interval):
+        sleeps.append(interval)
+        if len(sleeps) == 3:
+            raise KeyboardInterrupt()
+
+    monkeypatch.setattr(watch_module.time, "sleep", _sleep)
+
+    states = []
+
+    def _render(state):
+        states.append(state)
+        print(len(state.nodes))
+
+    watch_module.watch_cluster(_render, 0.5)
+
+    assert sleeps == [0.5] * 3
+    assert len(states) == 3
+    # Drawn once, escape codes are dropped when not writing to a terminal
+    assert capsys.readouterr().out == "2\n"
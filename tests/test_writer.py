@@ -0,0 +1,70 @@
+import collections
+import threading
+
+from gpu_use.monitor import monitor
+from gpu_use.monitor.cycle_stats import CycleStats
+from gpu_use.monitor.spool import SnapshotSpool
+from gpu_use.monitor.writer import SnapshotWriter
+from tests.test_spool import _make_state
+
+
+def test_writer_skips_stale_snapshots(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        monitor, "_spool", SnapshotSpool(path=str(tmpdir.join("spool.jsonl")))
+    )
+    monkeypatch.setattr(monitor, "sweep_orphans", lambda: False)
+
+    unblock = threading.Event()
+    written = []
+
+    def _write_spooled_states(last_fingerprint):
+        # The first write is stuck on the database while more is collected
+        unblock.wait()
+        states, marker = monitor.get_spool().pending()
+        if len(states) == 0:
+            return last_fingerprint
+
+        written.append(states["node1"].gpu2pid_info[0])
+        monitor.get_spool().discard(marker)
+        return "fingerprint"
+
+    monkeypatch.setattr(monitor, "write_spooled_states", _write_spooled_states)
+
+    writer = SnapshotWriter(max_queue_size=3)
+    writer.start()
+    for pid in range(10):
+        writer.submit(_make_state("node1", pid=pid))
+    assert writer.queue_depth <= 3
+
+    unblock.set()
+    writer.stop()
+
+    # One write for what was being written when the rest came in, then one
+    # for the newest snapshot
+    assert len(written) <= 2
+    assert written[-1] == [9]
+    assert writer.num_dropped > 0
+    assert writer.last_fingerprint == "fingerprint"
+
+
+def test_failed_cycles_collected_while_writing_are_kept(tmpdir, engine, monkeypatch):
+    monkeypatch.setattr(
+        monitor, "_spool", SnapshotSpool(path=str(tmpdir.join("spool.jsonl")))
+    )
+    monkeypatch.setattr(monitor, "failed_cycles", collections.deque())
+    written = CycleStats("node1", start_time=0.0, failed_phase="gpus")
+    collected = CycleStats("node1", start_time=1.0, failed_phase="jobs")
+    monitor.failed_cycles.append(written)
+
+    write_cycle_stats = monitor.write_cycle_stats
+
+    def _write_cycle_stats(session, cycles):
+        # The collector thread fails another cycle meanwhile
+        monitor.failed_cycles.append(collected)
+        write_cycle_stats(session, cycles)
+
+    monkeypatch.setattr(monitor, "write_cycle_stats", _write_cycle_stats)
+
+    monitor.get_spool().append(_make_state("node1"))
+    assert monitor.write_spooled_states() is not None
+    assert list(monitor.failed_cycles) == [collected]